@@ -2,8 +2,7 @@ import adsk.core
 import adsk.fusion
 import traceback
 
-from .src.fusion_api import Handlers
-from .src.fusion_api.Handlers import handlers
+from .src.fusion_api import dependencies
 
 
 def create_tab(workspace, tab_name):
@@ -55,6 +54,7 @@ def create_button(workspace, tab, panel, button_name, CreatedEventHandler, toolt
             buttonId, button_name, tooltip, resources)
 
     # Connect to the command created event.
+    from .src.fusion_api.Handlers import handlers
     newcommandCreated = CreatedEventHandler()
     button.commandCreated.add(newcommandCreated)
     handlers.append(newcommandCreated)
@@ -89,6 +89,11 @@ def run(context):
         app = adsk.core.Application.get()
         ui = app.userInterface
 
+        # numpy is not part of the python of Fusion: installed in the lib folder of the add-in
+        if not dependencies.ensureModules(ui):
+            return
+        from .src.fusion_api import Handlers
+
         cmdDefinitions = ui.commandDefinitions
 
         # Get all workspaces:
@@ -0,0 +1,93 @@
+"""
+Benchmark of utils.convert_relative against the line by line implementation it replaced.
+
+    python -m benchmarks.bench_convert_relative --layers 2000 --tools 3
+"""
+import argparse
+import random
+import time
+
+from src import utils
+
+
+def convert_relative_reference(gcode_abs):
+    """ Line by line absolute to relative extrusion conversion (implementation before the vectorised one) """
+    if 'M83 ' in gcode_abs or 'M83\n' in gcode_abs:
+        return gcode_abs
+
+    absolute_mode = False
+    last_tool = None
+    last_e = {}     # {'tool': last extrusion value}
+
+    gcode_rel = ''
+
+    for line in gcode_abs.split('\n'):
+        if line == '':
+            continue
+
+        line_start = line.split(' ')[0]
+        if line_start == 'M82':
+            absolute_mode = True
+            line = 'M83'
+        elif line_start == 'M83':
+            absolute_mode = False
+        elif line_start[0] == 'T':
+            last_tool = line_start
+        elif line_start == 'G92':
+            last_e[last_tool] = line.split('E')[1]
+
+        if absolute_mode:
+            if line_start == 'G0' or line_start == 'G1':
+                try:
+                    line_split = line.split('E')
+                    current_extrusion = line_split[1]
+                    extrusion_diff = round(float(current_extrusion) - float(last_e[last_tool]), 3)
+                    last_e[last_tool] = current_extrusion
+                    line = line_split[0] + 'E' + str(extrusion_diff)
+                except IndexError:
+                    pass
+        gcode_rel += line + '\n'
+
+    return gcode_rel
+
+
+def absolute_gcode(layers, tools, moves_per_layer=200, seed=0):
+    """ Multi-tool absolute extrusion gcode with a G92 reset on every tool change """
+    rand = random.Random(seed)
+    lines = ['G21', 'G90', 'M82', 'T0', 'G92 E0']
+    extrusion = {tool: 0.0 for tool in range(tools)}
+    tool = 0
+    for layer in range(1, layers + 1):
+        lines.append(f'; layer {layer} of {layers},')
+        if tools > 1 and layer % 2 == 0:
+            tool = (tool + 1) % tools
+            lines += [f'T{tool}', 'G92 E0']
+            extrusion[tool] = 0.0
+        for _ in range(moves_per_layer):
+            extrusion[tool] += rand.uniform(0.01, 0.2)
+            lines.append(f'G1 X{rand.uniform(-50, 50):.3f} Y{rand.uniform(-50, 50):.3f} '
+                         f'Z{layer * 0.3:.3f} F1200 E{extrusion[tool]:.5f}')
+    return '\n'.join(lines) + '\n'
+
+
+def timed(function, *args):
+    start = time.perf_counter()
+    result = function(*args)
+    return result, time.perf_counter() - start
+
+
+if __name__ == "__main__":
+    arg_parser = argparse.ArgumentParser(description='convert_relative benchmark')
+    arg_parser.add_argument('--layers', type=int, default=500)
+    arg_parser.add_argument('--tools', type=int, default=2)
+    args = arg_parser.parse_args()
+
+    gcode = absolute_gcode(args.layers, args.tools)
+    print(f'{len(gcode) / 1e6:.1f} MB, {gcode.count(chr(10))} lines, {args.tools} tools')
+
+    reference, reference_time = timed(convert_relative_reference, gcode)
+    converted, converted_time = timed(utils.convert_relative, gcode)
+
+    assert converted == reference, 'outputs differ'
+    print(f'reference : {reference_time:8.3f} s')
+    print(f'vectorised: {converted_time:8.3f} s  (x{reference_time / converted_time:.1f})')
@@ -0,0 +1,106 @@
+"""
+Memory of the parsed CAM operations, in bytes per CAM line (tracemalloc).
+
+The CAM operations of a subtractive file made by src.gcode_generator are parsed with
+tracemalloc on: `retained` is the memory still held by the parsed operations (the
+CamGcodeBlock columns, the segments and the layers) once the input file is closed,
+`peak` the most memory used during the parse. Each size runs in a fresh process.
+The results can be saved and compared with a saved baseline, e.g. before and after a
+change of the line representation:
+
+    python -m benchmarks.bench_memory --save before.json
+    python -m benchmarks.bench_memory --baseline before.json
+"""
+import argparse
+import json
+import multiprocessing
+import sys
+import tempfile
+import tracemalloc
+
+from src import gcode_generator
+from src.ASMBL_parser import Parser
+
+SIZES = [2000, 8000, 32000]     # lines per CAM operation
+BASE = {'layers': 20, 'operations': 20}
+
+
+def parse_case(config, connection):
+    """ Parses the CAM operations of `config` with tracemalloc on, sends their measures """
+    parser = Parser(config, run=False, quiet=True)
+    parser.open_subtractive_file(config)
+    tracemalloc.start()
+    start, _ = tracemalloc.get_traced_memory()
+    operations = parser.parse_cam_operations()
+    parser.gcode_sub_file.close()
+    parser.gcode_sub = None
+    retained, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    blocks = {id(layer.segments[0].block): layer.segments[0].block for operation in operations for layer in operation}
+    lines = sum(len(block) for block in blocks.values())
+    connection.send({
+        'lines': lines,
+        'segments': sum(len(layer.segments) for operation in operations for layer in operation),
+        'layers': sum(len(operation) for operation in operations),
+        'retained_bytes_per_line': (retained - start) / lines,
+        'peak_bytes_per_line': (peak - start) / lines,
+        'column_bytes_per_line': sum(getattr(block, field).nbytes for block in blocks.values()
+                                     for field in ('commands', 'x', 'y', 'z', 'feeds', 'types')) / lines,
+    })
+    connection.close()
+
+
+def measure_case(lines_per_operation):
+    """ The measures of the parse of a subtractive file of `lines_per_operation`, in a new process """
+    with tempfile.TemporaryDirectory() as folder:
+        config = gcode_generator.write_pair(folder, 'input', lines_per_operation=lines_per_operation, **BASE)
+        context = multiprocessing.get_context('spawn')
+        receiver, sender = context.Pipe(duplex=False)
+        process = context.Process(target=parse_case, args=(config, sender))
+        process.start()
+        sender.close()
+        result = receiver.recv()
+        process.join()
+    return result
+
+
+def run_benchmark(sizes):
+    cases = []
+    for size in sizes:
+        case = {'lines_per_operation': size, **measure_case(size)}
+        print(f"{size:>8} lines/operation {case['lines']:>9} lines {case['segments']:>7} segments: "
+              f"retained {case['retained_bytes_per_line']:6.1f} B/line "
+              f"(columns {case['column_bytes_per_line']:4.1f}), peak {case['peak_bytes_per_line']:6.1f} B/line")
+        cases.append(case)
+    return {'cases': cases}
+
+
+if __name__ == "__main__":
+    arg_parser = argparse.ArgumentParser(description='memory per CAM line benchmark')
+    arg_parser.add_argument('--sizes', type=int, nargs='+', default=SIZES, metavar='N',
+                            help='lines per CAM operation of each case')
+    arg_parser.add_argument('--save', metavar='FILE', help='save the results in this JSON file')
+    arg_parser.add_argument('--baseline', metavar='FILE', help='JSON results to compare with')
+    args = arg_parser.parse_args()
+
+    results = run_benchmark(args.sizes)
+    if args.save:
+        with open(args.save, 'w') as results_file:
+            json.dump(results, results_file, indent=4)
+
+    if args.baseline:
+        with open(args.baseline) as baseline_file:
+            baseline = {case['lines_per_operation']: case for case in json.load(baseline_file)['cases']}
+        grew = False
+        for case in results['cases']:
+            reference = baseline.get(case['lines_per_operation'])
+            if reference is None:
+                continue
+            for measure in ('retained_bytes_per_line', 'peak_bytes_per_line'):
+                change = case[measure] / reference[measure] - 1
+                grew = grew or change > 0.05
+                print(f"{case['lines_per_operation']:>8} {measure}: {reference[measure]:6.1f} -> "
+                      f"{case[measure]:6.1f} B/line ({change:+.0%})")
+        if grew:
+            sys.exit(1)
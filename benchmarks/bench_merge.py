@@ -0,0 +1,186 @@
+"""
+End-to-end scaling benchmark of the merge pipeline (Parser + output file).
+
+The Parser runs on inputs of increasing size made by src.gcode_generator, one sweep per
+dimension (additive layer count, CAM operation count, lines per CAM operation and Z height
+of the 3D surfacing blocs), the other dimensions keeping their base value. Each case runs
+in a fresh process to measure its peak RSS. The results (throughput, peak RSS and
+per-stage times) are saved as JSON and can be compared with a saved baseline:
+
+    python -m benchmarks.bench_merge --save results.json
+    python -m benchmarks.bench_merge --baseline results.json --threshold 0.2
+"""
+import argparse
+import json
+import multiprocessing
+import os
+import platform
+import sys
+import tempfile
+import time
+
+from src import gcode_generator
+from src.ASMBL_parser import Parser
+from src.profiler import StageProfiler
+
+BASE = {'layers': 400, 'operations': 20, 'lines_per_operation': 2000, 'surfacing_height': 20}
+
+SWEEPS = {
+    'layers': [100, 400, 1600, 6400],
+    'operations': [5, 20, 80, 320],
+    'lines_per_operation': [500, 2000, 8000, 32000],
+    'surfacing_height': [5, 20, 80],
+}
+QUICK_SWEEPS = {name: values[:2] for name, values in SWEEPS.items()}
+
+
+def write_inputs(folder, params):
+    """ Generates the input files of the case `params` in `folder`, returns the config to merge them """
+    config = gcode_generator.write_pair(folder, 'input', **params)
+    config['OutputSettings']['filename'] = 'merged'
+    return config
+
+
+def peak_rss_mb():
+    """
+    Peak RSS (MB) of this process: resource on Unix, psutil on Windows (peak working set),
+    None on Windows without psutil
+    """
+    if sys.platform == 'win32':
+        try:
+            import psutil
+        except ImportError:
+            return None
+        return psutil.Process().memory_info().peak_wset / 2**20
+
+    import resource
+    # kB on linux, bytes on macOS:
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / (2**20 if sys.platform == 'darwin' else 2**10)
+
+
+def run_case(config, folder):
+    """ Merges the input files of `config` into `folder`, returns the measures of the run """
+    profiler = StageProfiler(memory=False)
+    start = time.perf_counter()
+    parser = Parser(config, profiler=profiler, quiet=True)
+    parser.create_output_file(folder_path=os.path.join(folder, ''), open_output=False)
+    wall = time.perf_counter() - start
+    return {'wall_s': wall, 'peak_rss_MB': peak_rss_mb(),
+            'stages': {stage.name: stage.wall_s for stage in profiler.stages}}
+
+
+def case_worker(config, folder, connection):
+    connection.send(run_case(config, folder))
+    connection.close()
+
+
+def run_isolated(config, folder):
+    """ run_case in a new process, so that its peak RSS is its own """
+    context = multiprocessing.get_context('spawn')
+    receiver, sender = context.Pipe(duplex=False)
+    process = context.Process(target=case_worker, args=(config, folder, sender))
+    process.start()
+    sender.close()
+    result = receiver.recv()
+    process.join()
+    return result
+
+
+def measure_case(params, repeat=1):
+    """ The measures of the case `params`, the fastest of `repeat` runs """
+    with tempfile.TemporaryDirectory() as folder:
+        config = write_inputs(folder, params)
+        input_bytes, input_lines = 0, 0
+        for path in config['InputFiles'].values():
+            with open(path, 'rb') as input_file:
+                data = input_file.read()
+            input_bytes += len(data)
+            input_lines += data.count(b'\n')
+
+        result = min((run_isolated(config, folder) for _ in range(repeat)), key=lambda result: result['wall_s'])
+
+    return {
+        'input_bytes': input_bytes,
+        'input_lines': input_lines,
+        'wall_s': result['wall_s'],
+        'lines_per_s': input_lines / result['wall_s'],
+        'MB_per_s': input_bytes / 1e6 / result['wall_s'],
+        'peak_rss_MB': result['peak_rss_MB'],
+        'stages': result['stages'],
+    }
+
+
+def run_benchmark(sweeps, repeat=1):
+    """ Runs every case of `sweeps` {dimension: [values]}, keeps the fastest of `repeat` runs """
+    cases = []
+    for dimension, values in sweeps.items():
+        for value in values:
+            params = dict(BASE, **{dimension: value})
+            case = {'sweep': dimension, 'params': params, **measure_case(params, repeat)}
+            rss = 'RSS unknown' if case['peak_rss_MB'] is None else f"{case['peak_rss_MB']:8.1f} MB RSS"
+            print(f"{dimension:>20} = {value:<6} {case['input_bytes'] / 1e6:8.1f} MB {case['wall_s']:8.2f} s "
+                  f"{case['MB_per_s']:6.2f} MB/s {rss}")
+            cases.append(case)
+    return {
+        'machine': {'python': platform.python_version(), 'platform': platform.platform(),
+                    'processor': platform.processor(), 'cpus': os.cpu_count()},
+        'cases': cases,
+    }
+
+
+def case_key(case):
+    return case['sweep'], json.dumps(case['params'], sort_keys=True)
+
+
+def compare(results, baseline, threshold=0.2, rss_threshold=0.2):
+    """
+    Returns the list of the regressions of `results` against `baseline`: the cases whose
+    wall time or peak RSS grew by more than `threshold` / `rss_threshold` (fractions)
+    """
+    baseline_cases = {case_key(case): case for case in baseline['cases']}
+    regressions = []
+    for case in results['cases']:
+        reference = baseline_cases.get(case_key(case))
+        if reference is None:
+            continue
+        for measure, limit in (('wall_s', threshold), ('peak_rss_MB', rss_threshold)):
+            if case[measure] is None or reference[measure] is None:    # no peak RSS on Windows without psutil
+                continue
+            ratio = case[measure] / reference[measure]
+            if ratio > 1 + limit:
+                regressions.append(f"{case['sweep']}={case['params'][case['sweep']]}: {measure} "
+                                   f"{reference[measure]:.2f} -> {case[measure]:.2f} (x{ratio:.2f})")
+    return regressions
+
+
+if __name__ == "__main__":
+    arg_parser = argparse.ArgumentParser(description='merge pipeline scaling benchmark')
+    arg_parser.add_argument('--quick', action='store_true', help='only the 2 smallest values of each sweep')
+    arg_parser.add_argument('--sweep', choices=list(SWEEPS), action='append',
+                            help='only run this sweep (can be repeated)')
+    arg_parser.add_argument('--repeat', type=int, default=1, help='runs per case, the fastest is kept')
+    arg_parser.add_argument('--save', metavar='FILE', help='save the results in this JSON file')
+    arg_parser.add_argument('--baseline', metavar='FILE', help='JSON results to compare with')
+    arg_parser.add_argument('--threshold', type=float, default=0.2,
+                            help='allowed wall time increase over the baseline (fraction, default 0.2)')
+    arg_parser.add_argument('--rss-threshold', type=float, default=0.2,
+                            help='allowed peak RSS increase over the baseline (fraction, default 0.2)')
+    args = arg_parser.parse_args()
+
+    sweeps = QUICK_SWEEPS if args.quick else SWEEPS
+    if args.sweep:
+        sweeps = {name: sweeps[name] for name in args.sweep}
+
+    results = run_benchmark(sweeps, args.repeat)
+    if args.save:
+        with open(args.save, 'w') as results_file:
+            json.dump(results, results_file, indent=4)
+
+    if args.baseline:
+        with open(args.baseline) as baseline_file:
+            regressions = compare(results, json.load(baseline_file), args.threshold, args.rss_threshold)
+        for regression in regressions:
+            print('REGRESSION', regression)
+        if regressions:
+            sys.exit(1)
+        print('no regression')
@@ -0,0 +1,131 @@
+"""
+Startup time of the command line tool: what a short job pays before and around its work.
+
+Two measures:
+- the import time of the modules of main.py and of the parser (python -X importtime),
+  the modules slower to import than --min-ms are listed as a tree;
+- the wall time of complete launches, the median of --repeat runs: `--help` (the startup
+  alone) and the merge of a small pair of files made by src.gcode_generator.
+
+The launches run `python main.py` or, with --executable, the packaged tool (make exe):
+
+    python -m benchmarks.bench_startup
+    python -m benchmarks.bench_startup --executable dist/N-Fab/N-Fab --target-ms 400 --merge-target-ms 1000
+
+The exit status is 1 when the median of the `--help` launches is over --target-ms or
+the median of the small merges is over --merge-target-ms.
+"""
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+from src import gcode_generator
+
+MAIN = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'main.py')
+
+IMPORTED = {    # {name: (python arguments, depth of the modules listed)}
+    'main.py --help': ([MAIN, '--help'], 0),
+    'src.ASMBL_parser': (['-c', 'import src.ASMBL_parser'], 1),
+}
+
+SMALL_JOB = {'layers': 20, 'operations': 4, 'lines_per_operation': 200, 'surfacing_height': 5}
+
+
+def import_times(arguments, depth=0, min_ms=1.0):
+    """
+    Runs python -X importtime `arguments`, returns (total ms, [(level, module, cumulative ms)])
+    of the modules imported up to `depth` levels below the top level and slower than
+    `min_ms`, in the order of the import tree
+    """
+    process = subprocess.run([sys.executable, '-X', 'importtime', *arguments], cwd=os.path.dirname(MAIN),
+                             stdout=subprocess.DEVNULL, stderr=subprocess.PIPE, text=True, check=True)
+    total, modules = 0, []
+    # -X importtime prints a module once its imports are done: the tree is read backwards
+    for line in reversed(process.stderr.splitlines()):
+        if not line.startswith('import time:') or 'cumulative' in line:
+            continue
+        _, cumulative, name = line[len('import time:'):].split('|')
+        level = (len(name) - len(name.lstrip()) - 1) // 2
+        ms = int(cumulative) / 1000
+        if level == 0:
+            total += ms
+        if level <= depth and ms >= min_ms:
+            modules.append((level, name.strip(), ms))
+    return total, modules
+
+
+def launch_times(command, repeat=10, cwd=None):
+    """ Wall times (s) of `repeat` runs of `command` """
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        subprocess.run(command, cwd=cwd, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL, check=True)
+        times.append(time.perf_counter() - start)
+    return times
+
+
+def run_benchmark(executable=None, repeat=10, min_ms=1.0):
+    """ Measures the imports and the launches, see the module docstring """
+    results = {'imports': {}, 'launches': {}}
+    for name, (arguments, depth) in IMPORTED.items():
+        total, modules = import_times(arguments, depth, min_ms)
+        results['imports'][name] = {'total_ms': total, 'modules': {module: ms for _, module, ms in modules}}
+        print(f'{name}: {total:.1f} ms of imports')
+        for level, module, ms in modules:
+            print(f"{ms:10.1f} ms  {'  ' * level}{module}")
+
+    tool = [executable] if executable else [sys.executable, MAIN]
+    with tempfile.TemporaryDirectory() as folder:
+        config = gcode_generator.write_pair(folder, 'input', **SMALL_JOB)
+        config_path = os.path.join(folder, 'config.json')
+        with open(config_path, 'w') as config_file:
+            json.dump(config, config_file)
+
+        launches = {
+            '--help': tool + ['--help'],
+            'small merge': tool + ['--config', config_path, '--output', folder, '--no-open'],
+        }
+        for name, command in launches.items():
+            times = launch_times(command, repeat, cwd=folder)
+            results['launches'][name] = {'median_ms': 1000 * statistics.median(times), 'min_ms': 1000 * min(times)}
+            print(f"{' '.join(tool)} {name}: median {results['launches'][name]['median_ms']:.0f} ms, "
+                  f"min {results['launches'][name]['min_ms']:.0f} ms over {repeat} runs")
+    return results
+
+
+if __name__ == "__main__":
+    arg_parser = argparse.ArgumentParser(description='startup time benchmark')
+    arg_parser.add_argument('--executable', metavar='FILE', default=None,
+                            help='packaged tool to launch instead of python main.py')
+    arg_parser.add_argument('--repeat', type=int, default=10, help='launches of each command')
+    arg_parser.add_argument('--min-ms', type=float, default=1.0, help='only list the imports slower than this')
+    arg_parser.add_argument('--target-ms', type=float, default=None,
+                            help='fail when the median startup (--help) is over this time')
+    arg_parser.add_argument('--merge-target-ms', type=float, default=None,
+                            help='fail when the median small merge is over this time')
+    arg_parser.add_argument('--save', metavar='FILE', help='save the results in this JSON file')
+    args = arg_parser.parse_args()
+
+    results = run_benchmark(args.executable, args.repeat, args.min_ms)
+    if args.save:
+        with open(args.save, 'w') as results_file:
+            json.dump(results, results_file, indent=4)
+
+    too_slow = False
+    for name, launch, target in (('startup', '--help', args.target_ms),
+                                 ('small merge', 'small merge', args.merge_target_ms)):
+        if target is None:
+            continue
+        median = results['launches'][launch]['median_ms']
+        if median > target:
+            print(f'TOO SLOW: {name} {median:.0f} ms > target {target:.0f} ms')
+            too_slow = True
+        else:
+            print(f'{name} {median:.0f} ms <= target {target:.0f} ms')
+    if too_slow:
+        sys.exit(1)
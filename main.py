@@ -1,8 +1,11 @@
-from src.ASMBL_parser import Parser
-
 import json
 import argparse
 import os
+import sys
+
+# The modules of src are imported by the mode which uses them: numpy, the parser and the
+# http server are slow to import, --help or a wrong option should not wait for them.
+DEFAULT_SERVICE_ADDRESS = '127.0.0.1:8765'   # service.DEFAULT_ADDRESS
 
 
 def arg_parser_json(arg):
@@ -14,17 +17,154 @@ def arg_parser_json(arg):
         return json.load(open(arg, 'r'))  # return a dict from the json
 
 
+def apply_overrides(config, args):
+    """ Applies the command line options overriding the settings of `config` """
+    if args.cache is not None:
+        config.setdefault('Cache', {})['folder'] = args.cache
+    if args.split_folder is not None:
+        config['OutputSettings']['split_folder'] = args.split_folder
+    if args.format is not None:
+        config['OutputSettings']['format'] = args.format
+    if args.log_level is not None:
+        config.setdefault('Logging', {})['level'] = args.log_level
+    if args.log_file is not None:
+        config.setdefault('Logging', {})['file'] = args.log_file
+
+
 if __name__ == "__main__":
+    if getattr(sys, 'frozen', False):
+        import multiprocessing
+        multiprocessing.freeze_support()    # worker processes of the pyinstaller executable
 
     arg_parser = argparse.ArgumentParser(description='N-Fab Code Creation Tool')
-    arg_parser.add_argument('--config', '-C', type=arg_parser_json, default='config.json',
+    arg_parser.add_argument('--config', '-C', default='config.json',
                             metavar='FILE', help='path to json config file')
+    arg_parser.add_argument('--cache', metavar='FOLDER', default=None,
+                            help='folder of the cache of the parsed input files (overrides the config)')
+    arg_parser.add_argument('--split-folder', metavar='FOLDER', default=None,
+                            help='also write the subtractive gcode split by 3D surfacing in FOLDER, for debugging')
+    arg_parser.add_argument('--log-level', metavar='LEVEL', default=None,
+                            help='level of the messages written in the log file: DEBUG, INFO (default), WARNING...')
+    arg_parser.add_argument('--log-file', metavar='FILE', default=None,
+                            help='path of the log file (default: output/<filename>.log)')
+    arg_parser.add_argument('--profile', nargs='?', const='', default=None, metavar='FILE',
+                            help='save the time, memory and size of each stage in a JSON report '
+                                 '(default: output/<filename>_profile.json)')
+    arg_parser.add_argument('--profile-trace', metavar='FILE', default=None,
+                            help='also save the stages as a Chrome trace-event file')
+    arg_parser.add_argument('--sweep', type=arg_parser_json, default=None, metavar='FILE',
+                            help='json file of CamSettings values to sweep: {"layer_overlap": [1, 2, 3], ...}')
+    arg_parser.add_argument('--workers', type=int, default=None, metavar='N',
+                            help='number of worker processes to parse the CAM operations (default: 1) '
+                                 'or to run the sweep or the batch (default: number of cores)')
+    arg_parser.add_argument('--plan-only', action='store_true',
+                            help='only save the merge plan of each combination of the sweep, no gcode')
+    arg_parser.add_argument('--batch', metavar='MANIFEST', default=None,
+                            help='JSON list of the config files of the jobs to run, or folder of config files')
+    arg_parser.add_argument('--output', metavar='FOLDER', default='output/',
+                            help='folder of the merged files (default: output/)')
+    arg_parser.add_argument('--format', choices=['gcode', 'bgcode'], default=None,
+                            help='text gcode or binary gcode output, overrides "format" in the config')
+    arg_parser.add_argument('--no-open', action='store_true',
+                            help='do not open the merged file in an editor')
+    arg_parser.add_argument('--watch', action='store_true',
+                            help='merge again each time the input files or the config change, until Ctrl-C')
+    arg_parser.add_argument('--serve', nargs='?', const=DEFAULT_SERVICE_ADDRESS, default=None, metavar='ADDRESS',
+                            help='run the merge service on ADDRESS, host:port or unix:path '
+                                 f'(default: {DEFAULT_SERVICE_ADDRESS}), until Ctrl-C')
+    arg_parser.add_argument('--server', metavar='ADDRESS', default=None,
+                            help='merge on the merge service running on ADDRESS')
+    arg_parser.add_argument('--upload', action='store_true',
+                            help='send the input files to the merge service instead of their paths')
 
     args = arg_parser.parse_args()
 
+    if args.serve is not None:
+        from src import service
+        service.serve(args.serve, workers=args.workers, folder_path=args.output)
+        raise SystemExit
+
+    if args.batch is not None:
+        if args.log_file is not None:
+            arg_parser.error('--log-file can not be shared by the jobs of a batch')
+        from src.batch import load_manifest, run_batch
+        jobs = load_manifest(args.batch)
+        for _, config in jobs:
+            apply_overrides(config, args)
+        summary = run_batch(jobs, folder_path=args.output, workers=args.workers)
+        print(f"{summary['succeeded']}/{summary['jobs']} jobs succeeded in {summary['wall_s']:.2f} s, "
+              f"summary saved in {summary['path']}")
+        raise SystemExit(1 if summary['failed'] else 0)
+
+    try:
+        config_path, args.config = args.config, arg_parser_json(args.config)
+    except argparse.ArgumentTypeError as error:
+        arg_parser.error(str(error))
+    apply_overrides(args.config, args)
+
+    if args.watch:
+        from src.watch import Watcher
+        watcher = Watcher(config_path, folder_path=args.output, workers=args.workers,
+                          overrides=lambda config: apply_overrides(config, args))
+        print(f'Watching {", ".join(watcher.paths())}...')
+        try:
+            watcher.run()
+        except KeyboardInterrupt:
+            pass
+        raise SystemExit
+
+    if args.sweep is not None:
+        from src.sweep import run_sweep
+        results = run_sweep(args.config, args.sweep, folder_path=args.output, workers=args.workers,
+                            write=not args.plan_only, plan=args.plan_only)
+        if args.plan_only:
+            plan_path = os.path.join(args.output, args.config['OutputSettings']['filename'] + '_sweep_plan.json')
+            os.makedirs(args.output, exist_ok=True)
+            with open(plan_path, 'w') as plan_file:
+                json.dump(results, plan_file, indent=4)
+        for result in results:
+            print(f"{result['index']:3d} {result['settings']}: {result['cam_layers']} CAM layers, "
+                  f"heights {result['cam_heights']} -> {result['file'] or 'not written'}")
+        print('complete')
+        raise SystemExit
+
+    if args.server is not None:
+        from src import service
+
+        def print_event(event):
+            if event['event'] == 'queued':
+                print(f"job {event['job']} queued, {event['jobs_ahead']} jobs ahead")
+            elif event['event'] == 'progress':
+                print(event['message'] + '...')
+        result = service.merge(args.config, args.server, upload_inputs=args.upload,
+                               output_folder=None if args.upload else os.path.abspath(args.output),
+                               on_event=print_event)
+        for stage in result['stages']:
+            print(f"{stage['name']:>24} {stage['wall_s']:8.3f} s")
+        file_path = result['file']
+        if args.upload:     # written on the server, in its output folder
+            file_path = service.download(file_path, args.output, args.server)
+        print(f"merged in {result['wall_s']:.2f} s -> {file_path}")
+        raise SystemExit
+
+    from src.ASMBL_parser import Parser
+
+    profiler = None
+    if args.profile is not None or args.profile_trace is not None:
+        from src.profiler import StageProfiler
+        profiler = StageProfiler()
+
     print('parsing files...')
-    asmbl_parser = Parser(args.config)
+    asmbl_parser = Parser(args.config, workers=args.workers, profiler=profiler)
     print('saving output...')
-    asmbl_parser.create_output_file(asmbl_parser.merged_gcode_script)
+    asmbl_parser.create_output_file(folder_path=os.path.join(args.output, ''), open_output=not args.no_open)
+
+    if profiler is not None:
+        report_path = args.profile or os.path.join(args.output, args.config['OutputSettings']['filename'] + '_profile.json')
+        os.makedirs(os.path.dirname(report_path) or '.', exist_ok=True)
+        profiler.write_json(report_path)
+        print(f'profile saved in {report_path}')
+        if args.profile_trace is not None:
+            profiler.write_trace(args.profile_trace)
     print('complete')
     pass
@@ -1,16 +1,26 @@
-import sys
-import subprocess
+import contextlib
 import os
-import re
+import numpy as np
+from bisect import bisect_right
+from itertools import accumulate, takewhile
 from math import (
     inf,
-    ceil,
     floor,
 )
 from . import utils
-from .additive_gcode import AdditiveGcodeLayer
+from . import gcode_lexer
+from .gcode_file import GcodeFile
+from .run_log import RunLog, logger
+from .additive_gcode import (
+    AdditiveGcodeLayer,
+    AdditiveLayerTable,
+)
 from .cam_gcode import (
-    CamGcodeLine,
+    CUTTING_TYPES,
+    LEAD_IN_TYPES,
+    LEAD_OUT_TYPES,
+    RAMP_TYPES,
+    CamGcodeBlock,
     CamGcodeSegment,
     CamGcodeLayer,
 )
@@ -19,56 +29,125 @@ from .cam_gcode import (
 class Parser:
     """ Main parsing class. """
 
-    def __init__(self, config, progress=None):
+    def __init__(self, config, progress=None, keep_script=False, run=True, workers=1, profiler=None, quiet=False):
         self.config = config
         self.progress = progress    # progress bar for Fusion add-in
-        self.offset = (config['Printer']['bed_centre_x'],
-                       config['Printer']['bed_centre_y'],
-                       config['PrintSettings']['raft_height'] - config['CamSettings']['layer_dropdown']
-                       )
+        self.quiet = quiet          # no stage messages on stdout (batch, sweep, watch and service workers)
+        self.profiler = profiler    # StageProfiler measuring each stage of the run, see profiler.py
+        self.keep_script = keep_script  # also build the whole output in self.merged_gcode_script
+        self.workers = workers or 1     # number of worker processes used to parse, 1: no worker process
+        self.cache = None           # ParseCache of the 'Cache' section of the config, if there is one
+        if config.get('Cache'):
+            from .parse_cache import ParseCache     # only loaded with a cache
+            self.cache = ParseCache.from_config(config)
+        self.offset = self.cam_offset(config)
         #<JLC>
         self.flag_append_AddSubGcode = config['Flags']['append_AddSubGcode']
         #</JLC>
         
         self.last_additive_tool = None
         self.last_subtractive_tool = None 
-
-        self.main()
+        self.merged_gcode = None
+        self.merged_gcode_script = None
+
+        if run:
+            with RunLog(config):
+                self.main()
+
+    def announce(self, message):
+        """ Prints the message of a stage, unless the parser is quiet """
+        if not self.quiet:
+            print(message)
+
+    @staticmethod
+    def cam_offset(config):
+        """ X, Y & Z offset applied to the CAM gcode """
+        return (config['Printer']['bed_centre_x'],
+                config['Printer']['bed_centre_y'],
+                config['PrintSettings']['raft_height'] - config['CamSettings']['layer_dropdown']
+                )
 
     def main(self):
         progress = self.progress
 
-        print('Opening files...')
+        self.announce('Opening files...')
         if progress:
             progress.message = 'Opening files'
             progress.progressValue += 1
-        self.open_files(self.config)
+        with self.stage('open') as stage:
+            self.open_files(self.config)
+            if stage: stage.add_output(self.gcode_add, self.gcode_sub_file)
 
-        # Fusion 360 currently only exports absolute extrusion gcode, this needs to be converted
-        # This method will not convert gcode if it is already relative
-        print('Converting additive gcode to relative positioning...')
-        if progress:
-            progress.message = 'Converting additive gcode to relative positioning'
-            progress.progressValue += 1
-        self.gcode_add = utils.convert_relative(self.gcode_add)
+        with self.stage('convert_relative') as stage:
+            if stage: stage.add_input(self.gcode_add)
+            cached_additive = self.convert_additive_gcode()
+            if stage: stage.add_output(self.gcode_add)
 
         #<JLC>
         if self.flag_append_AddSubGcode:
             if progress:
                 progress.message = 'Appending substractive to additive Gcode'
                 progress.progressValue += 1
-                
-            self.merged_gcode_script = '; N-Fab gcode created by NAMMA\n'
-            self.merged_gcode_script += self.appendSub2AddGcode()
-            
+
+            if self.keep_script:
+                self.create_gcode_script()
             return
         #</JLC>
         
-        print('Spliting additive gcode layers...')
+        with self.stage('split_additive') as stage:
+            self.split_additive_gcode(cached_additive)
+            if stage: stage.add_input(self.gcode_add); stage.add_output(self.gcode_add_layers)
+
+        operations = self.parse_cam_operations()
+        self.gcode_sub_file.close()   # no more needed, don't keep the file mapped
+
+        self.schedule(operations)
+
+    def stage(self, name):
+        """ Context manager measuring the stage `name` with the profiler, yields its StageRecord (None without profiler) """
+        if self.profiler is None:
+            return contextlib.nullcontext()
+        return self.profiler.stage(name)
+
+    def convert_additive_gcode(self):
+        """
+        Converts the additive gcode to relative extrusion.
+        Returns the cached parsed additive gcode if the same file was already parsed, None otherwise.
+        """
+        progress = self.progress
+
+        # the parsed additive gcode is taken from the cache if the same file was already parsed:
+        cached_additive = None
+        if self.cache is not None and not self.flag_append_AddSubGcode:
+            cached_additive = self.cache.load(self.gcode_add_key)
+
+        # Fusion 360 currently only exports absolute extrusion gcode, this needs to be converted
+        # This method will not convert gcode if it is already relative
+        self.announce('Converting additive gcode to relative positioning...')
+        if progress:
+            progress.message = 'Converting additive gcode to relative positioning'
+            progress.progressValue += 1
+        if cached_additive is None:
+            self.gcode_add = utils.convert_relative(self.gcode_add)
+
+        return cached_additive
+
+    def split_additive_gcode(self, cached_additive=None):
+        """ Splits the relative additive gcode in layers, or rebuilds them from `cached_additive` """
+        progress = self.progress
+
+        self.announce('Spliting additive gcode layers...')
         if progress:
             progress.message = 'Spliting additive gcode layers'
             progress.progressValue += 1
-            
+
+        if cached_additive is not None:
+            self.announce('Using the cached additive gcode layers...')
+            from . import parse_cache
+            self.gcode_add, table, names, ORCA = parse_cache.unpack_additive(cached_additive)
+            self.gcode_add_layers = self.make_additive_layers(self.gcode_add, table, names, ORCA)
+            return
+
         #<JLC8>
         ORCA = False
         if 'OrcaSlicer' in self.gcode_add:
@@ -85,57 +164,114 @@ class Parser:
         #</JLC8>
         
         self.gcode_add_layers = self.split_additive_layers(self.gcode_add, ORCA)
+        if self.cache is not None:
+            from . import parse_cache
+            names = [layer.name for layer in self.gcode_add_layers]
+            self.cache.store(self.gcode_add_key,
+                             parse_cache.pack_additive(self.gcode_add, self.gcode_add_table, names, ORCA))
+
+    def parse_cam_operations(self):
+        """
+        Splits the subtractive gcode in CAM operations, each a list of CamGcodeLayer,
+        or takes them from the cache if the same file was already parsed with the same
+        offset and 3D surfacing settings
+        """
+        progress = self.progress
+
+        cached_cam, cam_key = None, None
+        if self.cache is not None:
+            from . import parse_cache
+            cam_key = parse_cache.ParseCache.key('cam', self.gcode_sub_file.data, self.cam_cache_fields())
+            cached_cam = self.cache.load(cam_key)
         
         #<JLC4>
-        print('Pre-processing substractive gcode file...')
+        self.announce('Pre-processing substractive gcode file...')
         if progress:
             progress.message = 'Preprocessing subtractive gcode file'
             progress.progressValue += 1
-        self.gcode_sub = self.preprocess_sub_gcode_file()
+        with self.stage('preprocess_subtractive') as stage:
+            if cached_cam is None:
+                self.gcode_sub = self.preprocess_sub_gcode_file()
+                if stage: stage.add_input(self.gcode_sub_file); stage.add_output(self.gcode_sub)
+            else:
+                self.gcode_sub = None
         #</JLC4>
 
-        print('Spliting substractive gcode layers...')
+        self.announce('Spliting substractive gcode layers...')
         if progress:
             progress.message = 'Spliting subtractive gcode layers'
             progress.progressValue += 1
-        operations = self.split_cam_operations(self.gcode_sub)
+        with self.stage('split_cam') as stage:
+            if cached_cam is None:
+                operations = self.split_cam_operations(self.gcode_sub)
+                if self.cache is not None:
+                    self.cache.store(cam_key, parse_cache.pack_cam_operations(operations))
+                if stage: stage.add_input(self.gcode_sub)
+            else:
+                self.announce('Using the cached CAM operations...')
+                operations = self.make_cam_operations(parse_cache.unpack_cam_operations(cached_cam))
+            if stage: stage.add_output(operations)
+
+        return operations
+
+    def schedule(self, operations):
+        """
+        Orders the CAM layers of `operations` and merges them with the additive layers.
+        Can be called again on the same operations with other CamSettings (see sweep.py).
+        """
+        progress = self.progress
 
-        print('Ordering subtractive gcode layers...')
+        self.announce('Ordering subtractive gcode layers...')
         if progress:
             progress.message = 'Ordering subtractive gcode layers'
             progress.progressValue += 1
-        self.cam_layers = self.order_cam_operations_by_layer(operations)
+        with self.stage('order') as stage:
+            self.cam_layers = self.order_cam_operations_by_layer(operations)
+            if stage: stage.add_input(operations); stage.add_output(self.cam_layers)
 
-        print('Merging gcode layers...')
+        self.announce('Merging gcode layers...')
         if progress:
             progress.message = 'Merging gcode layers'
             progress.progressValue += 1
-        self.merged_gcode = self.merge_gcode_layers(self.gcode_add_layers, self.cam_layers)
+        with self.stage('merge') as stage:
+            self.merged_gcode = self.merge_gcode_layers(self.gcode_add_layers, self.cam_layers)
+            if stage: stage.add_input(self.gcode_add_layers, self.cam_layers); stage.add_output(self.merged_gcode)
 
-        print('Creating gcode script...')
-        if progress:
-            progress.message = 'Creating gcode script'
-            progress.progressValue += 1
-        self.create_gcode_script(self.merged_gcode)
+        # the output gcode is generated layer by layer when it is written, see create_output_file
+        if self.keep_script:
+            self.announce('Creating gcode script...')
+            if progress:
+                progress.message = 'Creating gcode script'
+                progress.progressValue += 1
+            with self.stage('script') as stage:
+                self.create_gcode_script()
+                if stage: stage.add_input(self.merged_gcode); stage.add_output(self.merged_gcode_script)
 
     def open_files(self, config):
-        """ Open the additive and subtractive gcode files in `config` """
-        with open(config['InputFiles']['additive_gcode'], 'r') as gcode_add_file:
+        """
+        Open the additive and subtractive gcode files in `config`.
+        Both are mmapped, the subtractive lines are addressed through the line index of
+        self.gcode_sub_file, the additive gcode is decoded once into a string.
+        """
+        self.open_additive_file(config)
+        self.open_subtractive_file(config)
+
+    def open_additive_file(self, config):
+        with GcodeFile(config['InputFiles']['additive_gcode']) as gcode_add_file:
             self.gcode_add = gcode_add_file.read()
+            if self.cache is not None:
+                self.gcode_add_key = self.cache.key('additive', gcode_add_file.data)
 
-        with open(config['InputFiles']['subtractive_gcode'], 'r') as gcode_sub_file:
-            if self.flag_append_AddSubGcode:
-                self.gcode_sub = gcode_sub_file.read()
-            #<JLC4>: rwind the file to get all the lines:
-            gcode_sub_file.seek(0)
-            self.gcode_sub_lines = gcode_sub_file.readlines()
-            #</JLC4>
+    def open_subtractive_file(self, config):
+        #<JLC4>: all the lines of the subtractive file:
+        self.gcode_sub_file = GcodeFile(config['InputFiles']['subtractive_gcode'])
+        #</JLC4>
             
     #<JLC>
     def appendSub2AddGcode(self):
         """ Just append the substractive Gcode to the additive Gcode..."""
         if self.gcode_add[-1] != '\n': self.gcode_add += '\n'
-        return self.gcode_add + self.gcode_sub.replace('(', ';(')
+        return self.gcode_add + self.gcode_sub_file.read().replace('(', ';(')
     #</JLC>
 
     #<JLC4>
@@ -144,36 +280,18 @@ class Parser:
         To split CAM operations with a large Z range into smaller overlapping CAM 
         operations each covering a small Z range.
         '''
-        
-        # write debug info in a log file:
-        if sys.platform == 'linux':
-            outputFolder = './output'
-        else:
-            outputFolder = os.path.expanduser('~/N-Fab/output/')
-            
-        fileName = self.config['OutputSettings']['filename'] + '.log'
-        log_file_name = os.path.join(outputFolder, fileName)
-        if os.path.exists(log_file_name):
-            os.remove(log_file_name)
-
-        blocs_to_split = self.split_gcode_file_stage1(log_file_name)
+        blocs_to_split = self.split_gcode_file_stage1()
         
         if len(blocs_to_split) == 0:
             # nothing to do...
-            splitted_gcode = ''.join(self.gcode_sub_lines)
+            splitted_gcode = [self.gcode_sub_file.read()]
         else:
-            splitted_gcode = self.split_gcode_file_stage2(blocs_to_split, log_file_name)
+            splitted_gcode = self.split_gcode_file_stage2(blocs_to_split)
         
-        # write the new substractive gcode file with '_split' added to its name:
-        name = self.config['InputFiles']['subtractive_gcode']
-        new_sub_gcode_file_name = name.replace('.gcode','') + '_split.gcode'
-        
-        if os.path.exists(new_sub_gcode_file_name):
-            os.remove(new_sub_gcode_file_name)
-            
-        with open(new_sub_gcode_file_name, 'w') as F:
-            F.write(splitted_gcode)
-        F.close()
+        # for debugging, the new substractive gcode file with '_split' added to its name:
+        split_folder = self.config['OutputSettings'].get('split_folder')
+        if split_folder:
+            self.write_split_gcode(splitted_gcode, split_folder)
 
         # <JLC5> bug 5.2 presence of '(type: ramp)' in sub gcode ???
         # splitted_gcode = splitted_gcode.replace('(type: ramp)', '(type: cutting)')     
@@ -181,363 +299,130 @@ class Parser:
         #       => no more need to replace 'ramp' by 'cutting'
         # </JLC5>
         
-        # Now returns all the lines:
+        # Now returns all the lines, as str pieces:
         return splitted_gcode
         
         # That's all...
                     
-    def log_message(self, message, log_file_path):
-        
-        with open(log_file_path, 'a') as Log:
-            Log.write(message)
-            if message[-1] != '\n':
-                Log.write('\n')
-            Log.flush()
-        Log.close()
-        
-    def split_gcode_file_stage1(self, log_file_path):
+    def write_split_gcode(self, splitted_gcode, folder):
+        """ Writes the str pieces of the split subtractive gcode in <folder>/<name>_split.gcode, returns its path """
+        name = os.path.basename(self.config['InputFiles']['subtractive_gcode'])
+        folder = os.path.expanduser(folder)
+        os.makedirs(folder, exist_ok=True)
+        file_path = os.path.join(folder, name.replace('.gcode', '') + '_split.gcode')
+        with open(file_path, 'w') as F:
+            utils.write_chunks(splitted_gcode, F)
+        return file_path
+
+    def split_gcode_file_stage1(self):
         '''
-        This method:
-        - reads the whole substractive GCode file to get all the lines
-        - looks for lines beginning with the TAG :
-            "(strategy: parallel_new)" or 
+        Looks for the blocs of the substractive GCode beginning with the TAG :
+            "(strategy: parallel_new)" or
             "(strategy: ramp)"
             "(strategy: contour2D)
-        For each bloc beginning with TAG and ending with a blank line ('\n'), the gcode  
-        lines are grouped by sub-blocs with a z range <= zRangeMax3Dsurfacing_mm, 
-        overlapping each other with zOverlap3Dsurfacing_mm.
+        and ending with a blank line ('\n'), see surfacing.find_blocs.
         '''
-        bloc_to_split= {}
-        num_bloc = 0
-        bloc_found = False
-
-        STRATEGIES = ('(strategy: parallel_new)', 
-                      '(strategy: ramp)',
-                      '(strategy: contour2d)')
-
-        # scan the GCode lines to catch the target:
-        for i, line in enumerate(self.gcode_sub_lines, 1):
-            if line.strip() in STRATEGIES:
-                STRATEGY = line.strip()
-                start_bloc = i-2
-                name = self.gcode_sub_lines[start_bloc]
-                bloc_to_split[num_bloc] = {'strategy': f'{STRATEGY}\n',
-                                           'type': '',
-                                           'name': name, 
-                                           'header': '',
-                                           'start_bloc': start_bloc, 
-                                           'needs_header': False}
-                bloc_found, cutting, first_cutting_line = True, False, None
-                Zmin = None
-                header = ''
-                num_sub_bloc = 0
-                continue
-           
-            if i == len(self.gcode_sub_lines) or line == '\n':
-                # This is the end of a "(strategy: ...)"" CAM bloc, save the bloc data
-                if bloc_found:
-                    bloc_to_split[num_bloc]['header']   = header
-                    bloc_to_split[num_bloc]['ZMinMax']  = (Zmin, Zmax)
-                    bloc_to_split[num_bloc]['end_bloc'] = i
-                    
-                    num_bloc += 1
-                    bloc_found, cutting, first_cutting_line = False, False, None
-                continue
-           
-            if bloc_found:
-                if line.startswith('T') or line.startswith('M'):
-                    # add lines like "T1" and "M3 S14000" to header:
-                    header += line
-                    
-                elif not cutting and (line.startswith('(type: cutting)') or line.startswith('(type: ramp)')):
-                    cutting = True
-                    if first_cutting_line is None:
-                        first_cutting_line = i-1
-                        bloc_to_split[num_bloc]['first_cutting_line'] = first_cutting_line
-                        bloc_to_split[num_bloc]['type'] = line.strip()
-                       
-                elif line[:2] == 'G0':
-                    prev_line = self.gcode_sub_lines[i-2]
-                    if i <  len(self.gcode_sub_lines) :
-                        next_line = self.gcode_sub_lines[i]
-                    else:
-                        next_line = '\n'
-                    if prev_line.startswith('(type:') and next_line != '\n':
-                        # A new surfacing phase takes place: we wil create a new sub-bloc
-                        # with "(strategy: ...)"
-                        # 1/ Save the data of the current bloc
-                        bloc_to_split[num_bloc]['header']   = header
-                        bloc_to_split[num_bloc]['ZMinMax']  = (Zmin, Zmax)
-                        bloc_to_split[num_bloc]['end_bloc'] = i-3
-                        # 2/ Prepare the new bloc
-                        num_bloc += 1
-                        num_sub_bloc +=1
-                        start_bloc = i-2
-                        new_name = name.strip()[:-1] + f'- split {num_sub_bloc})\n'
-                        
-                        bloc_to_split[num_bloc] = {'strategy': f'{STRATEGY}\n', 
-                                                   'type': prev_line.strip,
-                                                   'name': new_name, 
-                                                   'header': header,
-                                                   'start_bloc': start_bloc, 
-                                                   'needs_header': True}
-                        bloc_found, cutting = True, False
-                        first_cutting_line, Zmin = None, None
-                                         
-                elif cutting and line[:2] == 'G1':
-                    # Extract Z from a line in a 'cutting' zone like: 
-                    # "G1 X100.202 Y108.725 Z2.083 F924"
-                    Z = float(line.strip().split()[3][1:])
-                    if Zmin is None: 
-                        Zmin, Zmax = Z, Z
-                    if Z < Zmin:
-                        Zmin = Z
-                    elif Z > Zmax:
-                        Zmax = Z
-                else:
-                    cutting = False
-                        
-        return bloc_to_split
+        from . import surfacing
+        return surfacing.find_blocs(self.gcode_sub_file)
         
-    def split_gcode_file_stage2(self, blocs_to_split, log_file_path):
+    def split_gcode_file_stage2(self, blocs_to_split):
         '''
         In this method we split each surfacing CAM operation with a large Z range
-        into overlapping smaller surfacing operations.
+        into overlapping smaller surfacing operations, see surfacing.split_blocs.
         '''
         
         zRangeMax3Dsurfacing_mm = self.config['CamSettings']['zRangeMax_3Dsurfacing_mm']
         zOverlap3Dsurfacing_mm  = self.config['CamSettings']['zOverlap_3Dsurfacing_mm']
 
-        mess = f"zRangeMax3Dsurfacing_mm: {zRangeMax3Dsurfacing_mm}, zOverlap3Dsurfacing_mm: {zOverlap3Dsurfacing_mm}"
-        self.log_message(mess, log_file_path)
+        logger.info(f"zRangeMax3Dsurfacing_mm: {zRangeMax3Dsurfacing_mm}, zOverlap3Dsurfacing_mm: {zOverlap3Dsurfacing_mm}")
 
-        splitted_gcode = ""
-        start_line_number = 0
+        from . import surfacing
 
-        for key in blocs_to_split:
-            
-            bloc = blocs_to_split[key]         
-            mess = "\n" + "="*30 + \
-                f"\nProcessing bloc {key}\n" + \
-                f"\t(start, end):{(bloc['start_bloc'], bloc['end_bloc'])}\n" + \
-                f"\tname        :{repr(bloc['name'])}, needs_header:{bloc['needs_header']}\n" + \
-                f"\tstrategy    :{repr(bloc['strategy'])}\n" + \
-                f"\ttype        :{repr(bloc['type'])}\n" + \
-                f"\theader      :{repr(bloc['header'])}\n" + \
-                f"\t(Zmin, Zmax):{(bloc['ZMinMax'])}\n"
-            self.log_message(mess, log_file_path); print(mess)
-            
-            first_line_bloc, end_line_bloc = bloc['first_cutting_line'], bloc['end_bloc']
-            Zmin, Zmax = bloc['ZMinMax']
-           
-            # Fill splitted_gcode with the Gcode lines until the firts line of the bloc:
-            if bloc['needs_header']:
-                splitted_gcode += bloc['name']
-                splitted_gcode += bloc['strategy']
-                splitted_gcode += bloc['header']
-              
-            splitted_gcode += ''.join(self.gcode_sub_lines[start_line_number:first_line_bloc])
-
-            # TODO
-            if abs(Zmax - Zmin) <= zRangeMax3Dsurfacing_mm: 
-                # no need to split the CAM operation
-                splitted_gcode += ''.join(self.gcode_sub_lines[first_line_bloc:end_line_bloc])
-                if splitted_gcode[-2:] != '\n\n': splitted_gcode += '\n'
-                start_line_number = end_line_bloc
-                continue
-            
-            # The first split and following splits need some different processing:
-            first_split = True
-            
-            while(True):
-                Z, prevZ, Z1, Z2, L1, L2, next_L1 = None, None, None, None, None, None, None
-                cutting, Z_increase = False, None
-            
-                if bloc['strategy'].strip() in ('(strategy: ramp)', '(strategy: contour2d)') and first_split == False:
-                    # When surfacing a 'ramp', we are splitting a large numver of 'G1 ....' 
-                    # # lines with just one '(cutting)' line in the preamble : we must keep
-                    # the cutting state for all the 'G1 ...' lines:
-                    cutting = True
-                    
-                # Every loop turn allows to build one of the overlapping smaller bloc:
-                for i, line in enumerate(self.gcode_sub_lines[first_line_bloc:end_line_bloc], first_line_bloc):
-                 
-                    if not cutting and (line.startswith('(type: cutting)') or line.startswith('(type: ramp)')) :
-                        # start the cutting state:
-                        cutting = True
-                        continue   
-                                  
-                    elif cutting and line.startswith('('):
-                        # exit from the cutting state
-                        print("line.startswith('('):", line)
-                        cutting = False
-                        continue
-                 
-                    if cutting: 
-                        # When in cutting state we must find out the start and end of each small cutting bloc:
-                        if line[:2] == 'G1': 
-                            Z = float(line.strip().split()[3][1:])
-                            if prevZ is None:
-                                 prevZ = Z
-                            else:
-                                # JLC : Fusion BUG : sometime we find 2 consecutive G1 lines with a difference
-                                #       between the 2 Z  of about 0.001 mm...
-                                if 0 < abs(Z - prevZ) <= 0.001: 
-                                    continue                              
-                                if Z > prevZ: 
-                                    Z_increase = True
-                                elif Z < prevZ:
-                                    Z_increase = False
-                                #<JLC6>
-                                elif Z == prevZ:
-                                    Z_increase = None
-                                #</JLC6>                               
-
-                            if Z1 == None :
-                                # this is the beginning of a small cutting bloc
-                                Z1, L1 = Z, i
-                            else:
-                                if next_L1 == None:
-                                    if abs(Z1 - Z) >= (zRangeMax3Dsurfacing_mm - zOverlap3Dsurfacing_mm):
-                                        # this is the beginning of the next small overlapping cutting bloc
-                                        next_L1 = i
-                                        
-                                if (abs(Z1 - Z) >= zRangeMax3Dsurfacing_mm) or \
-                                   (Z_increase == True and Z == Zmax) or \
-                                   (Z_increase == False and Z == Zmin):
-                                    # this is the end of a small cutting bloc: the bloc is added to the 
-                                    # object splitted_gcode:
-                                    Z2, L2 = Z, i
-                                    mess = f"(Z1,Z2):({Z1:.3f},{Z2:.3f}), (L1,L2)={(L1,L2)}" 
-                                    self.log_message(mess, log_file_path); print(mess)
-                                    
-                                    if first_split == False:
-                                        splitted_gcode += bloc['name']
-                                        splitted_gcode += bloc['strategy']
-                                        splitted_gcode += bloc['header']
-                                        
-                                        if bloc['strategy'].strip() in ('(strategy: ramp)', '(strategy: contour2d)'):
-                                            # when splitting the many lines of a 'ramp', we must add
-                                            # the '(type: cutting)\n' line in each small splitted bloc:
-                                            splitted_gcode += f"{bloc['type']}\n"
-
-                                    splitted_gcode += ''.join(self.gcode_sub_lines[first_line_bloc:L2+1])
-                                    
-                                    if splitted_gcode[-2:] != '\n\n': 
-                                        splitted_gcode += '\n'
-                
-                                    if first_split: 
-                                        first_split = False
-                                 
-                                    # Ready to build the surfacing bloc.
-                                    # Normally the next bloc to process overlaps the current bloc
-                                    if next_L1 is not None: 
-                                        first_line_bloc = next_L1 + 1
-                                    #<JLC6>
-                                    else:
-                                        first_line_bloc = i
-                                    #</JLC6>
-                                    
-                                    # break the 'for loop' to come back to the 'while loop':
-                                    break      
-                                
-                if Z_increase is not None:     
-                    if (Z_increase == True and Z == Zmax) or (Z_increase == False and Z == Zmin): 
-                        if bloc['strategy'].strip() in ('(strategy: ramp)', '(strategy: contour2d)'):
-                            # add the rest of the lines of the bloc:
-                            # 1/ remove the trailing '\n':
-                            if splitted_gcode[-2:] == '\n\n': splitted_gcode = splitted_gcode[:-1]
-                            # 2/ add the lines:
-                            splitted_gcode += ''.join(self.gcode_sub_lines[i+1:end_line_bloc])
-                            if splitted_gcode[-2:] != '\n\n': splitted_gcode += '\n'
-                            
-                            break  #<JLC6> break was outside the if bock
-                        else:
-                            pass
-                #<JLC6>
-                if i >= end_line_bloc - 1:
-                    break
-                #</JLC6>
-            # Go on with the next bloc:
-            start_line_number = end_line_bloc
-            
-        splitted_gcode += ''.join(self.gcode_sub_lines[end_line_bloc:])
-        return splitted_gcode
+        return surfacing.split_blocs(self.gcode_sub_file, blocs_to_split,
+                                     zRangeMax3Dsurfacing_mm, zOverlap3Dsurfacing_mm)
     #</JLC4>
     
     def split_additive_layers(self, gcode_add, ORCA):
         """ JLC: Takes additive gcode and splits in by layer.
-            the 'tmp_list' list consists in :
-            - a header,
-            - pairs of (layer_separator_tag str, gcode str of the layer)
+            The AdditiveLayerTable built in a single pass over the gcode gives:
+            - the header span,
+            - the span, height and tools of each layer starting with the layer separator tag.
             For fusion360 tah layer separator tag is '; layer', 
             for Orca it is ';LAYER_CHANGE'.
         """
         #<JLC8>
-        tag = '(; layer)'                         # for Fusion360 additive GCode
-        if ORCA : tag = '(;LAYER_CHANGE)'     # for OrcaSlicer additive GCode
-        tmp_list = re.split(tag, gcode_add)
+        table = AdditiveLayerTable.from_gcode(gcode_add, ORCA, self.workers)
         #</JLC8>
+        starts = table.starts.tolist()
+        ends = starts[1:] + [len(gcode_add)]
         
+        names = ["initialise"]    # slicer settings & initialise
+        for i in range(1, len(table)):
+
+            start, end = starts[i], ends[i]
+            if ORCA:
+                # name made of the 3 first ';' separated parts of the layer:
+                cut = start - 1
+                for _ in range(3):
+                    cut = gcode_add.find(';', cut + 1, end)
+                    if cut < 0:
+                        cut = end
+                        break
+                name = gcode_add[start:cut].replace(';', '').replace('\n',' ').strip()
+            else:
+                # Fusion360
+                comma = gcode_add.find(',', start, end)
+                name = gcode_add[start:comma if comma >= 0 else end][2:]
+
+            if i == len(table) - 1:
+                #<JLC10>: was  gcode_add_layers.append(AdditiveGcodeLayer(layer, 'end', inf))
+                name = 'end'
+            names.append(name)
+
+        return self.make_additive_layers(gcode_add, table, names, ORCA)
+
+    def make_additive_layers(self, gcode_add, table, names, ORCA):
+        """ Creates the AdditiveGcodeLayer of each row of the AdditiveLayerTable `table` of `gcode_add` """
+        self.gcode_add_table = table
+        starts, stops = table.starts.tolist(), table.stops.tolist()
+
         gcode_add_layers = []
         initialise_layer = AdditiveGcodeLayer(
-            tmp_list.pop(0),
-            name="initialise",
+            gcode_add[starts[0]:stops[0]],
+            name=names[0],
             layer_height=0,
+            table=table,
+            index=0,
         )    # slicer settings & initialise
         self.set_last_additive_tool(initialise_layer)
         # initialise_layer.comment_all_gcode()
         gcode_add_layers.append(initialise_layer)
 
-        for i in range(ceil(len(tmp_list)/2)):
-
-            layer = tmp_list[2*i] + tmp_list[2*i+1]
-            if ORCA:
-                name = ''.join(layer.split(';')[:3]).replace('\n',' ').strip()
-            else:
-                # Fusion360
-                name = layer.split(',')[0][2:]
-
-            if 2*i + 1 == len(tmp_list) - 1:
-                #<JLC10>: was  gcode_add_layers.append(AdditiveGcodeLayer(layer, 'end', inf))
-                gcode_add_layers.append(AdditiveGcodeLayer(layer, 'end', ORCA=ORCA))
-                continue
-
-            gcode_add_layers.append(AdditiveGcodeLayer(layer, name, ORCA=ORCA))
+        for i in range(1, len(table)):
+            layer = gcode_add[starts[i]:stops[i]]
+            gcode_add_layers.append(AdditiveGcodeLayer(layer, names[i], ORCA=ORCA, table=table, index=i))
 
         return gcode_add_layers
 
     def assign_cam_line_type(self, unlabelled_lines):
-        """ extract type information from string, returns a list of CamGcodeLine's """
-        lines = []
-        line_type = None
-        for line in unlabelled_lines:
-            if line.startswith('(type: '):
-                line_type = line[7:].strip(')')
-            elif line.startswith('(') or line.startswith('M'):
-                continue
-            else:
-                lines.append(CamGcodeLine(line, self.offset, line_type))
-
-        return lines
+        """ extract type information from string, returns a CamGcodeBlock of the offset lines """
+        return CamGcodeBlock.from_records(gcode_lexer.iter_records(unlabelled_lines), self.offset)
 
     def group_cam_lines(self, lines):
         """
-        Group consecutive lines of the same type into CamGcodeSegment segments
+        Group consecutive lines of the same type of the CamGcodeBlock `lines` into CamGcodeSegment segments
         Returns a list of segments
         """
-        segments = []
-        segment_lines = [lines[0]]
-        for i, line in enumerate(lines[1:]):
-            if line.type != lines[i].type:
-                segment_index = len(segments)
-                segments.append(CamGcodeSegment(segment_index, segment_lines, lines[i].type))
-                segment_lines = [line]
-            else:
-                segment_lines.append(line)
+        starts, stops = lines.segment_bounds()
+        min_heights = np.minimum.reduceat(lines.z, starts).tolist()
+        max_heights = np.maximum.reduceat(lines.z, starts).tolist()
 
-        segment_index = len(segments)
-        segments.append(CamGcodeSegment(segment_index, segment_lines, lines[-1].type))
+        codes = lines.types[starts].tolist()
+
+        segments = []
+        for segment_index, (start, stop) in enumerate(zip(starts.tolist(), stops.tolist())):
+            z_range = (min_heights[segment_index], max_heights[segment_index])
+            segments.append(CamGcodeSegment(segment_index, lines, start, stop, codes[segment_index], z_range))
 
         return segments
 
@@ -549,17 +434,17 @@ class Parser:
         start_index = cutting_group[0].index
         pre_index = start_index - 1 if start_index - 1 >= 0 else start_index
         # <JLC-4> Add 'transition'
-        if segments[pre_index].type in ('lead in', 'plunge', 'transition'):
+        if segments[pre_index].code in LEAD_IN_TYPES:
             start_index = pre_index
 
         # warn user if a bad linking setting are detected
-        if segments[pre_index].type in ('helix_ramp', 'profile_ramp', 'ramp'):
-            print('CAM Linking may be set incorrectly')
+        if segments[pre_index].code in RAMP_TYPES:
+            self.announce('CAM Linking may be set incorrectly')
 
         end_index = cutting_group[-1].index
         post_index = end_index + 1 if end_index + 1 <= len(segments) - 1 else end_index
         # <JLC-4> Add 'transition'
-        if segments[post_index].type in ('lead out', 'transition'):
+        if segments[post_index].code in LEAD_OUT_TYPES:
             end_index = post_index
 
         return segments[start_index:end_index+1]
@@ -572,7 +457,7 @@ class Parser:
 
         Returns a list of layers, each to be merged as a whole unit.
         """
-        cutting_segments = [segment for segment in segments if segment.type in ('cutting', 'ramp') ]
+        cutting_segments = [segment for segment in segments if segment.code in CUTTING_TYPES]
         cam_layers = []
         cutting_group = [cutting_segments[0]]
         cutting_height = cutting_segments[0].height
@@ -603,65 +488,110 @@ class Parser:
         return cam_layers
 
     def split_cam_operations(self, gcode_sub):
-        """ Takes fusion360 CAM gcode and splits the operations by execution height """
-        tmp_operation_list = gcode_sub.split('\n\n')
+        """
+        Takes fusion360 CAM gcode, a str or an iterable of str pieces, and splits the
+        operations by execution height. The operations are parsed one after the other
+        as they are found in the pieces.
+        With several workers, the operations are parsed in a process pool by chunks
+        of about the same size, and reassembled in their order.
+        """
+        if isinstance(gcode_sub, str):
+            gcode_sub = (gcode_sub,)
+        # the operations are separated by a blank line, up to the first empty one:
+        tmp_operation_list = takewhile(bool, utils.iter_blocks(gcode_sub, '\n\n'))
+
+        if self.workers > 1:
+            tmp_operation_list = list(tmp_operation_list)
+            if len(tmp_operation_list) > 1:
+                return self.split_cam_operations_parallel(tmp_operation_list)
 
         operations = []
 
-        for i, operation in enumerate(tmp_operation_list):
-            if operation == '': break
-            unlabelled_lines = operation.split('\n')
-            name = unlabelled_lines.pop(0)
-            strategy = unlabelled_lines.pop(0)[11:].strip(')')
-            tool = unlabelled_lines.pop(0)
-            #<JLC>
-            start_tool = unlabelled_lines.pop(0) if unlabelled_lines[0][0] == 'M' else None
-            #</JLC>
-            unlabelled_lines = [line for line in unlabelled_lines if line != '']
+        for operation in tmp_operation_list:
+            operations.append(self.parse_cam_operation(operation))
 
-            # 'lines' is the list of CamGcodeLine objects:
-            lines = self.assign_cam_line_type(unlabelled_lines)
-            
-            # 'segments' is the list of CamGcodeSegment objects (each grouping consecutive 
-            # lines of 'lines' of the same type):
-            segments = self.group_cam_lines(lines)
-            
-            # 'operation_layers' is the list of CamGcodeLayer objects (each grouping the 
-            # cutting segments of equal cutting height or the non-planer cutting segments
-            # that make the current operation):
-            operation_layers = self.group_cam_segments(segments, name, strategy, tool, start_tool)
-            
-            operations.append(operation_layers)
+        return operations
 
+    def split_cam_operations_parallel(self, operation_list):
+        """ Parses the CAM operations of `operation_list` in a pool of self.workers processes """
+        from concurrent.futures import ProcessPoolExecutor     # only loaded when workers are used
+        from . import parse_cache
+
+        chunks = utils.split_by_size(operation_list, 4 * self.workers)
+        jobs = [(self.config, self.offset, self.quiet, chunk) for chunk in chunks]
+
+        operations = []
+        with ProcessPoolExecutor(min(self.workers, len(chunks))) as executor:
+            for packed_operations in executor.map(parse_cam_chunk, jobs):
+                operations += self.make_cam_operations(parse_cache.unpack_cam_operations(packed_operations))
         return operations
 
-    def assign_cam_layer_height(self, cam_layer, later_cam_layers, layer_overlap):
-        """ Calculate the additive layer height that should be printed to before the CAM layer happens """
-        later_planar_layers = [layer for layer in later_cam_layers if layer.planar]
+    def parse_cam_operation(self, operation):
+        """ Parses the gcode of a single CAM operation into its list of CamGcodeLayer """
+        unlabelled_lines = operation.split('\n')
+        name = unlabelled_lines.pop(0)
+        strategy = unlabelled_lines.pop(0)[11:].strip(')')
+        tool = unlabelled_lines.pop(0)
+        #<JLC>
+        start_tool = unlabelled_lines.pop(0) if unlabelled_lines[0][0] == 'M' else None
+        #</JLC>
+        unlabelled_lines = [line for line in unlabelled_lines if line != '']
+
+        # 'lines' is the CamGcodeBlock storing all the lines:
+        lines = self.assign_cam_line_type(unlabelled_lines)
+        
+        # 'segments' is the list of CamGcodeSegment objects (each a range of consecutive 
+        # lines of 'lines' of the same type):
+        segments = self.group_cam_lines(lines)
+        
+        # 'operation_layers' is the list of CamGcodeLayer objects (each grouping the 
+        # cutting segments of equal cutting height or the non-planer cutting segments
+        # that make the current operation):
+        operation_layers = self.group_cam_segments(segments, name, strategy, tool, start_tool)
+        
+        return operation_layers
+
+    def cam_cache_fields(self):
+        """ The config values the parsed CAM operations depend on """
+        cam_settings = self.config['CamSettings']
+        return {'offset': self.offset,
+                'zRangeMax_3Dsurfacing_mm': cam_settings['zRangeMax_3Dsurfacing_mm'],
+                'zOverlap_3Dsurfacing_mm': cam_settings['zOverlap_3Dsurfacing_mm']}
+
+    def make_cam_operations(self, cached_operations):
+        """ Creates the CAM operations (lists of CamGcodeLayer) from the blocks & layer ranges of the parse cache """
+        operations = []
+        for block, layer_segments, name, strategy, tool, start_tool in cached_operations:
+            segments = self.group_cam_lines(block)
+            operations.append([CamGcodeLayer(segments[first:stop], name, strategy, tool, start_tool)
+                               for first, stop in layer_segments])
+        return operations
 
-        if (not cam_layer.planar) or (len(later_planar_layers) == 0):
+    def assign_cam_layer_height(self, cam_layer, later_planar_height, layer_overlap):
+        """
+        Calculate the additive layer height that should be printed to before the CAM layer happens.
+        `later_planar_height` is the minimum cutting height of the later planar CAM layers, inf if none.
+        """
+        if (not cam_layer.planar) or (later_planar_height == inf):
             cutting_height = cam_layer.cutting_height
         else:
             #<JLC>
             # was:  cutting_height = min([layer.cutting_height for layer in later_planar_layers])
-            min_cutting_height_later_planar_layers = min([layer.cutting_height for layer in later_planar_layers])
+            min_cutting_height_later_planar_layers = later_planar_height
             if min_cutting_height_later_planar_layers - cam_layer.cutting_height > 1:
                 cutting_height = cam_layer.cutting_height
             else:
                 cutting_height = min_cutting_height_later_planar_layers
             #</JLC>
 
-        later_additive = [layer for layer in self.gcode_add_layers[:-1]
-                          if layer.layer_height > cutting_height]
+        later_additive_height = None
+        if layer_overlap != 0:
+            later_additive_height = self.gcode_add_table.nth_height_above(cutting_height, layer_overlap)
 
-        if (layer_overlap == 0) or (len(later_additive) == 0):
+        if later_additive_height is None:
             cam_layer_height = cutting_height
-
-        elif len(later_additive) >= layer_overlap:
-            cam_layer_height = later_additive[layer_overlap - 1].layer_height
-
         else:
-            cam_layer_height = later_additive[-1].layer_height
+            cam_layer_height = later_additive_height
 
         if cam_layer_height == inf:
             raise ValueError("CAM op height can't be 'inf'")
@@ -681,12 +611,18 @@ class Parser:
 
         layer_overlap = self.config['CamSettings']['layer_overlap']
 
+        # the later layers of a CAM layer are the ones with a greater cutting height: they start at
+        # the bisect of its cutting height, and the minimum cutting height of the later planar layers
+        # is a suffix minimum (inf past the last planar layer)
+        cutting_heights = [layer.cutting_height for layer in ordered_cam_layers]
+        planar_heights = [layer.cutting_height if layer.planar else inf for layer in ordered_cam_layers]
+        later_planar_heights = list(accumulate(reversed(planar_heights), min, initial=inf))[::-1]
+
         # TODO assign layer height per layer in each operation independently.
         # There is an issue if you have sparse CAM currently
         for i, cam_layer in enumerate(ordered_cam_layers):
-            later_cam_layers = [
-                layer for layer in ordered_cam_layers if layer.cutting_height > cam_layer.cutting_height]
-            self.assign_cam_layer_height(cam_layer, later_cam_layers, layer_overlap)
+            later = bisect_right(cutting_heights, cam_layer.cutting_height)
+            self.assign_cam_layer_height(cam_layer, later_planar_heights[later], layer_overlap)
 
         return ordered_cam_layers
 
@@ -695,14 +631,11 @@ class Parser:
         Adds redamentary retracts between cam layers.
         Required since some of the retracts are removed by `group_cam_segments`
         """
-        first_line = cam_layer.segments[0].lines[0]
-        last_line = cam_layer.segments[-1].lines[-1]
-
-        offset = (0, 0, clearance_height)
-        pre_retract = utils.offset_gcode(first_line.gcode, offset)
-        post_retract = utils.offset_gcode(last_line.gcode, offset)
+        block = cam_layer.segments[0].block
+        pre_retract = block.render_line(cam_layer.segments[0].start, clearance_height)
+        post_retract = block.render_line(cam_layer.segments[-1].stop - 1, clearance_height)
 
-        cam_layer.gcode = '; retract\n' + pre_retract + '\n' + cam_layer.gcode + '; retract\n' + post_retract + '\n'
+        cam_layer.retracts = (pre_retract, post_retract)
 
     def merge_gcode_layers(self, gcode_add, cam_layers):
         """ Takes the individual CAM instructions and merges them into the additive file from Simplify3D """
@@ -720,53 +653,133 @@ class Parser:
 
         return merged_gcode
 
-    def create_gcode_script(self, gcode):
-        """ Converts list of layers into a single string with appropriate tool changes """
-        self.merged_gcode_script = '; N-Fab gcode created by https://github.com/cjlux/ASMBL\n'
+    def iter_gcode_script(self, gcode=None):
+        """
+        Generates the output gcode chunk by chunk: the header, then the tool changes and the
+        gcode of each layer of `gcode` (the merged list of layers by default) in turn
+        """
+        #<JLC>
+        if self.flag_append_AddSubGcode:
+            yield '; N-Fab gcode created by NAMMA\n'
+            yield self.appendSub2AddGcode()
+            return
+        #</JLC>
+
+        if gcode is None:
+            gcode = self.merged_gcode
+        self.last_additive_tool = None
+        yield '; N-Fab gcode created by https://github.com/cjlux/ASMBL\n'
         prev_layer = gcode[0]
         for layer in gcode:
             self.set_last_additive_tool(prev_layer)
-            self.tool_change(layer, prev_layer)
+            yield self.tool_change(layer, prev_layer)
             prev_layer = layer
-            self.merged_gcode_script += layer.gcode
+            yield layer.gcode
+
+    def create_gcode_script(self, gcode=None):
+        """ Converts list of layers into a single string with appropriate tool changes (opt-in, see keep_script) """
+        self.merged_gcode_script = ''.join(self.iter_gcode_script(gcode))
 
     def set_last_additive_tool(self, layer):
-        """ Finds the last used tool in a layer and saves it in memory """
+        """ Saves in memory the last used tool of a layer, read from the tool timeline (AdditiveLayerTable) """
         if isinstance(layer, AdditiveGcodeLayer):
-            process_list = layer.gcode.split('\nT')
-            if len(process_list) > 1:
-                self.last_additive_tool = 'T' + process_list[-1].split('\n')[0]
+            tool = layer.last_tool()
+            if tool is not None:
+                self.last_additive_tool = tool
 
     def tool_change(self, layer, prev_layer):
-        """ Adds any required tool changes between 2 layers """
+        """ Returns the tool changes required between 2 layers ('' if none) """
+        tool_change = ''
         if type(layer) == AdditiveGcodeLayer:
             if layer.name == 'initialise' or prev_layer.name == 'initialise':
-                return  # no need to add a tool change
-            first_gcode = layer.gcode.split('\n')[1]
-            if first_gcode[0] != 'T':
-                self.merged_gcode_script += self.last_additive_tool + '\n'
+                return tool_change  # no need to add a tool change
+            if not layer.opens_with_tool():
+                tool_change += self.last_additive_tool + '\n'
         elif type(layer) == CamGcodeLayer:
-            self.merged_gcode_script += layer.tool + '\n'
+            tool_change += layer.tool + '\n'
             #<JLC>
-            if layer.start_tool != None: self.merged_gcode_script += layer.start_tool + '\n'
+            if layer.start_tool != None: tool_change += layer.start_tool + '\n'
             #</JLC>
+        return tool_change
 
-    def create_output_file(self, gcode, folder_path="output/", relative_path=True):
-        """ Saves the file to the output folder """
-        file_path = folder_path + self.config['OutputSettings']['filename'] + ".gcode"
+    def write_gcode(self, sink, gcode=None):
+        """
+        Streams the output gcode to the file-like `sink`, the finished layers are flushed as they go.
+        `gcode` is the whole output as a string (e.g. merged_gcode_script) or an iterable
+        of chunks, by default the chunks are generated from the merged layers.
+        """
+        if gcode is None:
+            gcode = self.iter_gcode_script()
+        return utils.write_chunks(gcode, sink)
+
+    def create_output_file(self, gcode=None, folder_path="output/", relative_path=True, open_output=True):
+        """
+        Saves the file to the output folder, see write_gcode for `gcode`: a text .gcode file,
+        or a binary .bgcode file if the 'format' of the OutputSettings is 'bgcode'.
+        The .gcode file is then opened in an editor, unless `open_output` is False.
+        Returns the path of the file.
+        """
+        output_format = self.config['OutputSettings'].get('format', 'gcode')
+        if output_format not in ('gcode', 'bgcode'):
+            raise ValueError(f"Unknown output format '{output_format}', 'gcode' or 'bgcode'")
+        file_path = folder_path + self.config['OutputSettings']['filename'] + "." + output_format
 
         file_path = os.path.expanduser(file_path)
         os.makedirs(os.path.dirname(file_path), exist_ok=True)
 
-        with open(file_path, "w") as f:
-            f.write(gcode)
-
-        f.close()
-
-        try:
-            utils.open_file(file_path)
-        except FileNotFoundError:
-            pass
+        with self.stage('write') as stage:
+            if output_format == 'bgcode':
+                with open(file_path, "wb") as f, self.bgcode_writer(f) as writer:
+                    self.write_gcode(writer, gcode)
+            else:
+                with open(file_path, "w") as f:
+                    self.write_gcode(f, gcode)
+            if stage:
+                from pathlib import Path
+                stage.add_output(Path(file_path))
+
+        if open_output and output_format == 'gcode':
+            try:
+                utils.open_file(file_path)
+            except FileNotFoundError:
+                pass
+        return file_path
+
+    def bgcode_writer(self, bgcode_file):
+        """
+        BgcodeWriter of the output in the binary file `bgcode_file`, with the 'bgcode' settings
+        of the OutputSettings, the thumbnails of the additive gcode and of the settings, and
+        the settings of the merge as metadata
+        """
+        from . import bgcode     # only loaded for a binary output
+        settings = dict(bgcode.DEFAULT_SETTINGS, **self.config['OutputSettings'].get('bgcode', {}))
+
+        thumbnails = []
+        if getattr(self, 'gcode_add_layers', None):
+            thumbnails += bgcode.find_thumbnails(self.gcode_add_layers[0].gcode)
+        for path in settings['thumbnails']:
+            with open(os.path.expanduser(path), 'rb') as image_file:
+                thumbnails.append(image_file.read())
+
+        input_files = self.config['InputFiles']
+        metadata = {
+            bgcode.BlockType.PRINTER_METADATA: self.config['Printer'],
+            bgcode.BlockType.PRINT_METADATA: {
+                'additive_gcode': os.path.basename(input_files['additive_gcode']),
+                'subtractive_gcode': os.path.basename(input_files['subtractive_gcode']),
+            },
+            bgcode.BlockType.SLICER_METADATA: {**self.config['PrintSettings'], **self.config['CamSettings']},
+        }
+        return bgcode.BgcodeWriter(bgcode_file, settings, metadata, thumbnails, workers=self.workers)
+
+
+def parse_cam_chunk(job):
+    """ Worker of Parser.split_cam_operations_parallel: parses a chunk of CAM operations, returns them packed """
+    from . import parse_cache
+    config, offset, quiet, operation_list = job
+    parser = Parser(config, run=False, quiet=quiet)
+    parser.offset = offset
+    return parse_cache.pack_cam_operations([parser.parse_cam_operation(operation) for operation in operation_list])
 
 
 if __name__ == "__main__":
@@ -777,4 +790,4 @@ if __name__ == "__main__":
     gcode_sub = gcode_sub_file.read()
 
     parser = Parser(gcode_add, gcode_sub)
-    parser.create_output_file(parser.merged_gcode_script)
+    parser.create_output_file()
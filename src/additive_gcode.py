@@ -1,4 +1,260 @@
 from math import inf
+from bisect import bisect_right
+from collections import namedtuple
+import re
+import sys
+import numpy as np
+from . import gcode_lexer
+
+PARK_TAG = '; move to park position'
+
+# Z word in the code part of a line (before any ';' or '(' comment):
+Z_WORD = re.compile(r'^[^;(\n]*?(?:^|[ \t])Z([^\s;(]*)', re.M)
+# ORCA ';Z:<height>' comment:
+Z_COMMENT = re.compile(r'^[^;(\n]*[;(][ \t]*Z[ \t]*:[^\n]*', re.M)
+# tool selection at the beginning of a line:
+TOOL_LINE = re.compile(r'\nT[^\n]*')
+
+
+class AdditiveLayerTable:
+    """
+    Per-layer table of a complete additive gcode, built in one pass over the buffer.
+    Row 0 is the header ('initialise' layer), the last row is the 'end' layer.
+
+    - starts, stops:          span of each layer in the buffer, the park gcode excluded
+    - min_z, max_z:           extreme Z of the moves of the layer, nan if there is none
+    - heights:                layer height as defined by AdditiveGcodeLayer.get_layer_height,
+                              nan if there is none
+    - first_tools, last_tools: codes into `tools` of the first and last tool selected
+                              in the layer, -1 if there is none
+    - opens_with_tool:        True when the first command of the layer (the line after
+                              its tag) selects a tool
+
+    The tool columns are the tool timeline of the print: the tool changes of the output
+    are inserted from them, without scanning the text of the layers again.
+    """
+
+    def __init__(self, starts, stops, min_z, max_z, heights, first_tools, last_tools, opens_with_tool, tools):
+        self.starts = starts
+        self.stops = stops
+        self.min_z = min_z
+        self.max_z = max_z
+        self.heights = heights
+        self.first_tools = first_tools
+        self.last_tools = last_tools
+        self.opens_with_tool = opens_with_tool
+        self.tools = tools
+        self._printed_heights = None    # cache of nth_height_above
+        self._sorted = None
+
+    def __len__(self):
+        return len(self.starts)
+
+    def height(self, index):
+        """ Layer height of a row as a float, or None if the layer has no height """
+        height = self.heights[index]
+        return None if np.isnan(height) else float(height)
+
+    def nth_height_above(self, height, n):
+        """
+        Height of the n-th layer (n >= 1) above `height` in the order of the gcode, the 'end'
+        layer excluded: the highest one if there are less than n, None if there is none
+        """
+        if self._printed_heights is None:
+            heights = self.heights[:-1]
+            heights = heights[~np.isnan(heights)]
+            # the layers are found with a bisect when their heights never decrease (the usual case)
+            self._printed_heights = heights
+            self._sorted = bool(np.all(heights[1:] >= heights[:-1]))
+
+        heights = self._printed_heights
+        if self._sorted:
+            first = bisect_right(heights, height)
+            if first == len(heights):
+                return None
+            return float(heights[min(first + n - 1, len(heights) - 1)])
+
+        later_heights = heights[heights > height]
+        if len(later_heights) == 0:
+            return None
+        return float(later_heights[min(n, len(later_heights)) - 1])
+
+    def tool(self, index, last=True):
+        """ The last (or first) tool selected in a row as a gcode line ('T1'), or None """
+        code = self.last_tools[index] if last else self.first_tools[index]
+        return None if code < 0 else self.tools[code]
+
+    @classmethod
+    def from_gcode(cls, gcode, ORCA:bool=False, workers=1):
+        """
+        Splits `gcode` on the layer tags ('; layer' or ';LAYER_CHANGE' for ORCA) and fills the table.
+        With several `workers`, the lines are scanned by chunks of layers in a process pool.
+        """
+        tag = ';LAYER_CHANGE' if ORCA else '; layer'
+        length = len(gcode)
+
+        layer_starts = [match.start() for match in re.finditer(re.escape(tag), gcode)]
+        starts = np.array([0] + layer_starts, dtype=np.int64)
+        ends = np.append(starts[1:], length)
+
+        # cut each layer at the first park gcode it contains:
+        parks = np.array([match.start() for match in re.finditer(re.escape(PARK_TAG), gcode)], dtype=np.int64)
+        stops = ends.copy()
+        if len(parks):
+            first_park = np.searchsorted(parks, starts)
+            has_park = first_park < len(parks)
+            park_positions = parks[np.minimum(first_park, len(parks) - 1)]
+            cut = has_park & (park_positions < ends)
+            stops[cut] = park_positions[cut]
+
+        rows = len(starts)
+
+        if workers > 1 and rows > 1:
+            scans = scan_chunks(gcode, starts, workers)
+        else:
+            scans = [scan_lines(gcode, 0, length)]
+        positions = np.concatenate([scan.z_positions for scan in scans])
+        values = np.concatenate([scan.z_values for scan in scans])
+
+        # Z of the moves:
+        z_rows, valid = cls._rows_of(positions, starts, stops)
+        z_values = values[valid]
+        min_z = np.full(rows, inf)
+        max_z = np.full(rows, -inf)
+        np.minimum.at(min_z, z_rows, z_values)
+        np.maximum.at(max_z, z_rows, z_values)
+        no_z = np.isinf(min_z)
+        min_z[no_z] = np.nan
+        max_z[no_z] = np.nan
+
+        # tools:
+        tool_codes = {}
+        tool_positions = np.concatenate([scan.tool_positions for scan in scans])
+        tool_values = [tool_codes.setdefault(name, len(tool_codes)) for scan in scans for name in scan.tool_names]
+        tool_values = np.array(tool_values, dtype=np.int16)
+        # the whole '\nT' must be in the layer:
+        first = np.searchsorted(tool_positions, starts, 'left')
+        last = np.searchsorted(tool_positions, stops - 1, 'left') - 1
+        has_tool = first <= last
+        first_tools = np.full(rows, -1, dtype=np.int16)
+        last_tools = np.full(rows, -1, dtype=np.int16)
+        first_tools[has_tool] = tool_values[first[has_tool]]
+        last_tools[has_tool] = tool_values[last[has_tool]]
+        # the layer opens with its first tool line when there is no other line before it:
+        opens_with_tool = np.zeros(rows, dtype=bool)
+        for row in np.flatnonzero(has_tool).tolist():
+            opens_with_tool[row] = gcode.find('\n', int(starts[row]), int(tool_positions[first[row]])) < 0
+
+        # layer heights:
+        if ORCA:
+            heights = np.full(rows, np.nan)
+            z_rows, valid = cls._rows_of(np.concatenate([scan.z_comment_positions for scan in scans]), starts, stops)
+            matches = [match for scan in scans for match in scan.z_comments]
+            matches = [match for match, inside in zip(matches, valid) if inside]
+            # first ';Z:' comment of each layer:
+            z_rows, first_matches = np.unique(z_rows, return_index=True)
+            heights[z_rows] = [float(gcode_lexer.parse_line(matches[i]).tag[1]) for i in first_matches]
+        else:
+            heights = min_z.copy()
+            # Simplify3D / Fusion360 end of file code:
+            end_tags = [match.start() for match in re.finditer(re.escape('; layer end'), gcode)]
+            heights[np.isin(starts, end_tags)] = inf
+        heights[0] = 0      # header
+
+        return cls(starts, stops, min_z, max_z, heights, first_tools, last_tools, opens_with_tool, list(tool_codes))
+
+    @staticmethod
+    def _rows_of(positions, starts, stops):
+        """ Returns the row of each position and the mask of the positions inside their row span """
+        rows = np.searchsorted(starts, positions, 'right') - 1
+        valid = positions < stops[rows]
+        return rows[valid], valid
+
+
+LineScan = namedtuple('LineScan', ['z_positions', 'z_values', 'tool_positions', 'tool_names',
+                                   'z_comment_positions', 'z_comments'])
+LineScan.__doc__ = """
+Per-line data of a range of an additive gcode, used to fill an AdditiveLayerTable.
+The positions are offsets in the whole gcode.
+
+- z_positions, z_values: position and value of the Z words of the moves
+- tool_positions, tool_names: position of the '\\nT' of the tool lines and their name ('T1')
+- z_comment_positions, z_comments: position and text of the ORCA ';Z:' lines
+"""
+
+# gcode shared with the forked workers of scan_chunks:
+_gcode = None
+
+
+def scan_lines(gcode, start, stop):
+    """ Scans the lines of gcode[start:stop], `start` must be at the beginning of a line """
+    positions, values = [], []
+    for match in Z_WORD.finditer(gcode, start, stop):
+        try:
+            values.append(float(match.group(1)))
+        except ValueError:
+            continue
+        positions.append(match.start(1))
+
+    # the '\n' of a tool line at `start` is the last character of the previous range:
+    tool_matches = list(TOOL_LINE.finditer(gcode, max(start - 1, 0), stop))
+    z_comments = list(Z_COMMENT.finditer(gcode, start, stop))
+
+    return LineScan(
+        np.array(positions, dtype=np.int64),
+        np.array(values, dtype=float),
+        np.array([match.start() for match in tool_matches], dtype=np.int64),
+        [match.group()[1:] for match in tool_matches],
+        np.array([match.start() for match in z_comments], dtype=np.int64),
+        [match.group() for match in z_comments],
+    )
+
+
+def scan_chunk(job):
+    """ Worker of scan_chunks, the gcode is either in the job or shared by fork """
+    gcode, offset, start, stop = job
+    if gcode is None:
+        return scan_lines(_gcode, start, stop)
+    scan = scan_lines(gcode, start - offset, stop - offset)
+    return scan._replace(z_positions=scan.z_positions + offset,
+                         tool_positions=scan.tool_positions + offset,
+                         z_comment_positions=scan.z_comment_positions + offset)
+
+
+def scan_chunks(gcode, layer_starts, workers):
+    """
+    Scans `gcode` in a pool of `workers` processes, by chunks of consecutive layers of about
+    the same size. Returns the LineScan of each chunk, in the order of the gcode.
+    """
+    global _gcode
+    length = len(gcode)
+    n_chunks = min(4 * workers, len(layer_starts))
+    chunk_layers = np.searchsorted(layer_starts, length * np.arange(1, n_chunks) / n_chunks)
+    # each chunk starts at the beginning of the line of its first layer tag:
+    bounds = sorted({gcode.rfind('\n', 0, int(layer_starts[i])) + 1
+                     for i in chunk_layers.tolist() if i < len(layer_starts)} - {0})
+    bounds = [0] + bounds + [length]
+
+    # the pool is only loaded when workers are used, it is slow to import:
+    import multiprocessing
+    from concurrent.futures import ProcessPoolExecutor
+
+    # fork only on Linux: unsafe on macOS (numpy, Accelerate), missing on Windows
+    if sys.platform == 'linux':
+        _gcode = gcode
+        context = multiprocessing.get_context('fork')
+        jobs = [(None, 0, start, stop) for start, stop in zip(bounds[:-1], bounds[1:])]
+    else:
+        # the chunk and its previous character (for the tool lines) are sent to the workers:
+        context = None
+        jobs = [(gcode[max(start - 1, 0):stop], max(start - 1, 0), start, stop)
+                for start, stop in zip(bounds[:-1], bounds[1:])]
+
+    try:
+        with ProcessPoolExecutor(min(workers, len(jobs)), mp_context=context) as executor:
+            return list(executor.map(scan_chunk, jobs))
+    finally:
+        _gcode = None
 
 
 class AdditiveGcodeLayer:
@@ -7,10 +263,18 @@ class AdditiveGcodeLayer:
     Fusion360 or ORCA.
     """
 
-    def __init__(self, gcode, name=None, layer_height=None, ORCA:bool=False):
-        ''' The ORCA bool is added to be able to process differently the ORCA gcode.'''
+    def __init__(self, gcode, name=None, layer_height=None, ORCA:bool=False, table=None, index=None):
+        ''' The ORCA bool is added to be able to process differently the ORCA gcode.
+            When the layer is row `index` of an AdditiveLayerTable `table`, its height is 
+            read from the table instead of scanning the gcode.
+        '''
         self.gcode = gcode
         self.name = name
+        self.table = table
+        self.index = index
+
+        if layer_height is None and table is not None:
+            layer_height = table.height(index)
         self.layer_height = layer_height
 
         self.remove_park_gcode()
@@ -24,6 +288,21 @@ class AdditiveGcodeLayer:
     def get_name(self, gcode):
         return gcode.split(',')[0][2:]
 
+    def last_tool(self):
+        """ The last tool selected in the layer as a gcode line ('T1'), None if there is none """
+        if self.table is not None:
+            return self.table.tool(self.index)
+        process_list = self.gcode.split('\nT')
+        if len(process_list) > 1:
+            return 'T' + process_list[-1].split('\n')[0]
+        return None
+
+    def opens_with_tool(self):
+        """ True when the first command of the layer (the line after its tag) selects a tool """
+        if self.table is not None:
+            return bool(self.table.opens_with_tool[self.index])
+        return self.gcode.split('\n')[1][0] == 'T'
+
     def get_layer_height(self, gcode, ORCA:bool):
         ''' To find out the layer height in mm in the gcode fragment of the Layer.
             The height of the last layer ORCA gcode is processed differently 
@@ -34,10 +313,9 @@ class AdditiveGcodeLayer:
 
         if ORCA:
             # JLC: this is the new code for ORCA
-            for line in lines:
-                line_segments = line.split(';Z:')
-                if len(line_segments) > 1:
-                    height = float(line_segments[1])
+            for record in gcode_lexer.iter_records(lines):
+                if record.tag is not None and record.tag[0] == 'Z':
+                    height = float(record.tag[1])
                     break
                 
         else:
@@ -47,15 +325,9 @@ class AdditiveGcodeLayer:
                 height = inf
             else:    
                 line_heights = []
-                for line in lines:
-                    if line == '':
-                        continue
-                    if line[0] == ';':
-                        continue
-                    line_segments = line.split('Z')
-                    if len(line_segments) > 1:
-                        line_height = float(line_segments[1].split(' ')[0])
-                        line_heights.append(line_height)
+                for record in gcode_lexer.iter_records(lines):
+                    if 'Z' in record.params:
+                        line_heights.append(record.params['Z'])
 
                 height = min(line_heights)
 
@@ -74,4 +346,4 @@ class AdditiveGcodeLayer:
     def remove_park_gcode(self):
         # Fusion adds some dirty end gcode
         # Kill it with fire until they let us control the end gcode with the post processor
-        self.gcode = self.gcode.split('; move to park position')[0]
+        self.gcode = self.gcode.split(PARK_TAG)[0]
@@ -0,0 +1,133 @@
+"""
+Batch mode: many merges, each of its own config, in a pool of worker processes.
+
+The jobs are listed in a manifest, a JSON file holding a list (or {"jobs": [...]}) of
+config files, relative to the manifest, or of inline configs. A folder can also be given,
+its *.json files are then the configs of the jobs. The jobs run headless (the merged
+files are not opened in an editor), the progress is printed as each job ends and the
+summary of the run (status, time and output file of each job, the errors) is saved in
+batch_summary.json in the output folder, next to the merged files and their logs.
+"""
+import json
+import os
+import time
+import traceback
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from concurrent.futures.process import BrokenProcessPool
+
+from .ASMBL_parser import Parser
+
+
+def load_manifest(path):
+    """ Returns the list of (name, config) of the jobs of the manifest or of the folder of configs `path` """
+    if os.path.isdir(path):
+        folder = path
+        entries = sorted(entry for entry in os.listdir(path) if entry.endswith('.json'))
+    else:
+        folder = os.path.dirname(path)
+        with open(path) as manifest_file:
+            entries = json.load(manifest_file)
+        if isinstance(entries, dict):
+            entries = entries['jobs']
+
+    jobs = []
+    for entry in entries:
+        if isinstance(entry, str):
+            config_path = os.path.join(folder, entry)
+            with open(config_path) as config_file:
+                jobs.append((config_path, json.load(config_file)))
+        else:
+            jobs.append((entry['OutputSettings']['filename'], entry))
+
+    outputs = [config['OutputSettings']['filename'] for _, config in jobs]
+    duplicates = sorted({name for name in outputs if outputs.count(name) > 1})
+    if duplicates:
+        raise ValueError(f"Several jobs write the same output file: {', '.join(duplicates)}")
+    return jobs
+
+
+def run_job(job):
+    """ Merges the input files of one job without opening the output, returns its result """
+    index, name, config, folder_path = job
+    # the log of the job goes next to its output, unless its config says otherwise:
+    logging_settings = config.setdefault('Logging', {})
+    if not logging_settings.get('file'):
+        logging_settings['file'] = os.path.join(folder_path, config['OutputSettings']['filename'] + '.log')
+    result = {'index': index, 'name': name, 'file': None, 'error': None}
+    start = time.perf_counter()
+    try:
+        parser = Parser(config, quiet=True)
+        result['file'] = parser.create_output_file(folder_path=folder_path, open_output=False)
+    except Exception as error:
+        result['error'] = f'{type(error).__name__}: {error}'
+        result['traceback'] = traceback.format_exc()
+    result['wall_s'] = time.perf_counter() - start
+    return result
+
+
+def lost_job(job, error):
+    """ Result of a job whose worker process died (killed when out of memory, crashed) """
+    index, name, _, _ = job
+    return {'index': index, 'name': name, 'file': None, 'error': f'{type(error).__name__}: {error}', 'wall_s': 0.0}
+
+
+def run_batch(jobs, folder_path='output/', workers=None):
+    """
+    Runs the `jobs` [(name, config)] in `workers` processes (all the cores by default,
+    1 to run in this process), the merged files are written in `folder_path`.
+    Returns the summary of the run, also saved in batch_summary.json in `folder_path`.
+    """
+    folder_path = os.path.join(folder_path, '')
+    tasks = [(index, name, config, folder_path) for index, (name, config) in enumerate(jobs)]
+    if workers is None:
+        workers = os.cpu_count() or 1
+    workers = max(1, min(workers, len(tasks)))
+
+    print(f'Running {len(tasks)} jobs on {workers} workers...')
+    start = time.perf_counter()
+    results = []
+
+    def report(result):
+        results.append(result)
+        status = f"-> {result['file']}" if result['error'] is None else f"FAILED: {result['error']}"
+        print(f"[{len(results)}/{len(tasks)}] {result['name']} {result['wall_s']:.2f} s {status}", flush=True)
+
+    try:
+        if workers > 1:
+            with ProcessPoolExecutor(workers) as executor:
+                futures = {executor.submit(run_job, task): task for task in tasks}
+                for future in as_completed(futures):
+                    try:
+                        report(future.result())
+                    except BrokenProcessPool as error:
+                        # the jobs running or waiting when a worker died fail with it
+                        report(lost_job(futures[future], error))
+        else:
+            for task in tasks:
+                report(run_job(task))
+    finally:
+        # the summary of the jobs done, even if the batch is interrupted
+        summary = write_summary(results, folder_path, workers, time.perf_counter() - start)
+    return summary
+
+
+def write_summary(results, folder_path, workers, wall_s):
+    """ Saves the summary of the `results` of the jobs in batch_summary.json in `folder_path`, returns it """
+    results.sort(key=lambda result: result['index'])
+    failed = [result for result in results if result['error'] is not None]
+    summary = {
+        'jobs': len(results),
+        'succeeded': len(results) - len(failed),
+        'failed': len(failed),
+        'workers': workers,
+        'wall_s': wall_s,
+        'jobs_wall_s': sum(result['wall_s'] for result in results),
+        'results': results,
+    }
+
+    summary_path = os.path.join(os.path.expanduser(folder_path), 'batch_summary.json')
+    os.makedirs(os.path.dirname(summary_path), exist_ok=True)
+    with open(summary_path, 'w') as summary_file:
+        json.dump(summary, summary_file, indent=4)
+    summary['path'] = summary_path
+    return summary
@@ -0,0 +1,582 @@
+"""
+Binary G-code (.bgcode) writer and reader.
+
+The bgcode container (version 1 of the format of libbgcode) is a file header followed by
+blocks. Each block has a header (type, compression, uncompressed and compressed sizes),
+parameters (the encoding of its data, or the format and size of a thumbnail), its data
+and the CRC32 of the three. The blocks are, in this order: the file metadata, the printer
+metadata, the thumbnails, the print metadata, the slicer metadata, then the gcode in
+blocks of at most BLOCK_SIZE bytes cut on line ends. The metadata are 'key=value' lines.
+The gcode is MeatPack encoded (two characters per byte for the digits, ' ', '.', '\\n',
+'G' and 'X') then compressed with heatshrink, the compressions the printer firmwares read,
+or with deflate. Heatshrink uses the heatshrink2 package (C) when it is installed, else
+the numpy implementation of this module.
+
+The reader decodes every block back and checks their CRC, the gcode of a file written
+with the 'meatpack_comments' or 'none' encoding is the text written:
+
+    python -m src.bgcode output/merged.bgcode --gcode decoded.gcode --compare output/merged.gcode
+
+The round trips of every compression and encoding are tested in tests/test_bgcode.py.
+"""
+import base64
+import re
+import struct
+import zlib
+from enum import IntEnum
+
+import numpy as np
+
+MAGIC = b'GCDE'
+VERSION = 1
+BLOCK_SIZE = 65535     # bytes of gcode per block, before encoding
+
+
+class Checksum(IntEnum):
+    NONE = 0
+    CRC32 = 1
+
+
+class BlockType(IntEnum):
+    FILE_METADATA = 0
+    GCODE = 1
+    SLICER_METADATA = 2
+    PRINTER_METADATA = 3
+    PRINT_METADATA = 4
+    THUMBNAIL = 5
+
+
+class Compression(IntEnum):
+    NONE = 0
+    DEFLATE = 1
+    HEATSHRINK_11_4 = 2
+    HEATSHRINK_12_4 = 3
+
+
+class GcodeEncoding(IntEnum):
+    NONE = 0
+    MEATPACK = 1                # the comments are removed
+    MEATPACK_COMMENTS = 2
+
+
+class ThumbnailFormat(IntEnum):
+    PNG = 0
+    JPG = 1
+    QOI = 2
+
+
+METADATA_ENCODING_INI = 0
+
+# settings of the 'bgcode' entry of the OutputSettings of the config:
+DEFAULT_SETTINGS = {
+    'gcode_compression': 'heatshrink_12_4',
+    'gcode_encoding': 'meatpack_comments',
+    'metadata_compression': 'deflate',
+    'checksum': 'crc32',
+    'thumbnails': [],       # image files (PNG, JPG or QOI) added to the thumbnails of the additive gcode
+}
+
+HEATSHRINK_BITS = {     # (window, lookahead) bits
+    Compression.HEATSHRINK_11_4: (11, 4),
+    Compression.HEATSHRINK_12_4: (12, 4),
+}
+HEATSHRINK_MIN_MATCH = 3    # bytes, a back-reference of 2 would save a single bit
+HEATSHRINK_DEPTH = 32       # earlier matches compared for each position
+
+
+def setting(enum, name):
+    """ The member of `enum` named `name` ('heatshrink_12_4'...), ValueError if there is none """
+    try:
+        return enum[name.upper()]
+    except KeyError:
+        raise ValueError(f"Unknown {enum.__name__} '{name}', one of: "
+                         f"{', '.join(member.name.lower() for member in enum)}") from None
+
+
+# ---------------------------------------------------------------- heatshrink
+
+def heatshrink_compress(data, window_bits, lookahead_bits):
+    """
+    Heatshrink (LZSS) compression of the bytes `data`: a 1 bit and a byte for a literal,
+    a 0 bit, the offset - 1 (`window_bits`) and the length - 1 (`lookahead_bits`) of a
+    back-reference, MSB first.
+
+    The matches of every position are searched at once with numpy: the earlier positions
+    starting with the same HEATSHRINK_MIN_MATCH bytes are chained, and the HEATSHRINK_DEPTH
+    most recent ones in the window are compared 8 bytes at a time. The data is then cut
+    greedily into the longest match (the most recent of them) or a literal.
+    """
+    window, lookahead = 1 << window_bits, 1 << lookahead_bits
+    length = len(data)
+    if not length:
+        return b''
+    chars = np.frombuffer(data, dtype=np.uint8)
+    match_lengths = np.zeros(length + 1, dtype=np.int64)
+    match_offsets = np.zeros(length + 1, dtype=np.int64)
+
+    keys_count = length - HEATSHRINK_MIN_MATCH + 1
+    if keys_count > 0:
+        # previous position of the same 3 bytes:
+        keys = (chars[:keys_count].astype(np.int32) << 16) | (chars[1:keys_count + 1].astype(np.int32) << 8) \
+            | chars[2:keys_count + 2]
+        order = np.argsort(keys, kind='stable')
+        same = keys[order[1:]] == keys[order[:-1]]
+        previous = np.full(keys_count, -1, dtype=np.int64)
+        previous[order[1:][same]] = order[:-1][same]
+
+        # the 8 bytes from each position as a little endian word:
+        padded = np.concatenate((chars, np.zeros(lookahead + 8, dtype=np.uint8)))
+        words = np.ndarray((length + lookahead,), dtype='<u8', buffer=padded, strides=(1,)).copy()
+        remaining = length - np.arange(keys_count)
+
+        positions = np.flatnonzero(previous >= 0)
+        found = previous[positions]
+        for _ in range(HEATSHRINK_DEPTH):
+            in_window = positions - found <= window
+            positions, found = positions[in_window], found[in_window]
+            if not len(positions):
+                break
+            counts = np.zeros(len(positions), dtype=np.int64)
+            equal = np.ones(len(positions), dtype=bool)    # so far
+            for word in range(0, lookahead, 8):
+                difference = words[positions + word] ^ words[found + word]
+                differs = equal & (difference != 0)
+                # the lowest bit set is in the first byte that differs:
+                lowest = difference[differs] & (~difference[differs] + np.uint64(1))
+                counts[differs] += (np.frexp(lowest.astype(np.float64))[1] - 1) // 8
+                counts[equal & ~differs] += 8
+                equal &= ~differs
+            counts = np.minimum(counts, np.minimum(remaining[positions], lookahead))
+            longer = counts > match_lengths[positions]
+            match_lengths[positions[longer]] = counts[longer]
+            match_offsets[positions[longer]] = (positions - found)[longer]
+            found = previous[found]
+            earlier = found >= 0
+            positions, found = positions[earlier], found[earlier]
+
+    # the tokens start at the positions reached from 0 by steps of a match or of a literal,
+    # found by doubling the steps:
+    steps = np.where(match_lengths >= HEATSHRINK_MIN_MATCH, match_lengths, 1)
+    jump = np.minimum(np.arange(length + 1) + steps, length)
+    jumps = [jump]
+    while 1 << len(jumps) <= length:
+        jumps.append(jumps[-1][jumps[-1]])
+    reached = np.zeros(length + 1, dtype=bool)
+    reached[0] = True
+    for jump in reversed(jumps):
+        reached[jump[reached]] = True
+    tokens = np.flatnonzero(reached[:length])
+
+    references = match_lengths[tokens] >= HEATSHRINK_MIN_MATCH
+    reference_bits = 1 + window_bits + lookahead_bits
+    codes = np.where(references, ((match_offsets[tokens] - 1) << lookahead_bits) | (match_lengths[tokens] - 1),
+                     0x100 | chars[tokens].astype(np.int64))
+    shifts = np.where(references, reference_bits, 9)[:, None] - 1 - np.arange(reference_bits)
+    bits = (codes[:, None] >> np.maximum(shifts, 0)) & 1
+    return np.packbits(bits[shifts >= 0].astype(np.uint8)).tobytes()
+
+
+def heatshrink_decompress(data, window_bits, lookahead_bits):
+    """ Decompresses the heatshrink `data`, see heatshrink_compress """
+    bits = bin(int.from_bytes(b'\x01' + data, 'big'))[3:] if data else ''
+    output = bytearray()
+    reference_bits = 1 + window_bits + lookahead_bits
+    i, length = 0, len(bits)
+    while True:
+        if i < length and bits[i] == '1':
+            if i + 9 > length:
+                break
+            output.append(int(bits[i + 1:i + 9], 2))
+            i += 9
+        else:
+            if i + reference_bits > length:
+                break       # the padding of the last byte
+            offset = int(bits[i + 1:i + 1 + window_bits], 2) + 1
+            count = int(bits[i + 1 + window_bits:i + reference_bits], 2) + 1
+            i += reference_bits
+            start = len(output) - offset
+            if start < 0:   # before the data the window holds zeros
+                zeros = min(-start, count)
+                output += bytes(zeros)
+                count -= zeros
+                start = len(output) - offset
+            if start + count <= len(output):
+                output += output[start:start + count]
+            else:
+                for j in range(count):      # overlapping copy
+                    output.append(output[start + j])
+    return bytes(output)
+
+
+# ---------------------------------------------------------------- MeatPack
+
+MEATPACK_CHARS = b'0123456789. \nGX'     # the characters of the codes 0 to 14, 15: full character
+MEATPACK_LITERAL = 15
+MEATPACK_SIGNAL = b'\xff\xff'
+MEATPACK_ENABLE = 0xfb
+MEATPACK_DISABLE = 0xfa
+MEATPACK_RESET = 0xf9
+MEATPACK_NO_SPACES = 0xf7
+MEATPACK_SPACES = 0xf6
+
+MEATPACK_CODES = np.full(256, MEATPACK_LITERAL, dtype=np.uint8)
+MEATPACK_CODES[list(MEATPACK_CHARS)] = np.arange(len(MEATPACK_CHARS))
+
+COMMENT = re.compile(rb'[ \t]*;[^\n]*')
+
+
+def strip_comments(data):
+    """ The gcode bytes `data` without its ';' comments and the lines left empty """
+    data = COMMENT.sub(b'', data)
+    return re.sub(rb'\n\n+', b'\n', data).lstrip(b'\n')
+
+
+def meatpack_encode(data):
+    """
+    MeatPack encoding of the gcode bytes `data`: the characters of each line are packed by
+    pairs, 4 bits each (first in the low bits), the code 15 meaning that the character
+    follows in full after the packed byte. A line always starts a new byte, the decoder
+    skips the second character of a pair starting with '\\n'.
+    """
+    end = data.rfind(b'\n') + 1
+    data, tail = data[:end], data[end:]
+    chars = np.frombuffer(data, dtype=np.uint8)
+
+    # a line of odd length (its '\n' included) is padded with a code 0 after its '\n':
+    newlines = np.flatnonzero(chars == ord('\n'))
+    odd = np.diff(newlines, prepend=-1) % 2 == 1
+    chars = np.insert(chars, newlines[odd] + 1, ord('0'))
+    codes = MEATPACK_CODES[chars]
+
+    first_chars, second_chars = chars[0::2], chars[1::2]
+    first_full, second_full = codes[0::2] == MEATPACK_LITERAL, codes[1::2] == MEATPACK_LITERAL
+    sizes = 1 + first_full.astype(np.int64) + second_full
+    offsets = np.cumsum(sizes) - sizes
+
+    packed = np.empty(int(sizes.sum()), dtype=np.uint8)
+    packed[offsets] = codes[0::2] | (codes[1::2] << 4)
+    packed[offsets[first_full] + 1] = first_chars[first_full]
+    packed[(offsets + 1 + first_full)[second_full]] = second_chars[second_full]
+
+    encoded = MEATPACK_SIGNAL + bytes([MEATPACK_ENABLE]) + packed.tobytes()
+    if tail:    # the end of a file without '\n' is sent as it is
+        encoded += MEATPACK_SIGNAL + bytes([MEATPACK_DISABLE]) + tail
+    return encoded
+
+
+def meatpack_decode(data):
+    """ Decodes the MeatPack bytes `data`, see meatpack_encode """
+    chars = bytearray(MEATPACK_CHARS)
+    output = bytearray()
+    packing = False
+    i, length = 0, len(data)
+    while i < length:
+        byte = data[i]
+        if byte == 0xff and data[i + 1:i + 2] == b'\xff':
+            command = data[i + 2]
+            if command == MEATPACK_ENABLE:
+                packing = True
+            elif command == MEATPACK_DISABLE:
+                packing = False
+            elif command == MEATPACK_NO_SPACES:
+                chars[11] = ord('E')
+            elif command in (MEATPACK_SPACES, MEATPACK_RESET):
+                chars[11] = ord(' ')
+                packing = packing and command != MEATPACK_RESET
+            i += 3
+            continue
+        i += 1
+        if not packing:
+            output.append(byte)
+            continue
+
+        first, second = byte & 0xf, byte >> 4
+        if first == MEATPACK_LITERAL:
+            output.append(data[i])
+            i += 1
+        else:
+            output.append(chars[first])
+            if first == 12:     # '\n': the second character is the padding
+                continue
+        if second == MEATPACK_LITERAL:
+            output.append(data[i])
+            i += 1
+        else:
+            output.append(chars[second])
+    return bytes(output)
+
+
+# ---------------------------------------------------------------- blocks
+
+_heatshrink2 = False    # the heatshrink2 module, not imported yet
+
+
+def heatshrink_module():
+    """ The heatshrink2 package (C implementation of heatshrink) if it is installed, else None """
+    global _heatshrink2
+    if _heatshrink2 is False:
+        try:
+            import heatshrink2 as _heatshrink2
+        except ImportError:
+            _heatshrink2 = None
+    return _heatshrink2
+
+
+def compress(data, compression):
+    if compression == Compression.DEFLATE:
+        return zlib.compress(data)
+    if compression in HEATSHRINK_BITS:
+        window_bits, lookahead_bits = HEATSHRINK_BITS[compression]
+        heatshrink2 = heatshrink_module()
+        if heatshrink2 is not None:
+            return heatshrink2.compress(data, window_sz2=window_bits, lookahead_sz2=lookahead_bits)
+        return heatshrink_compress(data, window_bits, lookahead_bits)
+    return data
+
+
+def decompress(data, compression):
+    if compression == Compression.DEFLATE:
+        return zlib.decompress(data)
+    if compression in HEATSHRINK_BITS:
+        window_bits, lookahead_bits = HEATSHRINK_BITS[compression]
+        heatshrink2 = heatshrink_module()
+        if heatshrink2 is not None:
+            return heatshrink2.decompress(data, window_sz2=window_bits, lookahead_sz2=lookahead_bits)
+        return heatshrink_decompress(data, window_bits, lookahead_bits)
+    return data
+
+
+def encode_block(block_type, parameters, data, compression, checksum=Checksum.CRC32):
+    """ The bytes of a block: header, `parameters` (bytes), `data` compressed and checksum """
+    compressed = compress(data, compression)
+    if compression != Compression.NONE and len(compressed) >= len(data):
+        compression, compressed = Compression.NONE, data   # not worth it
+    header = struct.pack('<HHI', block_type, compression, len(data))
+    if compression != Compression.NONE:
+        header += struct.pack('<I', len(compressed))
+    block = header + parameters + compressed
+    if checksum == Checksum.CRC32:
+        block += struct.pack('<I', zlib.crc32(block))
+    return block
+
+
+def encode_metadata(items):
+    """ The 'key=value' lines of the dict `items` """
+    return ''.join(f'{key}={value}\n' for key, value in items.items()).encode()
+
+
+def image_size(data):
+    """ (ThumbnailFormat, width, height) of the PNG, JPG or QOI image `data` """
+    if data.startswith(b'\x89PNG'):
+        width, height = struct.unpack('>II', data[16:24])
+        return ThumbnailFormat.PNG, width, height
+    if data.startswith(b'qoif'):
+        width, height = struct.unpack('>II', data[4:12])
+        return ThumbnailFormat.QOI, width, height
+    if data.startswith(b'\xff\xd8'):
+        i = 2
+        while i + 9 < len(data):
+            marker, size = data[i + 1], struct.unpack('>H', data[i + 2:i + 4])[0]
+            if 0xc0 <= marker <= 0xcf and marker not in (0xc4, 0xc8, 0xcc):     # start of frame
+                height, width = struct.unpack('>HH', data[i + 5:i + 9])
+                return ThumbnailFormat.JPG, width, height
+            i += 2 + size
+    raise ValueError('Thumbnail image is not a PNG, JPG or QOI image')
+
+
+# '; thumbnail begin 300x300 1234' (PNG) or '; thumbnail_JPG begin ...' / '; thumbnail_QOI begin ...'
+# base64 lines of the slicers, until '; thumbnail end':
+THUMBNAIL = re.compile(r'^; thumbnail(?:_(JPG|QOI))? begin \d+x\d+ \d+\n(.*?)^; thumbnail(?:_(?:JPG|QOI))? end',
+                       re.M | re.S)
+
+
+def find_thumbnails(gcode):
+    """ The images of the thumbnails written by the slicer in the gcode string `gcode` """
+    return [base64.b64decode(re.sub(r'[;\s]', '', match.group(2))) for match in THUMBNAIL.finditer(gcode)]
+
+
+def encode_gcode_block(data, encoding, compression, checksum=Checksum.CRC32):
+    """ The bytes of the gcode block of the gcode bytes `data`, b'' if there is no gcode left to write """
+    if encoding == GcodeEncoding.MEATPACK:
+        data = strip_comments(data)
+        if not data:
+            return b''
+    if encoding != GcodeEncoding.NONE:
+        data = meatpack_encode(data)
+    return encode_block(BlockType.GCODE, struct.pack('<H', encoding), data, compression, checksum)
+
+
+class BgcodeWriter:
+    """
+    File-like object writing the gcode written to it (str) as a bgcode file in the binary
+    file `file`. The metadata and thumbnail blocks are written first, the gcode blocks as
+    the gcode comes, close() writes the last one. `settings` is the 'bgcode' dict of the
+    OutputSettings (see DEFAULT_SETTINGS), `metadata` is {BlockType: {key: value}} and
+    `thumbnails` a list of images (bytes). With several `workers`, the gcode blocks are
+    encoded and compressed in a process pool, heatshrink is slow in Python.
+    """
+
+    def __init__(self, file, settings=None, metadata=None, thumbnails=(), workers=1):
+        settings = dict(DEFAULT_SETTINGS, **(settings or {}))
+        self.file = file
+        self.gcode_compression = setting(Compression, settings['gcode_compression'])
+        self.gcode_encoding = setting(GcodeEncoding, settings['gcode_encoding'])
+        self.metadata_compression = setting(Compression, settings['metadata_compression'])
+        self.checksum = setting(Checksum, settings['checksum'])
+        self.buffer = b''
+        self.workers = workers
+        self.executor = None
+        self.pending = []   # gcode blocks waiting for the workers
+
+        metadata = metadata or {}
+        file.write(MAGIC + struct.pack('<IH', VERSION, self.checksum))
+        self.write_metadata(BlockType.FILE_METADATA, metadata.get(BlockType.FILE_METADATA, {'Producer': 'N-Fab'}))
+        self.write_metadata(BlockType.PRINTER_METADATA, metadata.get(BlockType.PRINTER_METADATA, {}))
+        for image in thumbnails:
+            image_format, width, height = image_size(image)
+            file.write(encode_block(BlockType.THUMBNAIL, struct.pack('<HHH', image_format, width, height), image,
+                                    Compression.NONE, self.checksum))
+        self.write_metadata(BlockType.PRINT_METADATA, metadata.get(BlockType.PRINT_METADATA, {}))
+        self.write_metadata(BlockType.SLICER_METADATA, metadata.get(BlockType.SLICER_METADATA, {}))
+
+    def write_metadata(self, block_type, items):
+        self.file.write(encode_block(block_type, struct.pack('<H', METADATA_ENCODING_INI), encode_metadata(items),
+                                     self.metadata_compression, self.checksum))
+
+    def write_gcode_block(self, data):
+        if self.workers <= 1:
+            self.file.write(encode_gcode_block(data, self.gcode_encoding, self.gcode_compression, self.checksum))
+            return
+        self.pending.append(data)
+        if len(self.pending) >= 4 * self.workers:
+            self.write_pending()
+
+    def write_pending(self):
+        """ Encodes the pending gcode blocks in the pool and writes them in order """
+        if not self.pending:
+            return
+        if self.executor is None:
+            from concurrent.futures import ProcessPoolExecutor     # only loaded when workers are used
+            self.executor = ProcessPoolExecutor(self.workers)
+        count = len(self.pending)
+        for block in self.executor.map(encode_gcode_block, self.pending, [self.gcode_encoding] * count,
+                                       [self.gcode_compression] * count, [self.checksum] * count):
+            self.file.write(block)
+        self.pending = []
+
+    def write(self, gcode):
+        """ Adds the str `gcode`, the full blocks are written, cut after their last new line """
+        data = self.buffer + gcode.encode()
+        start = 0
+        while len(data) - start >= BLOCK_SIZE:
+            cut = data.rfind(b'\n', start, start + BLOCK_SIZE) + 1 or start + BLOCK_SIZE
+            self.write_gcode_block(data[start:cut])
+            start = cut
+        self.buffer = data[start:]
+        return len(gcode)
+
+    def flush(self):
+        self.file.flush()
+
+    def close(self):
+        """ Writes the last gcode blocks, the file is left open """
+        try:
+            if self.buffer:
+                self.write_gcode_block(self.buffer)
+                self.buffer = b''
+            self.write_pending()
+        finally:
+            if self.executor is not None:
+                self.executor.shutdown()
+                self.executor = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, *exc):
+        if exc_type is None:
+            self.close()
+        elif self.executor is not None:
+            self.executor.shutdown(cancel_futures=True)
+
+
+# ---------------------------------------------------------------- reader
+
+def read_bgcode(data):
+    """
+    Decodes the bgcode bytes `data`, checking the checksum of each block.
+    Returns {'version': , 'metadata': {BlockType: {key: value}}, 'thumbnails': [(ThumbnailFormat,
+    width, height, image)], 'gcode': str, 'blocks': number of gcode blocks}.
+    Raises ValueError if the data is not a valid bgcode file.
+    """
+    if data[:4] != MAGIC:
+        raise ValueError('Not a bgcode file')
+    version, checksum = struct.unpack_from('<IH', data, 4)
+    if version != VERSION:
+        raise ValueError(f'Unsupported bgcode version {version}')
+    result = {'version': version, 'metadata': {}, 'thumbnails': [], 'gcode': '', 'blocks': 0}
+    gcode = []
+    i = 10
+    while i < len(data):
+        start = i
+        block_type, compression, size = struct.unpack_from('<HHI', data, i)
+        i += 8
+        stored_size = size
+        if compression != Compression.NONE:
+            stored_size, = struct.unpack_from('<I', data, i)
+            i += 4
+        parameters_size = 6 if block_type == BlockType.THUMBNAIL else 2
+        parameters = data[i:i + parameters_size]
+        stored = data[i + parameters_size:i + parameters_size + stored_size]
+        i += parameters_size + stored_size
+        if len(stored) != stored_size:
+            raise ValueError(f'Truncated block at byte {start}')
+        if checksum == Checksum.CRC32:
+            crc, = struct.unpack_from('<I', data, i)
+            if crc != zlib.crc32(data[start:i]):
+                raise ValueError(f'Bad checksum of the block at byte {start}')
+            i += 4
+
+        block = decompress(stored, Compression(compression))
+        if len(block) != size:
+            raise ValueError(f'Bad size of the block at byte {start}')
+        if block_type == BlockType.THUMBNAIL:
+            image_format, width, height = struct.unpack('<HHH', parameters)
+            result['thumbnails'].append((ThumbnailFormat(image_format), width, height, block))
+        elif block_type == BlockType.GCODE:
+            encoding, = struct.unpack('<H', parameters)
+            gcode.append(meatpack_decode(block) if encoding != GcodeEncoding.NONE else block)
+            result['blocks'] += 1
+        else:
+            result['metadata'][BlockType(block_type)] = dict(
+                line.split('=', 1) for line in block.decode().splitlines() if '=' in line)
+
+    result['gcode'] = b''.join(gcode).decode()
+    return result
+
+
+if __name__ == '__main__':
+    import argparse
+
+    arg_parser = argparse.ArgumentParser(description='bgcode reader')
+    arg_parser.add_argument('file', help='bgcode file')
+    arg_parser.add_argument('--gcode', metavar='FILE', help='write the decoded gcode in FILE')
+    arg_parser.add_argument('--compare', metavar='FILE', help='check the decoded gcode against the gcode FILE')
+    args = arg_parser.parse_args()
+
+    with open(args.file, 'rb') as bgcode_file:
+        decoded = read_bgcode(bgcode_file.read())
+    for block_type, items in decoded['metadata'].items():
+        print(f'{block_type.name.lower()}: {items}')
+    for image_format, width, height, image in decoded['thumbnails']:
+        print(f'thumbnail {image_format.name} {width}x{height}, {len(image)} bytes')
+    print(f"{decoded['blocks']} gcode blocks, {len(decoded['gcode'])} characters")
+
+    if args.gcode:
+        with open(args.gcode, 'w', newline='') as gcode_file:
+            gcode_file.write(decoded['gcode'])
+    if args.compare:
+        with open(args.compare, newline='') as gcode_file:
+            same = gcode_file.read() == decoded['gcode']
+        print('same gcode' if same else 'DIFFERENT gcode')
+        raise SystemExit(0 if same else 1)
@@ -1,46 +1,252 @@
+from enum import IntEnum
 from math import inf
+import numpy as np
 from . import utils
 
 
+class LineType(IntEnum):
+    """
+    Codes of the line types written by the CAM post processor (getMovementStringId of
+    post_processors/asmbl_cam.cps). The lines store the code of their type, the name is
+    only used to render the '; <type>' comments. A type not listed here gets one of the
+    codes following these ones in the type_names of its CamGcodeBlock.
+    """
+    NONE = 0
+    RAPID = 1
+    LEAD_IN = 2
+    CUTTING = 3
+    LEAD_OUT = 4
+    TRANSITION = 5
+    BRIDGING = 6
+    DIRECT = 7
+    HELIX_RAMP = 8
+    CIRCULAR_PIERCE = 9
+    PROFILE_RAMP = 10
+    PROFILE_PIERCE = 11
+    ZIGZAG_RAMP = 12
+    LINEAR_PIERCE = 13
+    RAMP = 14
+    PIERCE = 15
+    PLUNGE = 16
+    PREDRILL = 17
+    EXTENDED = 18
+    REDUCED = 19
+    HIGH_FEED = 20
+
+
+# name of each code of LineType, as written in the gcode:
+LINE_TYPE_NAMES = (None,) + tuple(line_type.name.lower().replace('_', ' ') for line_type in list(LineType)[1:])
+LINE_TYPE_CODES = {name: code for code, name in enumerate(LINE_TYPE_NAMES)}
+
+CUTTING_TYPES = frozenset((LineType.CUTTING, LineType.RAMP))
+LEAD_IN_TYPES = frozenset((LineType.LEAD_IN, LineType.PLUNGE, LineType.TRANSITION))
+LEAD_OUT_TYPES = frozenset((LineType.LEAD_OUT, LineType.TRANSITION))
+RAMP_TYPES = frozenset((LineType.HELIX_RAMP, LineType.PROFILE_RAMP, LineType.RAMP))
+
+# X & Y are stored as float32 when they are all within this range (mm), where a float32
+# still renders the same 3 decimals:
+FLOAT32_RANGE = 8192
+
+
+def compact_coordinates(values):
+    """ The rounded X or Y values `values` as float32 if it renders them exactly, else as they are """
+    if np.all(np.abs(values[~np.isnan(values)]) < FLOAT32_RANGE):
+        return values.astype(np.float32)
+    return values
+
+
+class CamGcodeBlock:
+    """
+    Stores all the lines of a fusion360 CAM operation as columns:
+    X/Y/Z (offset, rounded to 3 decimals) and line type code arrays,
+    plus small code arrays for the command and the feed rate words.
+    The gcode text is only rendered when the output is written.
+    """
+    __slots__ = ('commands', 'x', 'y', 'z', 'feeds', 'types', 'command_names', 'feed_names', 'type_names', 'extra')
+
+    def __init__(self, commands, x, y, z, feeds, types, command_names, feed_names, type_names, extra=None):
+        self.commands = commands            # uint8 codes into command_names ('G0', 'G1'...)
+        self.x = x
+        self.y = y
+        self.z = z
+        self.feeds = feeds                  # int16 codes into feed_names ('F924'...), -1 if no feed word
+        self.types = types                  # uint8 LineType codes into type_names, 0 is no type (None)
+        self.command_names = command_names
+        self.feed_names = feed_names
+        self.type_names = type_names
+        self.extra = extra or {}            # {line index: rendered gcode} for lines not in 'G X Y Z [F]' form or with a comment
+
+    def __len__(self):
+        return len(self.z)
+
+    @classmethod
+    def from_records(cls, records, offset):
+        """ Builds the columns from lexed CAM gcode records, `offset` is applied to X, Y & Z """
+        commands, xs, ys, zs, feeds, types = [], [], [], [], [], []
+        command_codes, feed_codes, type_codes = {}, {}, dict(LINE_TYPE_CODES)
+        extra = {}
+        type_code = 0
+
+        for record in records:
+            command = record.command
+            if command is None:
+                if record.fields:
+                    command = ''    # modal motion line 'X.. Y.. Z..', rendered from `extra`
+                else:
+                    if record.tag is not None and record.tag[0] == 'type':
+                        type_code = type_codes.setdefault(record.tag[1], len(type_codes))
+                    continue
+            elif command[0] == 'M':
+                continue
+
+            fields = record.fields
+            params = record.params
+            feed = -1
+            if (record.comment is None and len(fields) in (4, 5)
+                    and fields[1][0] == 'X' and fields[2][0] == 'Y' and fields[3][0] == 'Z'):
+                if len(fields) == 5:
+                    if fields[4][0] == 'F':
+                        feed = feed_codes.setdefault(fields[4], len(feed_codes))
+                    else:
+                        extra[len(zs)] = utils.offset_gcode(record, offset)
+            else:
+                extra[len(zs)] = utils.offset_gcode(record, offset)
+
+            commands.append(command_codes.setdefault(command, len(command_codes)))
+            xs.append(params.get('X', np.nan))
+            ys.append(params.get('Y', np.nan))
+            zs.append(params['Z'])
+            feeds.append(feed)
+            types.append(type_code)
+
+        # the names of the LineType codes are shared by the blocks:
+        type_names = LINE_TYPE_NAMES if len(type_codes) == len(LINE_TYPE_NAMES) else list(type_codes)
+        return cls(
+            np.array(commands, dtype=np.uint8),
+            compact_coordinates(utils.round_array(np.array(xs, dtype=float) + offset[0])),
+            compact_coordinates(utils.round_array(np.array(ys, dtype=float) + offset[1])),
+            # Z stays float64: the heights are compared with the additive layer heights
+            utils.round_array(np.array(zs, dtype=float) + offset[2]),
+            np.array(feeds, dtype=np.int16 if len(feed_codes) < 2**15 else np.int32),
+            np.array(types, dtype=np.uint8),
+            list(command_codes),
+            list(feed_codes),
+            type_names,
+            extra,
+        )
+
+    def render_line(self, index, z_offset=0):
+        """ Renders a single line, `z_offset` is added to its Z value (used for retracts) """
+        if index in self.extra:
+            if z_offset:
+                return utils.offset_gcode(self.extra[index], (0, 0, z_offset))
+            return self.extra[index]
+
+        gcode = (f'{self.command_names[self.commands[index]]} X{float(self.x[index]):.3f} '
+                 f'Y{float(self.y[index]):.3f} Z{self.z[index] + z_offset:.3f}')
+        feed = self.feeds[index]
+        if feed >= 0:
+            gcode += ' ' + self.feed_names[feed]
+        return gcode
+
+    def render(self, start, stop):
+        """ Renders lines [start, stop) with a '; <type>' comment each time the line type changes """
+        command_names, feed_names, type_names, extra = self.command_names, self.feed_names, self.type_names, self.extra
+        gcode = []
+        last_type = 0
+
+        columns = zip(self.commands[start:stop].tolist(), self.x[start:stop].tolist(), self.y[start:stop].tolist(),
+                      self.z[start:stop].tolist(), self.feeds[start:stop].tolist(), self.types[start:stop].tolist())
+        for index, (command, x, y, z, feed, line_type) in enumerate(columns, start):
+            if line_type != last_type:
+                gcode.append('; ' + str(type_names[line_type]) + '\n')
+                last_type = line_type
+            if index in extra:
+                gcode.append(extra[index] + '\n')
+            elif feed >= 0:
+                gcode.append(f'{command_names[command]} X{x:.3f} Y{y:.3f} Z{z:.3f} {feed_names[feed]}\n')
+            else:
+                gcode.append(f'{command_names[command]} X{x:.3f} Y{y:.3f} Z{z:.3f}\n')
+
+        return ''.join(gcode)
+
+    def segment_bounds(self):
+        """ Returns the (starts, stops) arrays of the runs of consecutive lines of the same type """
+        changes = np.flatnonzero(self.types[1:] != self.types[:-1]) + 1
+        starts = np.concatenate(([0], changes))
+        stops = np.concatenate((changes, [len(self)]))
+        return starts, stops
+
+
 class CamGcodeLine:
-    """ Stores a single line of fusion360 CAM gcode. """
+    """ View on a single line of fusion360 CAM gcode stored in a CamGcodeBlock. """
+    __slots__ = ('block', 'index')
+
+    def __init__(self, block, index):
+        self.block = block
+        self.index = index
+
+    @property
+    def gcode(self):
+        return self.block.render_line(self.index)
+
+    @property
+    def layer_height(self):
+        return float(self.block.z[self.index])
+
+    @property
+    def code(self):
+        """ LineType code of the line """
+        return int(self.block.types[self.index])
 
-    def __init__(self, gcode, offset, line_type):
-        self.gcode = utils.offset_gcode(gcode, offset)
-        self.layer_height = self.get_layer_height(self.gcode)
-        self.type = line_type
-        
-    def get_layer_height(self, gcode):
-        """Return the layer height of single line of gcode."""
-        return float(gcode.split('Z')[1].split(' ')[0])
+    @property
+    def type(self):
+        return self.block.type_names[self.block.types[self.index]]
 
 
 class CamGcodeSegment:
-    """ 
-    Stores gcode lines for a sequence of a specific movement type.
+    """
+    Stores the range [start, stop) of the lines of a CamGcodeBlock for a sequence of
+    a specific movement type, `code` is its LineType code.
     JLC: the type 'remp' is processed as is the type 'cutting'.
     """
+    __slots__ = ('code', 'block', 'start', 'stop', 'index', 'planar', 'height', 'z_range')
 
-    def __init__(self, index, lines, segment_type):
-        self.type = segment_type
-        self.lines = lines
+    def __init__(self, index, block, start, stop, code, z_range=None):
+        self.code = code
+        self.block = block
+        self.start = start
+        self.stop = stop
         self.index = index
         self.planar = None
         self.height = None
+        self.z_range = z_range  # (min, max) if already computed for all the segments at once
 
-        if self.type in ('cutting', 'ramp'):
+        if self.code in CUTTING_TYPES:
             self.set_z_height()
 
+    @property
+    def type(self):
+        """ Name of the type of the segment, as written in the gcode """
+        return self.block.type_names[self.code]
+
+    @property
+    def lines(self):
+        return [CamGcodeLine(self.block, index) for index in range(self.start, self.stop)]
+
+    def __len__(self):
+        return self.stop - self.start
+
     def get_min_z_height(self):
-        op_height = min(
-            [line.layer_height for line in self.lines])
-        return op_height
+        if self.z_range is not None:
+            return self.z_range[0]
+        return float(self.block.z[self.start:self.stop].min())
 
     def get_max_z_height(self):
         # Filter out retracts, only care about max Z height of cutting ops
-        op_height = max(
-            [line.layer_height for line in self.lines])
-        return op_height
+        if self.z_range is not None:
+            return self.z_range[1]
+        return float(self.block.z[self.start:self.stop].max())
 
     def set_z_height(self, threshold=0.05):
         max_height = self.get_max_z_height()
@@ -50,11 +256,11 @@ class CamGcodeSegment:
             self.height = max_height
             self.planar = False
         #<JLC> ajout
-        elif len(self.lines) == 1:
+        elif len(self) == 1:
             assert max_height == min_height
             self.height = min_height
         #</JLC>
-                    
+
         else:
             self.height = min_height
             self.planar = True
@@ -63,8 +269,11 @@ class CamGcodeSegment:
 class CamGcodeLayer:
     """
     Stores all the CAM operations in a specific layer.
+    The segments are consecutive ranges of the same CamGcodeBlock.
     JLC: the type 'remp' is processed as is the type 'cutting'.
     """
+    __slots__ = ('segments', 'name', 'strategy', 'tool', 'start_tool', 'planar', 'cutting_height', 'retracts',
+                 'layer_height')
 
     def __init__(self, segments, name=None, strategy=None, tool=None, start_tool=None, cutting_height=None):
         self.segments = segments
@@ -74,32 +283,33 @@ class CamGcodeLayer:
         self.start_tool = start_tool
         self.planar = None
         self.cutting_height = cutting_height
-        self.gcode = None
+        self.retracts = None    # (pre retract, post retract) gcode lines, see Parser.add_retracts
 
         if self.segments:
             self.set_cutting_height()
             self.set_planar()
-            self.gcode = self.parse_gcode()
 
         self.layer_height = None  # height to print to before running the operation
 
+    @property
+    def gcode(self):
+        """ Renders the gcode of the layer, with its retracts if any """
+        if not self.segments:
+            return None
+        gcode = self.parse_gcode()
+        if self.retracts is not None:
+            pre_retract, post_retract = self.retracts
+            gcode = '; retract\n' + pre_retract + '\n' + gcode + '; retract\n' + post_retract + '\n'
+        return gcode
+
     def parse_gcode(self):
         """ Combines the gcode lines from all the operations into a single string """
-        gcode = ''
-        last_line_type = None
-
-        for segment in self.segments:
-            for line in segment.lines:
-                if line.type != last_line_type:
-                    gcode += '; ' + str(line.type) + '\n'
-                    last_line_type = line.type
-                gcode += line.gcode + '\n'
-
-        return gcode
+        block = self.segments[0].block
+        return block.render(self.segments[0].start, self.segments[-1].stop)
 
     def set_cutting_height(self):
         self.cutting_height = max(
-            [segment.height for segment in self.segments if segment.type in ('cutting', 'ramp')])
+            [segment.height for segment in self.segments if segment.code in CUTTING_TYPES])
 
     def set_planar(self):
         non_planar_segments = [segment for segment in self.segments if segment.planar is False]
@@ -1,10 +1,12 @@
 from pathlib import Path
 import adsk.core
 import adsk.fusion
-import time, os, shutil, sys, subprocess, traceback
+import os, shutil, sys, subprocess, traceback
 
 from ..ASMBL_parser import Parser
 from .. import utils
+from .. import service
+from .. import readiness
 
 # Global list to keep all event handlers in scope.
 # This is only needed with Python.
@@ -33,35 +35,34 @@ def generateAllTootpaths(ui, cam):
     progress.isCancelButtonShown = False
     progress.show('Toolpath Generation Progress', 'Generating Toolpaths', 0, 10)
 
-    # Enter a loop to wait while the toolpaths are being generated and update
-    # the progress dialog.
-    while not future.isGenerationCompleted:
-        # since toolpaths are calculated in parallel, loop the progress bar while the toolpaths
-        # are being generated but none are yet complete.
-        n = 0
-        start = time.time()
-        while future.numberOfCompleted == 0:
-            if time.time() - start > .125:  # increment the progess value every .125 seconds.
-                start = time.time()
-                n += 1
-                progress.progressValue = n
-                adsk.doEvents()
-            if n > 10:
-                n = 0
-
-        # The first toolpath has finished computing so now display better
-        # information in the progress dialog.
+    # Wait while the toolpaths are being generated and update the progress dialog
+    # (every .125 seconds, sleeping in between).
 
-        # set the progress bar value to the number of completed toolpaths
-        progress.progressValue = future.numberOfCompleted
+    # since toolpaths are calculated in parallel, loop the progress bar while the toolpaths
+    # are being generated but none are yet complete.
+    def loopProgress():
+        progress.progressValue = (progress.progressValue + 1) % 11
+        adsk.doEvents()
+
+    readiness.wait_until(lambda: future.numberOfCompleted > 0 or future.isGenerationCompleted,
+                         on_wait=loopProgress, first_delay=.125, max_delay=.125)
 
-        # set the progress bar max to the number of operations to be completed.
-        progress.maximumValue = numOps
+    # The first toolpath has finished computing so now display better
+    # information in the progress dialog.
 
-        # set the message for the progress dialog to track the progress value and the total number of operations to be completed.
-        progress.message = 'Generating %v of %m' + ' Toolpaths'
+    # set the progress bar max to the number of operations to be completed.
+    progress.maximumValue = numOps
+
+    # set the message for the progress dialog to track the progress value and the total number of operations to be completed.
+    progress.message = 'Generating %v of %m' + ' Toolpaths'
+
+    def showCompleted():
+        # set the progress bar value to the number of completed toolpaths
+        progress.progressValue = future.numberOfCompleted
         adsk.doEvents()
 
+    readiness.wait_for_future(future, on_wait=showCompleted)
+
     progress.hide()
     ui.messageBox(message)
 
@@ -88,8 +89,39 @@ def remove_old_file(path, file_name):
         os.remove(file_path)
 
     # ensure file deleted
-    while os.path.exists(file_path):
-        pass
+    readiness.wait_for_removal(file_path)
+
+
+# s to connect to the merge service and for each of its answers, then between two events of the merge:
+SERVICE_TIMEOUT = 5
+SERVICE_READ_TIMEOUT = 600
+
+def showMergeProgress(progress, event):
+    # stages of the merge done by the merge service in the progress dialog
+    if event['event'] == 'queued' and event['jobs_ahead']:
+        progress.message = 'Waiting for %d merges' % event['jobs_ahead']
+    elif event['event'] == 'progress':
+        progress.message = event['message']
+        progress.progressValue += 1
+    adsk.doEvents()
+
+
+def mergeOnService(config, progress, outputFolder):
+    # merged by the merge service if one is running (see service.py), returns the path of the
+    # merged file in outputFolder, None if there is no service. A service on another computer
+    # receives the input files and sends back the merged file.
+    address = os.environ.get('NFAB_MERGE_SERVICE', service.DEFAULT_ADDRESS)
+    local = service.is_local(address)
+    try:
+        result = service.merge(config, address=address, output_folder=outputFolder if local else None,
+                               upload_inputs=not local, timeout=SERVICE_TIMEOUT,
+                               read_timeout=SERVICE_READ_TIMEOUT,
+                               on_event=lambda event: showMergeProgress(progress, event))
+        if local:
+            return result['file']
+        return service.download(result['file'], outputFolder, address, timeout=SERVICE_TIMEOUT)
+    except OSError:
+        return None
 
 
 def postToolpaths(ui, cam, viewResult, externAdditiveGcode):
@@ -177,24 +209,13 @@ def postCamToolpath(ui, cam, setup, units, output_folder, part_name):
 
         cam.postProcess(setup, postInput)
 
-        start = time.time()
         file_path = os.path.join(output_folder, programName + '.gcode')
-        while not os.path.exists(file_path):
-            if time.time() > start + 10:
-                ui.messageBox('Posting timed out')
-                return
-            pass    # wait until files exist
-
-        checkpoint = time.time()
-        while True:
-            if time.time() > checkpoint + 10:
-                ui.messageBox('Permission Error timed out')
-                return
-            try:
-                open(file_path)
-                break
-            except PermissionError:
-                continue
+        try:
+            # wait until the file is written
+            readiness.wait_for_files([file_path], timeout=10, on_wait=adsk.doEvents)
+        except TimeoutError as error:
+            ui.messageBox(str(error))
+            return
 
 
 # Event handler that reacts when the command definitio is executed which
@@ -410,25 +431,15 @@ class PostProcessExecuteHandler(adsk.core.CommandEventHandler):
         #     os.remove(tmpSubtractive)
 
         try:
-            start = time.time()
             externAdditiveGcode = orcaFile != ""
             postToolpaths(ui, cam, viewIntermediateFiles, externAdditiveGcode)
-            while not (os.path.exists(tmpAdditive) and os.path.exists(tmpSubtractive)):
-                if time.time() > start + 10:
-                    ui.messageBox('Posting timed out')
-                    return
-                pass    # wait until files exist
-            checkpoint = time.time()
-            while True:
-                if time.time() > checkpoint + 10:
-                    ui.messageBox('Permission Error timed out')
-                    return
-                try:
-                    open(tmpAdditive)
-                    open(tmpSubtractive)
-                    break
-                except PermissionError:
-                    continue
+            # wait until both files are written completely
+            readiness.wait_for_files([tmpAdditive, tmpSubtractive], timeout=10,
+                                     cancel=lambda: progress.wasCancelled, on_wait=adsk.doEvents)
+        except (TimeoutError, readiness.WaitCancelled) as error:
+            progress.hide()
+            ui.messageBox(str(error))
+            return
         except:
             ui.messageBox('Failed posting toolpaths:\n{}'.format(traceback.format_exc()))
             return
@@ -456,16 +467,26 @@ class PostProcessExecuteHandler(adsk.core.CommandEventHandler):
             },
             "Flags": {
                 "append_AddSubGcode": appendAddSubGcode
+            },
+            "Cache": {
+                "folder": os.path.expanduser('~/N-Fab/cache/')   # identical toolpaths are not parsed again
             }
         }
         # ui.messageBox(config.__str__())
 
         try:
-            time.sleep(1)   # be sure files are written completely
-            asmbl_parser = Parser(config, progress)
-
             outputFolder = os.path.expanduser('~/N-Fab/output/')
-            asmbl_parser.create_output_file(asmbl_parser.merged_gcode_script, outputFolder)
+
+            # merged by the merge service if one is running, by the add-in otherwise:
+            filePath = mergeOnService(config, progress, outputFolder)
+            if filePath is None:
+                asmbl_parser = Parser(config, progress)
+                asmbl_parser.create_output_file(folder_path=outputFolder)
+            elif not filePath.endswith('.bgcode'):     # binary gcode, not for an editor
+                try:
+                    utils.open_file(filePath)
+                except FileNotFoundError:
+                    pass
 
             utils.open_file(outputFolder)
         except:
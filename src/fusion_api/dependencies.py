@@ -0,0 +1,91 @@
+"""
+Packages of the add-in that the python of Fusion 360 does not ship (numpy, see
+requirements-addin.txt).
+
+They are installed by the python of Fusion, with pip, in the lib folder of the add-in, which
+is put in front of sys.path before the parser is imported. The add-in offers to install
+them at its first run, and again when a Fusion update changes its python version. By hand:
+
+    <python of Fusion> -m pip install --upgrade --target lib -r requirements-addin.txt
+
+This module only uses the standard library: it runs before the packages are there.
+"""
+import importlib
+import os
+import subprocess
+import sys
+
+ADDIN_FOLDER = os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+LIB_FOLDER = os.path.join(ADDIN_FOLDER, 'lib')
+REQUIREMENTS = os.path.join(ADDIN_FOLDER, 'requirements-addin.txt')
+MODULES = ('numpy',)
+
+
+def addLibFolder():
+    if LIB_FOLDER not in sys.path:
+        sys.path.insert(0, LIB_FOLDER)
+
+
+def missingModules():
+    """ Names of the MODULES that can not be imported """
+    importlib.invalidate_caches()
+    missing = []
+    for name in MODULES:
+        try:
+            importlib.import_module(name)
+        except ImportError:     # not installed, or built for another python version
+            missing.append(name)
+    return missing
+
+
+def pythonExecutable():
+    """ The python interpreter of Fusion: sys.executable is Fusion itself """
+    if sys.platform == 'win32':
+        return os.path.join(sys.prefix, 'python.exe')
+    return os.path.join(sys.prefix, 'bin', 'python3')
+
+
+def installCommand():
+    return [pythonExecutable(), '-m', 'pip', 'install', '--upgrade', '--target', LIB_FOLDER, '-r', REQUIREMENTS]
+
+
+def installModules():
+    """ Installs the requirements in LIB_FOLDER, returns (success, output of pip) """
+    try:
+        process = subprocess.run(installCommand(), stdout=subprocess.PIPE, stderr=subprocess.STDOUT,
+                                 text=True, check=False)
+    except OSError as error:
+        return False, str(error)
+    return process.returncode == 0, process.stdout
+
+
+def ensureModules(ui):
+    """
+    Makes the MODULES importable, installing them when the user agrees.
+    Returns False when they are still missing: the add-in can not run.
+    """
+    import adsk.core
+
+    addLibFolder()
+    missing = missingModules()
+    if not missing:
+        return True
+
+    answer = ui.messageBox('N-Fab needs {} which the python of Fusion 360 does not have.\n'
+                           'Install it in {} now? (internet connection needed)'.format(', '.join(missing), LIB_FOLDER),
+                           'N-Fab', adsk.core.MessageBoxButtonTypes.YesNoButtonType,
+                           adsk.core.MessageBoxIconTypes.QuestionIconType)
+    output = ''
+    if answer == adsk.core.DialogResults.DialogYes:
+        success, output = installModules()
+        # forget what was left of the failed imports before importing again:
+        for name in [name for name in sys.modules if name.split('.')[0] in missing]:
+            del sys.modules[name]
+        missing = missingModules()
+        if not missing:
+            return True
+        output = '' if success else output[-2000:]     # the end of the pip error
+
+    ui.messageBox('N-Fab can not run without {}. To install it by hand, close Fusion 360 and run:\n\n{}\n\n{}'.format(
+        ', '.join(missing), subprocess.list2cmdline(installCommand()), output).strip())
+    return False
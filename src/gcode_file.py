@@ -0,0 +1,121 @@
+"""
+Memory-mapped gcode input file with an index of the line start offsets.
+
+The lines are addressed by number as with the list of `readlines()`, but only
+the byte ranges actually needed are decoded: a file of millions of lines costs
+8 bytes per line for the index instead of one str object per line.
+"""
+import locale
+import mmap
+from array import array
+from bisect import bisect_left
+import numpy as np
+
+CHUNK_SIZE = 1 << 20    # bytes decoded at once when iterating over lines
+
+
+class GcodeFile:
+    """
+    Read-only gcode file, mmapped, with `offsets` the array('Q') of the byte offset
+    of the start of each line, plus the size of the file as the last item.
+
+    The lines of files with '\\r\\n' line endings (`crlf`) are indexed on the '\\n' and
+    their '\\r' removed when they are decoded. Files with lone '\\r' line endings are read
+    in memory with the newline translation of text mode instead, so that in both cases
+    the lines are the same as with `open(path, 'r')`.
+    """
+
+    def __init__(self, path, encoding=None):
+        self.path = path
+        self.encoding = encoding or locale.getpreferredencoding(False)
+        self._mmap = None
+        self.crlf = False
+
+        with open(path, 'rb') as gcode_file:
+            try:
+                self._mmap = mmap.mmap(gcode_file.fileno(), 0, access=mmap.ACCESS_READ)
+                self.data = self._mmap
+            except ValueError:
+                # empty file, can't be mapped
+                self.data = b''
+
+        if self.data.find(b'\r') >= 0:
+            buffer = np.frombuffer(self.data, dtype=np.uint8)
+            carriage_returns = np.flatnonzero(buffer == ord('\r'))
+            # the byte after each '\r' ('\r' itself for a '\r' ending the file):
+            self.crlf = bool(np.all(buffer[np.minimum(carriage_returns + 1, len(buffer) - 1)] == ord('\n')))
+            del buffer, carriage_returns
+            if not self.crlf:
+                self.close()
+                with open(path, 'r', encoding=self.encoding) as gcode_file:
+                    self.data = gcode_file.read().encode(self.encoding)
+
+        size = len(self.data)
+        buffer = np.frombuffer(self.data, dtype=np.uint8) if size else np.zeros(0, dtype=np.uint8)
+        starts = np.flatnonzero(buffer == ord('\n')) + 1
+        if len(starts) and starts[-1] == size:
+            starts = starts[:-1]
+        self.offsets = array('Q', [0] if size else [])
+        self.offsets.frombytes(starts.astype(np.uint64).tobytes())
+        self.offsets.append(size)
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def close(self):
+        """ Unmaps the file, the object is then empty """
+        if self._mmap is not None:
+            self._mmap.close()
+            self._mmap = None
+        self.data = b''
+        self.offsets = array('Q', [0])
+        self.crlf = False
+
+    def decode(self, begin, end):
+        """ Bytes [begin, end) of the file as a string, with '\\n' line endings """
+        text = self.data[begin:end].decode(self.encoding)
+        return text.replace('\r\n', '\n') if self.crlf else text
+
+    def byte_range(self, start=0, stop=None):
+        """ Byte range [begin, end) of the lines [start, stop), same index rules as a list slice """
+        start, stop, _ = slice(start, stop).indices(len(self))
+        if start >= stop:
+            return 0, 0
+        return self.offsets[start], self.offsets[stop]
+
+    def line(self, index):
+        """ Line `index` with its trailing new line, as `readlines()[index]` """
+        if index < 0:
+            index += len(self)
+        if not 0 <= index < len(self):
+            raise IndexError('line index out of range')
+        return self.decode(self.offsets[index], self.offsets[index + 1])
+
+    def text(self, start=0, stop=None):
+        """ Lines [start, stop) as a single string, as `''.join(readlines()[start:stop])` """
+        return self.decode(*self.byte_range(start, stop))
+
+    def read(self):
+        """ The whole file as a string """
+        return self.text()
+
+    def lines(self, start=0, stop=None):
+        """ Generates the lines [start, stop), decoded by chunks of about CHUNK_SIZE bytes """
+        start, stop, _ = slice(start, stop).indices(len(self))
+        offsets = self.offsets
+        while start < stop:
+            # the chunk ends on a line boundary:
+            chunk_stop = bisect_left(offsets, offsets[start] + CHUNK_SIZE, start + 1, stop)
+            pieces = self.decode(offsets[start], offsets[chunk_stop]).split('\n')
+            last = pieces.pop()
+            for piece in pieces:
+                yield piece + '\n'
+            if last:
+                yield last
+            start = chunk_stop
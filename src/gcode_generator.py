@@ -0,0 +1,394 @@
+"""
+Synthetic additive and subtractive gcode for benchmarks and stress tests.
+
+Generates consistent pairs of input files for the Parser: the additive gcode of a
+cylindrical part printed with one or several tools, in the style of Fusion 360, OrcaSlicer
+or Simplify3D, and the Fusion 360 CAM gcode of operations machining this part (the cuts
+stay inside its footprint and below its top). The CAM operations cycle through planar
+(contour2d, adaptive2d with ramp entries) and non planar (parallel_new and ramp 3D
+surfacing over a large Z range, scallop) strategies, with or without lead in/out moves.
+
+The files are generated layer by layer and operation by operation and written as they
+are produced, so inputs of hundreds of MB don't need to fit in memory. The same shape
+and seed always give the same files.
+
+    python -m src.gcode_generator output/synthetic --slicer orca --tools 3 --size 300
+    python main.py --config output/synthetic/synthetic_config.json
+"""
+import argparse
+import json
+import math
+import os
+import random
+
+from . import utils
+
+SLICERS = ('fusion', 'orca', 'simplify3d')
+
+CAM_STRATEGIES = ('contour2d', 'adaptive2d', 'parallel_new', 'ramp', 'scallop')
+
+DEFAULT_SHAPE = {
+    'slicer': 'fusion',
+    'layers': 400,
+    'layer_height': 0.3,
+    'radius': 40.0,              # radius of the part (mm), centred on the bed centre
+    'tools': 2,                 # additive tools, all used on each layer
+    'moves_per_layer': 100,
+    'operations': 20,
+    'strategies': CAM_STRATEGIES,
+    'lines_per_operation': 2000,
+    'surfacing_height': 20,     # Z range of the parallel_new and ramp operations (mm)
+    'lead_in_out': True,
+    'seed': 0,
+}
+
+CAM_TOOLS = {'contour2d': 'T1', 'adaptive2d': 'T3', 'parallel_new': 'T2', 'ramp': 'T2', 'scallop': 'T4'}
+
+SAFE_HEIGHT = 5     # of the rapid moves above the part (mm)
+
+
+def make_shape(**shape):
+    """ DEFAULT_SHAPE updated with `shape`, checked """
+    unknown = set(shape) - set(DEFAULT_SHAPE)
+    if unknown:
+        raise ValueError(f"Unknown shape parameters: {', '.join(sorted(unknown))}")
+    shape = dict(DEFAULT_SHAPE, **shape)
+    if shape['slicer'] not in SLICERS:
+        raise ValueError(f"Unknown slicer '{shape['slicer']}', expected one of {', '.join(SLICERS)}")
+    unknown = set(shape['strategies']) - set(CAM_STRATEGIES)
+    if unknown or not shape['strategies']:
+        raise ValueError(f"Unknown CAM strategies: {', '.join(sorted(unknown))}")
+    return shape
+
+
+def top_height(shape):
+    return shape['layers'] * shape['layer_height']
+
+
+def move(command, x, y, z=None, feed=None, e=None):
+    """ A 'G0'/'G1' line with the given words """
+    line = f'{command} X{x:.3f} Y{y:.3f}'
+    if z is not None:
+        line += f' Z{z:.3f}'
+    if feed is not None:
+        line += f' F{feed:g}'
+    if e is not None:
+        line += f' E{e:.5f}'
+    return line
+
+
+#
+# Additive gcode
+#
+
+def additive_header(shape):
+    slicer, layers = shape['slicer'], shape['layers']
+    if slicer == 'orca':
+        lines = ['; HEADER_BLOCK_START', '; generated by OrcaSlicer 2.1.1', f'; total layer number: {layers}',
+                 '; HEADER_BLOCK_END', '', '; EXECUTABLE_BLOCK_START', 'M83']
+    elif slicer == 'simplify3d':
+        lines = ['; G-Code generated by Simplify3D(R) Version 4.1.2', f';   layerHeight,{shape["layer_height"]:.4f}',
+                 'G90', 'M82', 'M106 S0']
+    else:
+        lines = [';FLAVOR:Marlin', ';Printer Name: E3D Tool Changer', f'; Layer Count: {layers}',
+                 'G21', 'G90', 'M82']
+    lines += ['T0', 'G92 E0', 'G28', 'G1 Z5 F3000']
+    return lines
+
+
+def additive_layer(shape, layer, extrusion, rand):
+    """
+    The lines of the layer `layer` (1...), each tool printing a sector of the part:
+    a perimeter arc followed by infill lines. `extrusion` {tool: E} is the absolute
+    extrusion of each tool, updated.
+    """
+    slicer, layers, tools = shape['slicer'], shape['layers'], shape['tools']
+    z = layer * shape['layer_height']
+    radius = shape['radius']
+
+    if slicer == 'orca':
+        lines = [';LAYER_CHANGE', f';Z:{z:.3f}', f';HEIGHT:{shape["layer_height"]:g}']
+    elif slicer == 'simplify3d':
+        lines = [f'; layer {layer}, Z = {z:.3f}']
+    else:
+        lines = [f'; layer {layer} of {layers},']
+
+    moves = max(2, shape['moves_per_layer'] // tools)
+    for tool in range(tools):
+        if tools > 1:
+            lines.append(f'T{tool}')
+            if slicer != 'orca':
+                lines.append('G92 E0')
+                extrusion[tool] = 0.0
+        sector = 2 * math.pi / tools
+        start = tool * sector + rand.uniform(0, 0.1)
+        perimeter = moves // 3
+        lines.append(move('G0', radius * math.cos(start), radius * math.sin(start), z if tool == 0 else None, 6000))
+        feed = 1800
+        for step in range(1, perimeter + 1):
+            angle = start + sector * step / perimeter
+            e = rand.uniform(0.02, 0.06)
+            extrusion[tool] += e
+            lines.append(move('G1', radius * math.cos(angle), radius * math.sin(angle), None, feed,
+                              e if slicer == 'orca' else extrusion[tool]))
+            feed = None
+        # infill: chords of the sector
+        for step in range(moves - perimeter):
+            angle = start + sector * rand.random()
+            reach = radius * rand.uniform(0.2, 0.95)
+            e = rand.uniform(0.01, 0.2)
+            extrusion[tool] += e
+            lines.append(move('G1', reach * math.cos(angle), reach * math.sin(angle), None,
+                              1200 if step == 0 else None, e if slicer == 'orca' else extrusion[tool]))
+    return lines
+
+
+def additive_footer(shape):
+    slicer = shape['slicer']
+    park = top_height(shape) + 10
+    if slicer == 'orca':
+        # the last layer, then the config bloc OrcaSlicer writes after the gcode:
+        return ['G1 Z{:.3f} F3000'.format(park), 'M84', '; EXECUTABLE_BLOCK_END', '',
+                '; CONFIG_BLOCK_START', f'; layer_height = {shape["layer_height"]:g}',
+                '; layer_change_gcode = ;LAYER:{layer_num}', '; CONFIG_BLOCK_END']
+    if slicer == 'simplify3d':
+        return ['; layer end', 'M104 S0', f'G1 Z{park:.3f} F3000', 'M84']
+    return ['; move to park position', f'G0 X0 Y0 Z{park:.3f}', '; layer end,', '; END OF GCODE', 'T-1']
+
+
+def additive_gcode(shape):
+    """ Generates the pieces of text (one per layer) of the additive gcode of `shape` """
+    rand = random.Random(shape['seed'])
+    extrusion = {tool: 0.0 for tool in range(shape['tools'])}
+    yield '\n'.join(additive_header(shape)) + '\n'
+    for layer in range(1, shape['layers'] + 1):
+        yield '\n'.join(additive_layer(shape, layer, extrusion, rand)) + '\n'
+    yield '\n'.join(additive_footer(shape)) + '\n'
+
+
+#
+# Subtractive gcode
+#
+
+def lead(kind, x, y, z, shape):
+    """ The lead in/out lines of a cut starting/ending at (x, y, z): 3 radial moves outside of it """
+    if not shape['lead_in_out']:
+        return []
+    angle = math.atan2(y, x)
+    offsets = (3, 2, 1) if kind == 'in' else (1, 2, 3)
+    return [f'(type: lead {kind})'] + [move('G1', x + offset * math.cos(angle), y + offset * math.sin(angle), z, 800)
+                                       for offset in offsets]
+
+
+def contour2d(shape, length, top, rand):
+    """ Planar passes around the part, from the top down """
+    radius = shape['radius'] + 3
+    passes = max(1, length // 50)
+    lines = [move('G0', radius, 0, top + SAFE_HEIGHT)]
+    for height in sorted((rand.uniform(1, top) for _ in range(passes)), reverse=True):
+        lines += lead('in', radius, 0, height, shape)
+        if not shape['lead_in_out']:
+            lines += ['(type: plunge)', move('G1', radius, 0, height, 400)]
+        lines.append('(type: cutting)')
+        steps = max(1, length // passes)
+        for step in range(1, steps + 1):
+            angle = 2 * math.pi * step / steps
+            lines.append(move('G1', radius * math.cos(angle), radius * math.sin(angle), height, 900))
+        lines += lead('out', radius, 0, height, shape)
+        lines += ['(type: rapid)', move('G0', radius, 0, top + SAFE_HEIGHT)]
+    return lines
+
+
+def adaptive2d(shape, length, top, rand):
+    """ Planar pocket levels inside the part, each entered by a helical ramp """
+    radius = shape['radius'] * 0.5
+    levels = max(1, length // 100)
+    depth = min(top - 1, 10)
+    lines = [move('G0', 0, 0, top + SAFE_HEIGHT)]
+    for level in range(1, levels + 1):
+        height = top - depth * level / levels
+        centre_x, centre_y = rand.uniform(-radius, radius) / 2, rand.uniform(-radius, radius) / 2
+        lines.append('(type: ramp)')
+        for step in range(8):
+            angle = 2 * math.pi * step / 8
+            lines.append(move('G1', centre_x + 2 * math.cos(angle), centre_y + 2 * math.sin(angle),
+                              height + 1 - step / 8, 500))
+        lines.append('(type: cutting)')
+        for step in range(max(1, length // levels - 8)):
+            # trochoidal loops spiralling out:
+            reach = min(radius, 2 + step / 20)
+            angle = step / 3
+            lines.append(move('G1', centre_x + reach * math.cos(angle), centre_y + reach * math.sin(angle),
+                              height, 1500))
+        lines += ['(type: rapid)', move('G0', centre_x, centre_y, top + SAFE_HEIGHT)]
+    return lines
+
+
+def parallel_new(shape, length, top, rand):
+    """ 3D surfacing of a dome down to `surfacing_height` mm under the top, by parallel rows """
+    radius = shape['radius']
+    bottom = max(shape['layer_height'], top - shape['surfacing_height'])
+    rows = max(1, length // 100)
+    columns = max(2, length // rows)
+    sharpness = rand.uniform(0.3, 0.6) * radius * radius
+
+    def surface(x, y):
+        return bottom + (top - bottom) * math.exp(-(x * x + y * y) / sharpness)
+
+    lines = [move('G0', -radius, -radius, top + SAFE_HEIGHT)]
+    for row in range(rows):
+        y = -radius + 2 * radius * (row + 0.5) / rows
+        x = -radius if row % 2 == 0 else radius
+        if row:
+            lines += ['(type: rapid)', move('G0', x, y, top + SAFE_HEIGHT)]
+        if shape['lead_in_out']:
+            lines += ['(type: lead in)', move('G1', x, y, surface(x, y) + 1, 800)]
+        lines.append('(type: cutting)')
+        for column in range(columns):
+            x = -radius + 2 * radius * column / (columns - 1)
+            if row % 2:
+                x = -x
+            lines.append(move('G1', x, y, surface(x, y), 1000))
+        if shape['lead_in_out']:
+            lines += ['(type: lead out)', move('G1', x, y, surface(x, y) + 1, 1000)]
+    return lines
+
+
+def ramp(shape, length, top, rand):
+    """ 3D finishing of the wall of the part by a continuous descending spiral """
+    radius = shape['radius'] + 3
+    bottom = max(shape['layer_height'], top - shape['surfacing_height'])
+    turns = max(1, length // 200)
+    lines = [move('G0', radius, 0, top + SAFE_HEIGHT)]
+    lines += lead('in', radius, 0, top, shape)
+    lines.append('(type: cutting)')
+    for step in range(length):
+        angle = 2 * math.pi * turns * step / length
+        lines.append(move('G1', radius * math.cos(angle), radius * math.sin(angle),
+                          top - (top - bottom) * step / length, 900))
+    return lines
+
+
+def scallop(shape, length, top, rand):
+    """ Non planar finishing of the top of the part by concentric rings on a shallow dome """
+    radius = shape['radius'] * 0.9
+    rings = max(1, length // 100)
+    steps = max(2, length // rings)
+
+    def surface(x, y, angle):
+        return top - 0.5 - 2 * (x * x + y * y) / (radius * radius) - 0.2 * math.sin(3 * angle)
+
+    lines = [move('G0', radius, 0, top + SAFE_HEIGHT)]
+    for ring in range(rings, 0, -1):
+        reach = radius * ring / rings
+        if ring < rings:
+            lines += ['(type: transition)', move('G1', reach, 0, surface(reach, 0, 0), 1200)]
+        lines.append('(type: cutting)')
+        for step in range(1, steps + 1):
+            angle = 2 * math.pi * step / steps
+            x, y = reach * math.cos(angle), reach * math.sin(angle)
+            lines.append(move('G1', x, y, surface(x, y, angle), 1200))
+    lines += ['(type: rapid)', move('G0', 0, 0, top + SAFE_HEIGHT)]
+    return lines
+
+
+STRATEGY_MOVES = {'contour2d': contour2d, 'adaptive2d': adaptive2d, 'parallel_new': parallel_new,
+                  'ramp': ramp, 'scallop': scallop}
+
+
+def cam_operation(shape, number, top, rand):
+    """ The lines of the CAM operation `number` (0...) """
+    strategy = shape['strategies'][number % len(shape['strategies'])]
+    name = ''.join(word.capitalize() for word in strategy.split('_'))
+    lines = [f'({name}{number})', f'(strategy: {strategy})', CAM_TOOLS[strategy], 'M3 S14000']
+    lines += STRATEGY_MOVES[strategy](shape, shape['lines_per_operation'], top, rand)
+    return lines
+
+
+def cam_gcode(shape):
+    """ Generates the pieces of text (one per operation) of the CAM gcode of `shape` """
+    rand = random.Random(shape['seed'] + 1)
+    top = top_height(shape)
+    for number in range(shape['operations']):
+        separator = '\n\n' if number else ''
+        yield separator + '\n'.join(cam_operation(shape, number, top, rand))
+    yield '\n'
+
+
+#
+# Pairs of files
+#
+
+def fit_size(shape, size_bytes):
+    """
+    `shape` with its moves per layer and lines per operation scaled for a pair of files
+    of about `size_bytes` bytes, half additive and half subtractive
+    """
+    sample = dict(shape, layers=min(shape['layers'], 20), moves_per_layer=200,
+                  operations=len(shape['strategies']), lines_per_operation=200)
+    additive_bytes = sum(len(piece) for piece in additive_gcode(sample)) / (sample['layers'] * 200)
+    cam_bytes = sum(len(piece) for piece in cam_gcode(sample)) / (sample['operations'] * 200)
+    return dict(shape,
+                moves_per_layer=max(10, round(size_bytes / 2 / additive_bytes / shape['layers'])),
+                lines_per_operation=max(10, round(size_bytes / 2 / cam_bytes / shape['operations'])))
+
+
+def merge_config(additive_path, subtractive_path, shape, filename='merged'):
+    """ A Parser config merging the pair of files, its log goes next to them """
+    return {
+        'InputFiles': {'additive_gcode': additive_path, 'subtractive_gcode': subtractive_path},
+        'Printer': {'bed_centre_x': 0, 'bed_centre_y': 0},
+        'PrintSettings': {'raft_height': 0},
+        'CamSettings': {'layer_overlap': 2, 'layer_dropdown': 0,
+                        'zRangeMax_3Dsurfacing_mm': 5, 'zOverlap_3Dsurfacing_mm': 0.75},
+        'OutputSettings': {'filename': filename},
+        'Flags': {'append_AddSubGcode': 0},
+        'Logging': {'file': os.path.join(os.path.dirname(additive_path), filename + '.log')},
+    }
+
+
+def write_pair(folder, name='synthetic', **shape):
+    """
+    Writes <name>_additive.gcode and <name>_subtractive.gcode of the shape `shape`
+    (see DEFAULT_SHAPE) in `folder`, returns the config to merge them
+    """
+    shape = make_shape(**shape)
+    os.makedirs(folder, exist_ok=True)
+    paths = []
+    for kind, pieces in (('additive', additive_gcode(shape)), ('subtractive', cam_gcode(shape))):
+        path = os.path.join(folder, f'{name}_{kind}.gcode')
+        with open(path, 'w') as gcode_file:
+            utils.write_chunks(pieces, gcode_file)
+        paths.append(path)
+    return merge_config(*paths, shape, filename=name)
+
+
+if __name__ == '__main__':
+    arg_parser = argparse.ArgumentParser(description='synthetic additive & subtractive gcode generator')
+    arg_parser.add_argument('folder', help='output folder')
+    arg_parser.add_argument('--name', default='synthetic', help='prefix of the files (default: synthetic)')
+    arg_parser.add_argument('--slicer', choices=SLICERS, default=DEFAULT_SHAPE['slicer'])
+    arg_parser.add_argument('--size', type=float, metavar='MB',
+                            help='approximate size of the pair of files, sets the moves per layer '
+                                 'and the lines per operation')
+    for key, value in DEFAULT_SHAPE.items():
+        if isinstance(value, (int, float)) and not isinstance(value, bool) and key != 'seed':
+            arg_parser.add_argument('--' + key.replace('_', '-'), type=type(value), default=value)
+    arg_parser.add_argument('--strategies', default=','.join(CAM_STRATEGIES),
+                            help='comma separated CAM strategies, cycled through by the operations')
+    arg_parser.add_argument('--no-lead', action='store_true', help='no lead in/out moves')
+    arg_parser.add_argument('--seed', type=int, default=DEFAULT_SHAPE['seed'])
+    args = arg_parser.parse_args()
+
+    shape = make_shape(**{key: getattr(args, key) for key in DEFAULT_SHAPE if key not in ('strategies', 'lead_in_out')},
+                       strategies=tuple(args.strategies.split(',')), lead_in_out=not args.no_lead)
+    if args.size:
+        shape = fit_size(shape, args.size * 1e6)
+
+    config = write_pair(args.folder, args.name, **shape)
+    config_path = os.path.join(args.folder, args.name + '_config.json')
+    with open(config_path, 'w') as config_file:
+        json.dump(config, config_file, indent=4)
+    for path in config['InputFiles'].values():
+        print(f'{path}: {os.path.getsize(path) / 1e6:.1f} MB')
+    print(config_path)
@@ -0,0 +1,73 @@
+"""
+Streaming G-code lexer shared by the additive and subtractive parsers.
+
+Each line is tokenised once into a `GcodeRecord` holding the command, the
+X/Y/Z/E/F words as floats, the comment and its tag. `iter_records` lexes the
+lines lazily, so that only one line is held in memory at a time.
+"""
+from collections import namedtuple
+
+AXES = 'XYZEF'
+
+GcodeRecord = namedtuple('GcodeRecord', ['line', 'command', 'params', 'fields', 'comment', 'tag'])
+GcodeRecord.__doc__ = """
+One lexed line of gcode.
+
+- line:    the raw line, as read (trailing new line kept if present)
+- command: first word of the line ('G1', 'M83', 'T0'...), None for comments, blank lines and
+           the lines starting with an axis word (modal motion lines 'X.. Y.. Z..')
+- params:  {'X': float, ...} for the X/Y/Z/E/F words of the line
+- fields:  tuple of the words of the code part of the line
+- comment: text of the '(...)' or ';' comment, None if there is no comment
+- tag:     (key, value) extracted from the comment, e.g. ('type', 'cutting') for
+           '(type: cutting)', ('layer', '3 of 40,') for '; layer 3 of 40,' or
+           ('Z', '0.2') for ';Z:0.2'. None if there is no comment.
+"""
+
+
+def parse_tag(comment):
+    """ Splits a comment into a (key, value) tag on the first ':' or, failing that, the first space """
+    key, sep, value = comment.partition(':')
+    if not sep:
+        key, sep, value = comment.partition(' ')
+    return key.strip(), value.strip()
+
+
+def parse_line(line):
+    """ Tokenises a single line of gcode into a GcodeRecord """
+    text = line.rstrip('\r\n')
+
+    comment = None
+    tag = None
+    code = text
+    semicolon = text.find(';')
+    bracket = text.find('(')
+    if semicolon >= 0 or bracket >= 0:
+        if semicolon < 0 or (0 <= bracket < semicolon):
+            code, comment = text[:bracket], text[bracket + 1:]
+            if comment.endswith(')'):
+                comment = comment[:-1]
+        else:
+            code, comment = text[:semicolon], text[semicolon + 1:]
+        comment = comment.strip()
+        if comment:
+            tag = parse_tag(comment)
+
+    fields = tuple(code.split())
+    params = {}
+    for field in fields:
+        if field[0] in AXES:
+            try:
+                params[field[0]] = float(field[1:])
+            except ValueError:
+                pass
+
+    command = fields[0] if fields and fields[0][0] not in AXES else None
+
+    return GcodeRecord(line, command, params, fields, comment, tag)
+
+
+def iter_records(lines):
+    """ Lazily lexes an iterable of gcode lines """
+    for line in lines:
+        yield parse_line(line)
@@ -0,0 +1,192 @@
+"""
+Content-addressed on-disk cache of the parsed inputs.
+
+An entry is a `.npz` file named after the hash of the input bytes, of the config
+fields the parsing depends on and of PARSER_VERSION. It holds either the parsed
+additive gcode (relative gcode + AdditiveLayerTable + layer names) or the parsed
+CAM operations (the columns of their CamGcodeBlock and their layer slices).
+The least recently used entries are removed when the folder exceeds its size limit.
+"""
+import hashlib
+import json
+import os
+import numpy as np
+
+from .additive_gcode import AdditiveLayerTable
+from .cam_gcode import LINE_TYPE_NAMES, CamGcodeBlock
+
+# to be increased each time the parsed data changes for the same inputs:
+PARSER_VERSION = 4
+
+TABLE_FIELDS = ('starts', 'stops', 'min_z', 'max_z', 'heights', 'first_tools', 'last_tools', 'opens_with_tool')
+BLOCK_FIELDS = ('commands', 'x', 'y', 'z', 'feeds', 'types')
+
+
+class ParseCache:
+    """ Cache folder of parsed inputs, `size_limit` is in bytes """
+
+    def __init__(self, folder, size_limit=512 * 2**20):
+        self.folder = os.path.expanduser(folder)
+        self.size_limit = size_limit
+        os.makedirs(self.folder, exist_ok=True)
+
+    @classmethod
+    def from_config(cls, config):
+        """ The cache of the optional 'Cache' section of the config, None if there is none """
+        settings = config.get('Cache')
+        if not settings or not settings.get('folder'):
+            return None
+        size_limit = settings.get('size_limit_MB', 512) * 2**20
+        return cls(settings['folder'], size_limit)
+
+    @staticmethod
+    def key(kind, data, fields=None):
+        """ Hash of the kind of entry, the bytes of the input `data`, the config `fields` and the parser version """
+        digest = hashlib.sha256(data)
+        digest.update(json.dumps([kind, PARSER_VERSION, fields], sort_keys=True).encode())
+        return f'{kind}-{digest.hexdigest()}'
+
+    def path(self, key):
+        return os.path.join(self.folder, key + '.npz')
+
+    def load(self, key):
+        """ The arrays of the entry `key`, or None if it is not in the cache """
+        path = self.path(key)
+        try:
+            with np.load(path, allow_pickle=False) as entry:
+                arrays = {name: entry[name] for name in entry.files}
+        except (OSError, ValueError, KeyError):
+            return None
+        try:
+            os.utime(path)  # most recently used
+        except FileNotFoundError:
+            pass            # evicted by another process since, the arrays are read
+        return arrays
+
+    def store(self, key, arrays):
+        """ Saves the entry `key` then removes the least recently used entries over the size limit """
+        import tempfile     # slow to import, only needed for a new entry
+        handle, tmp_path = tempfile.mkstemp(suffix='.tmp', dir=self.folder)
+        try:
+            with os.fdopen(handle, 'wb') as entry:
+                np.savez(entry, **arrays)
+            os.replace(tmp_path, self.path(key))
+        except OSError:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+            return
+        self.evict()
+
+    def evict(self):
+        entries = []
+        for name in os.listdir(self.folder):
+            if name.endswith('.npz'):
+                try:
+                    stat = os.stat(os.path.join(self.folder, name))
+                except FileNotFoundError:
+                    continue    # removed by another process sharing the cache
+                entries.append((stat.st_mtime, stat.st_size, name))
+        entries.sort()
+
+        total = sum(size for _, size, _ in entries)
+        for _, size, name in entries:
+            if total <= self.size_limit:
+                break
+            try:
+                os.remove(os.path.join(self.folder, name))
+            except OSError:
+                pass
+            total -= size
+
+
+def strings(values):
+    return np.array(values, dtype=str)
+
+
+def split_counts(values, counts):
+    """ Splits the array `values` into lists of `counts` items """
+    return [part.tolist() for part in np.split(values, np.cumsum(counts)[:-1])] if len(counts) else []
+
+
+def pack_additive(gcode, table, names, ORCA):
+    """ Arrays of a parsed additive gcode: the relative gcode, its AdditiveLayerTable and the layer names """
+    arrays = {field: getattr(table, field) for field in TABLE_FIELDS}
+    arrays.update(
+        gcode=np.frombuffer(gcode.encode(), dtype=np.uint8),
+        tools=strings(table.tools),
+        names=strings(names),
+        ORCA=np.array(ORCA),
+    )
+    return arrays
+
+
+def unpack_additive(arrays):
+    """ Returns (gcode, table, names, ORCA) from the arrays of pack_additive """
+    table = AdditiveLayerTable(*(arrays[field] for field in TABLE_FIELDS), arrays['tools'].tolist())
+    return arrays['gcode'].tobytes().decode(), table, arrays['names'].tolist(), bool(arrays['ORCA'])
+
+
+def pack_cam_operations(operations):
+    """
+    Arrays of the parsed CAM operations (lists of CamGcodeLayer): the columns of the
+    CamGcodeBlock of each operation one after the other, and the range of segments of each layer
+    """
+    blocks = [operation[0].segments[0].block for operation in operations]
+    first_layers = [operation[0] for operation in operations]
+
+    arrays = {field: np.concatenate([getattr(block, field) for block in blocks])
+              if blocks else np.zeros(0) for field in BLOCK_FIELDS}
+    arrays.update(
+        block_sizes=np.array([len(block) for block in blocks], dtype=np.int64),
+        command_names=strings([name for block in blocks for name in block.command_names]),
+        command_counts=np.array([len(block.command_names) for block in blocks], dtype=np.int64),
+        feed_names=strings([name for block in blocks for name in block.feed_names]),
+        feed_counts=np.array([len(block.feed_names) for block in blocks], dtype=np.int64),
+        # only the names of the types which are not LineType codes:
+        type_names=strings([name for block in blocks for name in block.type_names[len(LINE_TYPE_NAMES):]]),
+        type_counts=np.array([len(block.type_names) - len(LINE_TYPE_NAMES) for block in blocks], dtype=np.int64),
+        extra_operations=np.array([i for i, block in enumerate(blocks) for _ in block.extra], dtype=np.int64),
+        extra_indexes=np.array([index for block in blocks for index in block.extra], dtype=np.int64),
+        extra_lines=strings([line for block in blocks for line in block.extra.values()]),
+        operation_names=strings([layer.name for layer in first_layers]),
+        operation_strategies=strings([layer.strategy for layer in first_layers]),
+        operation_tools=strings([layer.tool for layer in first_layers]),
+        operation_start_tools=strings([layer.start_tool or '' for layer in first_layers]),
+        operation_has_start_tool=np.array([layer.start_tool is not None for layer in first_layers], dtype=bool),
+        layer_operations=np.array([i for i, operation in enumerate(operations) for _ in operation], dtype=np.int64),
+        layer_segments=np.array([(layer.segments[0].index, layer.segments[-1].index + 1)
+                                 for operation in operations for layer in operation], dtype=np.int64).reshape(-1, 2),
+    )
+    return arrays
+
+
+def unpack_cam_operations(arrays):
+    """
+    Returns a list of (block, layer segment ranges, name, strategy, tool, start_tool) per operation
+    from the arrays of pack_cam_operations
+    """
+    sizes = arrays['block_sizes']
+    bounds = np.concatenate(([0], np.cumsum(sizes)))
+    command_names = split_counts(arrays['command_names'], arrays['command_counts'])
+    feed_names = split_counts(arrays['feed_names'], arrays['feed_counts'])
+    type_names = split_counts(arrays['type_names'], arrays['type_counts'])
+
+    extras = [{} for _ in sizes]
+    for i, index, line in zip(arrays['extra_operations'].tolist(), arrays['extra_indexes'].tolist(),
+                              arrays['extra_lines'].tolist()):
+        extras[i][index] = line
+
+    layer_segments = [[] for _ in sizes]
+    for i, (first, stop) in zip(arrays['layer_operations'].tolist(), arrays['layer_segments'].tolist()):
+        layer_segments[i].append((first, stop))
+
+    operations = []
+    for i in range(len(sizes)):
+        start, stop = bounds[i], bounds[i + 1]
+        block_type_names = list(LINE_TYPE_NAMES) + type_names[i] if type_names[i] else LINE_TYPE_NAMES
+        block = CamGcodeBlock(*(arrays[field][start:stop] for field in BLOCK_FIELDS),
+                              command_names[i], feed_names[i], block_type_names, extras[i])
+        start_tool = str(arrays['operation_start_tools'][i]) if arrays['operation_has_start_tool'][i] else None
+        operations.append((block, layer_segments[i], str(arrays['operation_names'][i]),
+                           str(arrays['operation_strategies'][i]), str(arrays['operation_tools'][i]), start_tool))
+    return operations
@@ -0,0 +1,169 @@
+"""
+Per-stage profile of a run of the Parser.
+
+A StageProfiler given to the Parser records, for each stage of the run (open, convert
+relative, split additive, preprocess subtractive, split CAM, order, merge, script, write):
+its wall and CPU times, the peak of the memory traced by tracemalloc during the stage,
+and the size in bytes and lines (or the number of items) of its input and output.
+The report is a dict saved as JSON, the stages can also be saved as a Chrome trace-event
+file (chrome://tracing, https://ui.perfetto.dev).
+
+    profiler = StageProfiler()
+    Parser(config, profiler=profiler).create_output_file()
+    profiler.write_json('profile.json')
+    profiler.write_trace('profile.trace.json')
+"""
+import json
+import os
+import time
+import tracemalloc
+from contextlib import contextmanager
+
+from .gcode_file import GcodeFile
+
+READ_SIZE = 1 << 20
+
+
+def measure(value):
+    """
+    Size of the input or output `value` of a stage: {'bytes': , 'lines': } for gcode
+    (str, bytes, GcodeFile, path of a file or iterable of str pieces), {'items': } for a
+    list of layers or operations
+    """
+    if isinstance(value, str):
+        return {'bytes': len(value.encode()), 'lines': value.count('\n')}
+    if isinstance(value, (bytes, bytearray)):
+        return {'bytes': len(value), 'lines': value.count(b'\n')}
+    if isinstance(value, GcodeFile):
+        return {'bytes': len(value.data), 'lines': len(value)}
+    if isinstance(value, os.PathLike):
+        size, lines = 0, 0
+        with open(value, 'rb') as gcode_file:
+            for chunk in iter(lambda: gcode_file.read(READ_SIZE), b''):
+                size += len(chunk)
+                lines += chunk.count(b'\n')
+        return {'bytes': size, 'lines': lines}
+    if isinstance(value, (list, tuple)) and not (value and isinstance(value[0], str)):
+        return {'items': len(value)}
+    # iterable of str pieces:
+    size, lines = 0, 0
+    for piece in value:
+        size += len(piece.encode())
+        lines += piece.count('\n')
+    return {'bytes': size, 'lines': lines}
+
+
+class StageRecord:
+    """ Measures of one stage, its input and output are only measured once the stage is over """
+
+    def __init__(self, name):
+        self.name = name
+        self.start = None
+        self.wall_s = None
+        self.cpu_s = None
+        self.peak_memory_bytes = None
+        self.inputs = []
+        self.outputs = []
+        self.input = {}
+        self.output = {}
+
+    def add_input(self, *values):
+        self.inputs += values
+
+    def add_output(self, *values):
+        self.outputs += values
+
+    def measure(self):
+        """ Replaces the inputs and outputs by their sizes """
+        for values, sizes in ((self.inputs, self.input), (self.outputs, self.output)):
+            for value in values:
+                for key, size in measure(value).items():
+                    sizes[key] = sizes.get(key, 0) + size
+        self.inputs, self.outputs = [], []
+
+    def as_dict(self):
+        return {
+            'name': self.name,
+            'start_s': self.start,
+            'wall_s': self.wall_s,
+            'cpu_s': self.cpu_s,
+            'peak_memory_bytes': self.peak_memory_bytes,
+            'input': self.input,
+            'output': self.output,
+        }
+
+
+class StageProfiler:
+    """
+    Profile of the stages of a run, see the module docstring.
+    `memory`: trace the memory allocations with tracemalloc, which slows the run down.
+    """
+
+    def __init__(self, memory=True):
+        self.memory = memory
+        self.stages = []
+        self.origin = time.perf_counter()
+
+    @contextmanager
+    def stage(self, name):
+        """ Context manager measuring the stage `name`, yields its StageRecord """
+        record = StageRecord(name)
+        started_tracing = False
+        if self.memory:
+            if not tracemalloc.is_tracing():
+                tracemalloc.start()
+                started_tracing = True
+            tracemalloc.reset_peak()
+            memory_start = tracemalloc.get_traced_memory()[0]
+
+        cpu_start = time.process_time()
+        wall_start = time.perf_counter()
+        try:
+            yield record
+        finally:
+            record.wall_s = time.perf_counter() - wall_start
+            record.cpu_s = time.process_time() - cpu_start
+            record.start = wall_start - self.origin
+            if self.memory:
+                # the peak of the memory allocated during the stage:
+                record.peak_memory_bytes = tracemalloc.get_traced_memory()[1] - memory_start
+                if started_tracing:
+                    tracemalloc.stop()
+            record.measure()
+            self.stages.append(record)
+
+    def report(self):
+        """ The profile as a dict: the stages in the order they ended, and their total """
+        stages = [record.as_dict() for record in self.stages]
+        total = {
+            'wall_s': sum(stage['wall_s'] for stage in stages),
+            'cpu_s': sum(stage['cpu_s'] for stage in stages),
+            'peak_memory_bytes': max((stage['peak_memory_bytes'] or 0 for stage in stages), default=0)
+                                 if self.memory else None,
+        }
+        return {'stages': stages, 'total': total}
+
+    def write_json(self, path):
+        """ Saves the report in the JSON file `path` """
+        with open(path, 'w') as report_file:
+            json.dump(self.report(), report_file, indent=4)
+
+    def write_trace(self, path):
+        """ Saves the stages as complete events of a Chrome trace-event file `path` """
+        events = [{
+            'name': record.name,
+            'cat': 'stage',
+            'ph': 'X',
+            'ts': record.start * 1e6,
+            'dur': record.wall_s * 1e6,
+            'pid': os.getpid(),
+            'tid': 0,
+            'args': {
+                'cpu_s': record.cpu_s,
+                'peak_memory_bytes': record.peak_memory_bytes,
+                'input': record.input,
+                'output': record.output,
+            },
+        } for record in self.stages]
+        with open(path, 'w') as trace_file:
+            json.dump({'traceEvents': events, 'displayTimeUnit': 'ms'}, trace_file)
@@ -0,0 +1,230 @@
+"""
+Waiting for files and toolpath futures without spinning a core.
+
+The waits check their condition, then sleep with a backoff (FIRST_DELAY doubled up to
+MAX_DELAY) until the next check. On Linux the sleeps are cut short by inotify events of
+the folders of the files waited for, elsewhere the files are polled with os.stat.
+A file is ready once it exists, can be opened for reading (Windows locks the files being
+written) and its size and modification time have not changed for `stable_for` seconds.
+
+Every wait takes a `timeout` (TimeoutError), a `cancel` (threading.Event or function
+returning True, WaitCancelled) and an `on_wait` function called before each sleep, to
+keep the Fusion UI alive with adsk.doEvents. Nothing here depends on Fusion: a future
+only needs the isGenerationCompleted and numberOfCompleted attributes of a Fusion
+GenerateToolpathFuture, see the demo:
+
+    python -m src.readiness
+
+The waits are tested in tests/test_readiness.py (python -m pytest).
+"""
+import ctypes
+import ctypes.util
+import os
+import select
+import sys
+import time
+
+FIRST_DELAY = 0.005     # s before the second check
+MAX_DELAY = 0.25        # s between two checks
+STABLE_FOR = 0.2        # s without change of a file before it is ready
+
+
+class WaitCancelled(Exception):
+    pass
+
+
+def is_set(cancel):
+    if cancel is None:
+        return False
+    if hasattr(cancel, 'is_set'):
+        return cancel.is_set()
+    return bool(cancel())
+
+
+class FolderEvents:
+    """
+    Context manager waking the waits when something happens in `folders`: inotify on
+    Linux, a plain sleep elsewhere or when inotify is not available
+    """
+    IN_MODIFY = 0x002
+    IN_ATTRIB = 0x004
+    IN_CLOSE_WRITE = 0x008
+    IN_MOVED_FROM = 0x040
+    IN_MOVED_TO = 0x080
+    IN_CREATE = 0x100
+    IN_DELETE = 0x200
+    IN_NONBLOCK = 0o4000
+    IN_CLOEXEC = 0o2000000
+    MASK = IN_MODIFY | IN_ATTRIB | IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO | IN_CREATE | IN_DELETE
+
+    def __init__(self, folders=()):
+        self.folders = [folder for folder in folders if os.path.isdir(folder)]
+        self.fd = None
+
+    def __enter__(self):
+        if self.folders and sys.platform == 'linux':
+            try:
+                libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+                fd = libc.inotify_init1(self.IN_NONBLOCK | self.IN_CLOEXEC)
+                if fd >= 0:
+                    self.fd = fd
+                    for folder in self.folders:
+                        libc.inotify_add_watch(fd, os.fsencode(folder), self.MASK)
+            except (OSError, AttributeError):
+                self.close()
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def close(self):
+        if self.fd is not None:
+            os.close(self.fd)
+            self.fd = None
+
+    def wait(self, timeout):
+        """ Sleeps for `timeout` seconds at most, returns True if woken by an event """
+        if self.fd is None:
+            time.sleep(timeout)
+            return False
+        readable, _, _ = select.select([self.fd], [], [], timeout)
+        if not readable:
+            return False
+        try:
+            while os.read(self.fd, 65536):     # the events are not needed, only the wake up
+                pass
+        except BlockingIOError:
+            pass
+        return True
+
+
+def wait_until(condition, timeout=None, cancel=None, on_wait=None, folders=(), description='condition',
+               first_delay=FIRST_DELAY, max_delay=MAX_DELAY):
+    """
+    Waits until `condition()` is true, returns its value. The sleeps between two checks grow
+    from `first_delay` to `max_delay`, and start again from `first_delay` after an event in
+    one of the `folders`. Raises TimeoutError after `timeout` seconds (None: no limit) and
+    WaitCancelled when `cancel` is set.
+    """
+    deadline = None if timeout is None else time.monotonic() + timeout
+    delay = first_delay
+    with FolderEvents(folders) as events:
+        while True:
+            result = condition()
+            if result:
+                return result
+            if is_set(cancel):
+                raise WaitCancelled(f'Cancelled while waiting for {description}')
+            now = time.monotonic()
+            if deadline is not None and now >= deadline:
+                raise TimeoutError(f'Timed out after {timeout:g} s waiting for {description}')
+            if on_wait is not None:
+                on_wait()
+            sleep = delay if deadline is None else min(delay, deadline - now)
+            delay = first_delay if events.wait(sleep) else min(2 * delay, max_delay)
+
+
+def readable_signature(path):
+    """ (size, modification time) of the file `path`, None if it is missing or can't be read yet """
+    try:
+        stat = os.stat(path)
+        with open(path, 'rb'):
+            pass
+    except (FileNotFoundError, PermissionError):
+        return None
+    return stat.st_size, stat.st_mtime_ns
+
+
+def wait_for_files(paths, timeout=10, stable_for=STABLE_FOR, cancel=None, on_wait=None):
+    """ Waits until the files `paths` are ready (see the module docstring) """
+    paths = [os.path.abspath(path) for path in paths]
+    seen = {}   # {path: (signature, time it was first seen)}
+
+    def ready():
+        now = time.monotonic()
+        all_ready = True
+        for path in paths:
+            signature = readable_signature(path)
+            if signature is None:
+                seen.pop(path, None)
+                all_ready = False
+                continue
+            if path not in seen or seen[path][0] != signature:
+                seen[path] = (signature, now)
+            if now - seen[path][1] < stable_for:
+                all_ready = False
+        return all_ready
+
+    try:
+        wait_until(ready, timeout, cancel, on_wait, folders={os.path.dirname(path) for path in paths},
+                   description=', '.join(paths))
+    except TimeoutError:
+        missing = [path for path in paths if not os.path.exists(path)]
+        if missing:
+            raise TimeoutError(f"Posting timed out, file not written: {', '.join(missing)}") from None
+        raise TimeoutError(f"Posting timed out, file still written or locked: {', '.join(paths)}") from None
+
+
+def wait_for_removal(path, timeout=10, cancel=None, on_wait=None):
+    """ Waits until the file `path` does not exist any more """
+    wait_until(lambda: not os.path.exists(path), timeout, cancel, on_wait,
+               folders=[os.path.dirname(os.path.abspath(path))], description=f'the removal of {path}')
+
+
+def wait_for_future(future, timeout=None, cancel=None, on_wait=None, period=0.125):
+    """ Waits until the toolpaths of `future` are generated, `on_wait` is called every `period` seconds """
+    wait_until(lambda: future.isGenerationCompleted, timeout, cancel, on_wait,
+               description='the toolpaths', first_delay=period, max_delay=period)
+
+
+if __name__ == '__main__':
+    # demo without Fusion: a writer process and a fake future, and the CPU time of the waits
+    import subprocess
+    import tempfile
+    import threading
+
+    class FakeToolpathFuture:
+        """ GenerateToolpathFuture of `operations` toolpaths taking `duration` seconds each """
+
+        def __init__(self, operations, duration):
+            self.numberOfOperations = operations
+            self.start = time.monotonic()
+            self.duration = duration
+
+        @property
+        def numberOfCompleted(self):
+            return min(self.numberOfOperations, int((time.monotonic() - self.start) / self.duration))
+
+        @property
+        def isGenerationCompleted(self):
+            return self.numberOfCompleted == self.numberOfOperations
+
+    writer = ("import sys, time\n"
+              "with open(sys.argv[1], 'w') as f:\n"
+              "    for i in range(10):\n"
+              "        f.write('G1 X%d\\n' % i); f.flush(); time.sleep(0.1)\n")
+
+    with tempfile.TemporaryDirectory() as folder:
+        path = os.path.join(folder, 'tmpSubtractive.gcode')
+        cpu, start = time.process_time(), time.perf_counter()
+        process = subprocess.Popen([sys.executable, '-c', writer, path])
+        wait_for_files([path], timeout=10)
+        print(f'file ready after {time.perf_counter() - start:.2f} s, writer done: {process.poll() is not None}, '
+              f'{time.process_time() - cpu:.3f} s CPU')
+        process.wait()
+
+        cpu, start = time.process_time(), time.perf_counter()
+        future = FakeToolpathFuture(4, 0.25)
+        wait_for_future(future, timeout=10)
+        print(f'toolpaths generated after {time.perf_counter() - start:.2f} s, {time.process_time() - cpu:.3f} s CPU')
+
+        cancel = threading.Event()
+        threading.Timer(0.3, cancel.set).start()
+        try:
+            wait_for_files([os.path.join(folder, 'never.gcode')], timeout=10, cancel=cancel)
+        except WaitCancelled as error:
+            print(error)
+        try:
+            wait_for_future(FakeToolpathFuture(4, 10), timeout=0.5)
+        except TimeoutError as error:
+            print(error)
@@ -0,0 +1,64 @@
+"""
+Log of a run of the Parser.
+
+The messages go through the 'asmbl' logger, see `logger`. A RunLog installs one buffered
+handler on it for the time of a run: the records are kept in memory and written to the
+log file in batches, when the buffer is full, on an error and at the end of the run.
+The level and the file are taken from the optional 'Logging' section of the config,
+the debug messages are off by default. Callers in loops check `logger.isEnabledFor`
+before building their messages, so a disabled level costs nothing.
+"""
+import logging
+import os
+import sys
+from logging.handlers import MemoryHandler
+
+logger = logging.getLogger('asmbl')
+
+DEFAULT_LEVEL = 'INFO'
+BUFFER_RECORDS = 1000   # number of records written at once
+
+
+def default_log_path(config):
+    """ <output folder>/<filename>.log """
+    if sys.platform == 'linux':
+        output_folder = './output'
+    else:
+        output_folder = os.path.expanduser('~/N-Fab/output/')
+    return os.path.join(output_folder, config['OutputSettings']['filename'] + '.log')
+
+
+class RunLog:
+    """
+    Context manager of the log of one run configured by the 'Logging' section of `config`:
+    {'level': 'DEBUG' | 'INFO' | ..., 'file': path of the log file, 'buffer': number of records}
+    """
+
+    def __init__(self, config):
+        settings = config.get('Logging') or {}
+        self.level = logging.getLevelName(str(settings.get('level') or DEFAULT_LEVEL).upper())
+        if not isinstance(self.level, int):
+            raise ValueError(f"Unknown log level '{settings['level']}'")
+        self.path = os.path.expanduser(settings.get('file') or default_log_path(config))
+        self.buffer = settings.get('buffer', BUFFER_RECORDS)
+        self.handler = None
+        self.file_handler = None
+        self.previous_level = None
+
+    def __enter__(self):
+        os.makedirs(os.path.dirname(self.path) or '.', exist_ok=True)
+        # the file is only created (and the previous log replaced) by the first record written:
+        self.file_handler = logging.FileHandler(self.path, mode='w', delay=True)
+        self.file_handler.setFormatter(logging.Formatter('%(message)s'))
+        self.handler = MemoryHandler(self.buffer, flushLevel=logging.ERROR, target=self.file_handler)
+        self.previous_level = logger.level
+        logger.setLevel(self.level)
+        logger.addHandler(self.handler)
+        return self
+
+    def __exit__(self, *exc):
+        logger.removeHandler(self.handler)
+        logger.setLevel(self.previous_level)
+        self.handler.close()    # writes the buffered records
+        self.file_handler.close()
+        self.handler, self.file_handler = None, None
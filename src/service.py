@@ -0,0 +1,500 @@
+"""
+Local merge service: a server merging the jobs of several clients in a pool of worker
+processes kept running, so that a merge pays neither the start of the interpreter nor
+the imports, and the parse cache is shared by all the jobs.
+
+The server listens on a localhost TCP port ('127.0.0.1:8765') or on a Unix socket
+('unix:/tmp/nfab.sock') and speaks HTTP with JSON:
+
+- PUT /inputs/<name>: the body is saved as an input file of the server, the response is
+  {"path": <path of the file on the server>} to use in the InputFiles of a config
+- POST /merge {"config": <config>, "output_folder": <folder>}: queues the job, the response
+  is a stream of JSON lines, the events of the job as they happen:
+  {"event": "queued", "job": , "jobs_ahead": }, {"event": "started", "job": , "pid": },
+  {"event": "progress", "message": , "value": } (the stages of the Parser),
+  then {"event": "done", "file": , "wall_s": , "stages": [<StageRecord.as_dict>]}
+  or {"event": "error", "error": , "traceback": }
+- GET /outputs/<name>: the merged file <name> of the output folder of the server
+- GET /status: {"workers": , "jobs": , "active": }
+
+The jobs beyond the number of workers wait in the queue of the pool. `merge` is the client
+used by main.py (--server) and the Fusion add-in. A client on another computer uploads
+its input files and downloads the merged file (`download`):
+
+    python main.py --serve                      # or --serve unix:/tmp/nfab.sock
+    python main.py --config config.json --server 127.0.0.1:8765
+"""
+import contextlib
+import http.client
+import json
+import multiprocessing
+import os
+import queue
+import shutil
+import signal
+import socket
+import socketserver
+import threading
+import time
+import traceback
+import urllib.parse
+import uuid
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+DEFAULT_ADDRESS = '127.0.0.1:8765'
+DEFAULT_CACHE_FOLDER = '~/N-Fab/cache/'
+READ_SIZE = 1 << 20
+DISPATCH_PERIOD = 1.0   # s between two checks that the pool of the dispatcher is still the current one
+
+FINAL_EVENTS = ('done', 'error')
+
+
+def parse_address(address):
+    """ ('unix', path) for 'unix:<path>', ('tcp', (host, port)) for '<host>:<port>' or '<port>' """
+    if address.startswith('unix:'):
+        return 'unix', address[5:]
+    host, _, port = address.rpartition(':')
+    return 'tcp', (host or '127.0.0.1', int(port))
+
+
+def is_local(address):
+    """ True if the server at `address` runs on this computer (its paths are the ones of the client) """
+    kind, location = parse_address(address)
+    return kind == 'unix' or location[0] in ('127.0.0.1', 'localhost', '::1')
+
+
+#
+# Worker processes
+#
+
+# queue of the (job, event) sent by the jobs to the server, set in each worker process:
+_events = None
+
+
+def init_worker(events):
+    global _events
+    _events = events
+    # imported once, before the first job:
+    from . import ASMBL_parser, profiler
+
+
+class ProgressEvents:
+    """
+    Progress of a job for the Parser (as the Fusion progress dialog): the Parser sets the
+    message of a stage then increments the value, an event is sent at each increment
+    """
+
+    def __init__(self, job):
+        self.job = job
+        self._message = ''
+        self._value = 0
+
+    def send(self):
+        _events.put((self.job, {'event': 'progress', 'message': self._message, 'value': self._value}))
+
+    @property
+    def message(self):
+        return self._message
+
+    @message.setter
+    def message(self, message):
+        self._message = message
+
+    @property
+    def progressValue(self):
+        return self._value
+
+    @progressValue.setter
+    def progressValue(self, value):
+        self._value = value
+        self.send()
+
+
+def run_merge_job(job, config, folder_path):
+    """ Merges the input files of `config` in a worker process, its events are sent to the server """
+    from .ASMBL_parser import Parser
+    from .profiler import StageProfiler
+
+    _events.put((job, {'event': 'started', 'job': job, 'pid': os.getpid()}))
+    start = time.perf_counter()
+    try:
+        profiler = StageProfiler(memory=False)
+        parser = Parser(config, progress=ProgressEvents(job), profiler=profiler, quiet=True)
+        file_path = parser.create_output_file(folder_path=folder_path, open_output=False)
+        event = {'event': 'done', 'file': os.path.abspath(file_path), 'wall_s': time.perf_counter() - start,
+                 'stages': profiler.report()['stages']}
+    except Exception as error:
+        event = {'event': 'error', 'error': f'{type(error).__name__}: {error}', 'traceback': traceback.format_exc()}
+    _events.put((job, event))
+
+
+#
+# Server
+#
+
+class MergeService:
+    """
+    The pool of `workers` processes (all the cores by default) running the jobs, and the
+    dispatch of their events. The merged files are written in `folder_path` unless a job
+    gives its own folder, the uploaded input files in `spool_folder`. When a worker dies
+    (e.g. killed when out of memory), its job fails and the pool is replaced at the next job.
+    """
+
+    def __init__(self, workers=None, folder_path='output/', spool_folder='~/N-Fab/spool/',
+                 cache_folder=DEFAULT_CACHE_FOLDER):
+        self.workers = workers or os.cpu_count() or 1
+        self.folder_path = os.path.join(os.path.abspath(os.path.expanduser(folder_path)), '')
+        self.spool_folder = os.path.expanduser(spool_folder)
+        self.cache_folder = cache_folder
+        os.makedirs(self.spool_folder, exist_ok=True)
+
+        self.submitted = 0      # number of jobs, the id of the last one
+        self.listeners = {}     # {job: queue.Queue of its events}
+        self.uploads = {}       # {job: paths of its uploaded input files}
+        self.lock = threading.Lock()
+        # spawned (not forked from the threads of the server) workers:
+        self.context = multiprocessing.get_context('spawn')
+        self.executor = None
+        self.start_pool()
+
+    def start_pool(self, broken=None):
+        """
+        Starts the worker processes, now rather than at the first job. With `broken`, the
+        pool that failed: a new pool is only started if it is still the current one (another
+        thread may already have replaced it)
+        """
+        if broken is not None:
+            if self.executor is not broken:
+                return
+            print('A worker process died, restarting the pool')
+            broken.shutdown(wait=False, cancel_futures=True)
+        # a new queue of events: the dead worker may have left the lock of the previous one taken
+        self.events = self.context.Queue()
+        self.executor = ProcessPoolExecutor(self.workers, mp_context=self.context,
+                                            initializer=init_worker, initargs=(self.events,))
+        for _ in range(self.workers):
+            self.executor.submit(int)
+        self.dispatcher = threading.Thread(target=self.dispatch, args=(self.events,), daemon=True)
+        self.dispatcher.start()
+
+    def dispatch(self, events):
+        """ Forwards the `events` of the workers to the listener of their job, until the pool is replaced """
+        while True:
+            try:
+                job, event = events.get(timeout=DISPATCH_PERIOD)
+            except queue.Empty:
+                if events is not self.events:
+                    return
+                continue
+            if job is None:
+                return
+            with self.lock:
+                listener = self.listeners.get(job)
+            if listener is not None:
+                listener.put(event)
+            if event['event'] in FINAL_EVENTS:
+                self.remove_uploads(job)
+
+    def submit(self, config, folder_path=None):
+        """ Queues a job, returns its id and the queue.Queue of its events """
+        if self.cache_folder and 'Cache' not in config:
+            config['Cache'] = {'folder': self.cache_folder}
+        folder_path = os.path.join(folder_path or self.folder_path, '')
+
+        spool_folder = os.path.abspath(self.spool_folder)
+        uploads = [path for path in config['InputFiles'].values()
+                   if os.path.dirname(os.path.abspath(path)) == spool_folder]
+
+        listener = queue.Queue()
+        with self.lock:
+            self.submitted += 1
+            job = self.submitted
+            self.uploads[job] = uploads
+            jobs_ahead = max(0, len(self.listeners) - self.workers + 1)
+            self.listeners[job] = listener
+        listener.put({'event': 'queued', 'job': job, 'jobs_ahead': jobs_ahead})
+
+        # a pool with a dead worker (e.g. killed when out of memory) refuses the new jobs: it is
+        # replaced once and the job submitted again
+        future = None
+        for attempt in range(2):
+            executor = self.executor
+            try:
+                future = executor.submit(run_merge_job, job, config, folder_path)
+                break
+            except BrokenProcessPool:
+                with self.lock:
+                    self.start_pool(broken=executor)
+        if future is None:
+            self.finish(job)
+            self.remove_uploads(job)
+            raise BrokenProcessPool('The worker processes of the merge service keep failing')
+
+        def failed(future):
+            # the worker process died before it could send the end of the job:
+            error = future.exception()
+            if error is not None:
+                listener.put({'event': 'error', 'error': f'{type(error).__name__}: {error}'})
+                self.remove_uploads(job)
+        future.add_done_callback(failed)
+        return job, listener
+
+    def finish(self, job):
+        """ Forgets the listener of `job` """
+        with self.lock:
+            self.listeners.pop(job, None)
+
+    def remove_uploads(self, job):
+        """ Removes the uploaded input files of the ended `job` """
+        with self.lock:
+            uploads = self.uploads.pop(job, [])
+        for path in uploads:
+            with contextlib.suppress(OSError):
+                os.remove(path)
+
+    def store_input(self, name, stream, size):
+        """ Saves `size` bytes of `stream` as the input file `name`, returns its path """
+        path = os.path.join(self.spool_folder, f'{uuid.uuid4().hex}_{os.path.basename(name)}')
+        with open(path, 'wb') as input_file:
+            while size > 0:
+                chunk = stream.read(min(READ_SIZE, size))
+                if not chunk:
+                    raise ValueError('Input file truncated')
+                input_file.write(chunk)
+                size -= len(chunk)
+        return path
+
+    def output_path(self, name):
+        """ Path of the merged file `name` of the output folder, None if there is no such file """
+        path = os.path.join(self.folder_path, os.path.basename(name))
+        return path if os.path.isfile(path) else None
+
+    def status(self):
+        with self.lock:
+            return {'workers': self.workers, 'jobs': self.submitted, 'active': len(self.listeners)}
+
+    def close(self):
+        self.executor.shutdown(cancel_futures=True)
+        self.events.put((None, None))
+        self.dispatcher.join()
+
+
+class MergeRequestHandler(BaseHTTPRequestHandler):
+    """ The HTTP requests of the clients, see the module docstring """
+    server_version = 'N-Fab'
+
+    def address_string(self):
+        # no client address on a Unix socket:
+        return self.client_address[0] if isinstance(self.client_address, tuple) else 'local'
+
+    def send_json(self, value, status=200):
+        body = json.dumps(value).encode()
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def read_json(self):
+        return json.loads(self.rfile.read(int(self.headers.get('Content-Length', 0))))
+
+    def do_GET(self):
+        if self.path.startswith('/outputs/'):
+            return self.send_output(urllib.parse.unquote(self.path[len('/outputs/'):]))
+        if self.path != '/status':
+            return self.send_json({'error': f'Unknown path {self.path}'}, 404)
+        self.send_json(self.server.service.status())
+
+    def send_output(self, name):
+        path = self.server.service.output_path(name)
+        if path is None:
+            return self.send_json({'error': f'No output file {name}'}, 404)
+        with open(path, 'rb') as output_file:
+            self.send_response(200)
+            self.send_header('Content-Type', 'application/octet-stream')
+            self.send_header('Content-Length', str(os.fstat(output_file.fileno()).st_size))
+            self.end_headers()
+            shutil.copyfileobj(output_file, self.wfile, READ_SIZE)
+
+    def do_PUT(self):
+        if not self.path.startswith('/inputs/'):
+            return self.send_json({'error': f'Unknown path {self.path}'}, 404)
+        size = int(self.headers.get('Content-Length', 0))
+        path = self.server.service.store_input(self.path[len('/inputs/'):], self.rfile, size)
+        self.send_json({'path': path})
+
+    def do_POST(self):
+        if self.path != '/merge':
+            return self.send_json({'error': f'Unknown path {self.path}'}, 404)
+        try:
+            request = self.read_json()
+            config = request['config']
+            config['InputFiles']['additive_gcode'], config['InputFiles']['subtractive_gcode']
+        except (ValueError, KeyError, TypeError) as error:
+            return self.send_json({'error': f'Bad merge request: {error}'}, 400)
+
+        service = self.server.service
+        try:
+            job, listener = service.submit(config, request.get('output_folder'))
+        except BrokenProcessPool as error:
+            return self.send_json({'error': str(error)}, 503)
+        try:
+            # the events are streamed as JSON lines until the end of the job (HTTP/1.0, no length):
+            self.send_response(200)
+            self.send_header('Content-Type', 'application/x-ndjson')
+            self.end_headers()
+            while True:
+                event = listener.get()
+                self.wfile.write(json.dumps(event).encode() + b'\n')
+                self.wfile.flush()
+                if event['event'] in FINAL_EVENTS:
+                    break
+        finally:
+            service.finish(job)
+
+
+class MergeHTTPServer(ThreadingHTTPServer):
+    daemon_threads = True
+
+
+if hasattr(socketserver, 'UnixStreamServer'):     # not on Windows
+    class MergeUnixServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+        daemon_threads = True
+
+
+def stop_server(signum, frame):
+    raise KeyboardInterrupt
+
+
+def serve(address=DEFAULT_ADDRESS, **settings):
+    """ Runs the merge service on `address` until Ctrl-C (or SIGTERM), `settings` are the ones of MergeService """
+    kind, location = parse_address(address)
+    service = MergeService(**settings)
+    if kind == 'unix':
+        if os.path.exists(location):
+            os.remove(location)     # left by a previous server
+        server = MergeUnixServer(location, MergeRequestHandler)
+    else:
+        server = MergeHTTPServer(location, MergeRequestHandler)
+    server.service = service
+    signal.signal(signal.SIGTERM, stop_server)
+    print(f'Merge service on {address} with {service.workers} workers, output in {service.folder_path}')
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        service.close()
+        if kind == 'unix' and os.path.exists(location):
+            os.remove(location)
+
+
+#
+# Client
+#
+
+class UnixHTTPConnection(http.client.HTTPConnection):
+    """ HTTPConnection over the Unix socket `path` """
+
+    def __init__(self, path, timeout=None):
+        super().__init__('localhost', timeout=timeout)
+        self.unix_path = path
+
+    def connect(self):
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        if self.timeout is not None:
+            self.sock.settimeout(self.timeout)
+        self.sock.connect(self.unix_path)
+
+
+def connect(address, timeout=None):
+    kind, location = parse_address(address)
+    if kind == 'unix':
+        return UnixHTTPConnection(location, timeout=timeout)
+    return http.client.HTTPConnection(*location, timeout=timeout)
+
+
+def request_json(address, method, path, body=None, headers=None, timeout=None):
+    connection = connect(address, timeout)
+    try:
+        connection.request(method, path, body=body, headers=headers or {})
+        response = connection.getresponse()
+        result = json.loads(response.read())
+        if response.status != 200:
+            raise RuntimeError(f"Merge service: {result.get('error', response.reason)}")
+        return result
+    finally:
+        connection.close()
+
+
+def upload(input_file, name, address=DEFAULT_ADDRESS, timeout=None):
+    """ Sends the content of the path or binary file `input_file` to the server, returns its path there """
+    with contextlib.ExitStack() as stack:
+        if isinstance(input_file, (str, os.PathLike)):
+            input_file = stack.enter_context(open(input_file, 'rb'))
+        size = os.fstat(input_file.fileno()).st_size - input_file.tell()
+        return request_json(address, 'PUT', f'/inputs/{os.path.basename(name)}', body=input_file,
+                            headers={'Content-Length': str(size)}, timeout=timeout)['path']
+
+
+def download(file_path, folder, address=DEFAULT_ADDRESS, timeout=None):
+    """ Saves the merged file `file_path` of the server (the 'file' of the 'done' event) in `folder`, returns its path """
+    name = os.path.basename(file_path.replace('\\', '/'))
+    connection = connect(address, timeout)
+    try:
+        connection.request('GET', '/outputs/' + urllib.parse.quote(name))
+        response = connection.getresponse()
+        if response.status != 200:
+            raise RuntimeError(f"Merge service: {json.loads(response.read()).get('error', response.reason)}")
+        os.makedirs(folder, exist_ok=True)
+        path = os.path.join(folder, name)
+        with open(path, 'wb') as output_file:
+            shutil.copyfileobj(response, output_file, READ_SIZE)
+        return path
+    finally:
+        connection.close()
+
+
+def status(address=DEFAULT_ADDRESS):
+    return request_json(address, 'GET', '/status')
+
+
+def merge(config, address=DEFAULT_ADDRESS, output_folder=None, upload_inputs=False, on_event=None,
+          timeout=None, read_timeout=None):
+    """
+    Merges the input files of `config` on the server at `address`, in `output_folder` (a folder
+    of the server, its default one if None). With `upload_inputs` the input files are sent to
+    the server, otherwise their paths must be valid on the server. `on_event` is called with
+    each event of the job. `timeout` (s) limits the connection and the wait for each response
+    of the server, `read_timeout` the wait between two events of the job (None: no limit).
+    Returns the 'done' event, raises RuntimeError if the job failed and OSError if the server
+    can't be reached or does not answer in time.
+    """
+    config = json.loads(json.dumps(config))
+    if upload_inputs:
+        for key, path in config['InputFiles'].items():
+            config['InputFiles'][key] = upload(path, os.path.basename(path), address, timeout)
+
+    connection = connect(address, timeout)
+    try:
+        body = json.dumps({'config': config, 'output_folder': output_folder}).encode()
+        connection.request('POST', '/merge', body=body, headers={'Content-Type': 'application/json'})
+        sock = connection.sock      # the connection forgets it once the response is read until closed
+        response = connection.getresponse()
+        if response.status != 200:
+            raise RuntimeError(f"Merge service: {json.loads(response.read()).get('error', response.reason)}")
+        sock.settimeout(read_timeout)
+        for line in response:
+            event = json.loads(line)
+            if on_event is not None:
+                on_event(event)
+            if event['event'] == 'error':
+                raise RuntimeError(f"Merge failed on the service: {event['error']}")
+            if event['event'] == 'done':
+                return event
+        raise RuntimeError('Merge service: connection closed before the end of the job')
+    finally:
+        connection.close()
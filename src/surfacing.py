@@ -0,0 +1,406 @@
+"""
+Split of the CAM operations with a large Z range into overlapping operations of a small Z range.
+
+`find_blocs` scans the subtractive gcode for the '(strategy: parallel_new)', '(strategy: ramp)'
+and '(strategy: contour2d)' blocs and their Z range, `split_blocs` splits them.
+The G1 moves of a bloc are lexed once into arrays (line number, Z and what is needed to
+know the cutting state at any move), the end of each overlapping window is then found by a
+vectorized search from its start, so that each bloc is split in a single pass over its lines.
+"""
+import logging
+from collections import namedtuple
+import numpy as np
+
+from . import gcode_lexer
+from .run_log import logger
+
+STRATEGIES = ('parallel_new',
+              'ramp',
+              'contour2d')
+
+# strategies with a single '(type: ...)' line before many cutting lines:
+SINGLE_TYPE_STRATEGIES = ('(strategy: ramp)', '(strategy: contour2d)')
+
+CUTTING_TAGS = (('type', 'cutting'), ('type', 'ramp'))
+
+# JLC : Fusion BUG : sometime we find 2 consecutive G1 lines with a difference
+#       between the 2 Z  of about 0.001 mm...
+Z_JITTER_MM = 0.001
+
+SEARCH_SIZE = 256   # number of moves first searched for the end of a window, doubled at each step
+
+SurfacingWindow = namedtuple('SurfacingWindow', ['L1', 'Z1', 'next_L1', 'L2', 'Z', 'Z_increase'])
+SurfacingWindow.__doc__ = """
+One small cutting bloc of a bloc to split.
+
+- L1, Z1:     line and Z of its first cutting move
+- next_L1:    first line at (zRange - zOverlap) from Z1, the next bloc starts after it. None if not reached
+- L2:         its last line, the first one at zRange from Z1 or at Zmin/Zmax. None if not reached
+- Z:          Z of its last cutting move
+- Z_increase: True/False if the Z of its last cutting move (jitter excluded) is above/under Z1, else None
+"""
+
+
+class CuttingMoves:
+    """
+    The G1 moves of the lines [start, stop) of a bloc of subtractive gcode.
+
+    The cutting state at a line depends on where the scan of the lines starts and on
+    the state there: a '(type: cutting)' or '(type: ramp)' line starts the cutting state,
+    any comment line stops it. The state after a comment line which is not a cutting tag
+    does not depend on the state before it, so each move keeps the last such line before it
+    (`resets`), the state at the move from that line (`reset_states`) and the number of
+    cutting tags before it (`move_toggles`): the state at the move is then known for any
+    start of the scan.
+    """
+
+    def __init__(self, after_off, after_on, moves, z, start):
+        """
+        Bool columns of the lines [start, stop): `after_off`/`after_on` the cutting state
+        after the line when it was off/on before it, `moves` if the line is a G1 move,
+        and `z` the Z of the lines
+        """
+        self.start = start
+        n = len(moves)
+
+        # a line is a reset if the state after it is the same whatever the state before it,
+        # a toggle if it inverts the state (a cutting tag):
+        resets = np.flatnonzero(after_off == after_on)
+        toggles = np.zeros(n + 1, dtype=np.int64)     # number of toggle lines before line i
+        np.cumsum(after_off & ~after_on, out=toggles[1:])
+        last_reset = np.full(n + 1, -1, dtype=np.int64)   # last reset line before line i
+        last_reset[resets + 1] = resets
+        np.maximum.accumulate(last_reset, out=last_reset)
+
+        self.lines = np.flatnonzero(moves)
+        self.z = z[self.lines]
+        self.toggles = toggles
+        self.move_toggles = toggles[self.lines]
+        # for each move, the state at the move as seen from its last reset line:
+        self.resets = last_reset[self.lines]
+        reset_index = np.maximum(self.resets, 0)
+        self.reset_states = (after_on[reset_index] + self.move_toggles - toggles[reset_index + 1]) & 1
+
+    def cutting(self, first, last, start, cutting):
+        """ Mask of the moves [first, last) in the cutting state when the scan starts at line `start` with `cutting` """
+        start -= self.start
+        from_start = (int(cutting) + self.move_toggles[first:last] - self.toggles[start]) & 1
+        return np.where(self.resets[first:last] >= start, self.reset_states[first:last], from_start).astype(bool)
+
+    def window(self, start, cutting, Zmin, Zmax, zRange, zNext):
+        """
+        The SurfacingWindow of the small cutting bloc scanned from line `start` with the
+        cutting state `cutting`, for a bloc covering [Zmin, Zmax]: it ends at `zRange`
+        from its first move, the next one begins at `zNext` from it
+        """
+        first = int(np.searchsorted(self.lines, start - self.start))
+        Z1, L1, next_L1, Z, Z_increase = None, None, None, None, None
+        size = SEARCH_SIZE
+        while first < len(self.lines):
+            last = first + size
+            mask = self.cutting(first, last, start, cutting)
+            lines, z = self.lines[first:last][mask], self.z[first:last][mask]
+            first, size = last, 2 * size
+
+            if Z1 is None and len(lines):
+                # this is the beginning of a small cutting bloc
+                Z1, L1 = float(z[0]), int(lines[0]) + self.start
+                Z = Z1
+                lines, z = lines[1:], z[1:]
+            if not len(lines):
+                continue
+
+            delta = np.abs(z - Z1)
+            counted = ~((delta > 0) & (delta <= Z_JITTER_MM))
+            next_hits = np.flatnonzero(counted & (delta >= zNext)) if next_L1 is None else ()
+            ends = np.flatnonzero(counted & ((delta >= zRange) |
+                                             ((z > Z1) & (z == Zmax)) |
+                                             ((z < Z1) & (z == Zmin))))
+            if len(ends):
+                end = ends[0]
+                if len(next_hits) and next_hits[0] <= end:
+                    next_L1 = int(lines[next_hits[0]]) + self.start
+                Z = float(z[end])
+                return SurfacingWindow(L1, Z1, next_L1, int(lines[end]) + self.start, Z, increase(Z, Z1))
+
+            if len(next_hits):
+                next_L1 = int(lines[next_hits[0]]) + self.start
+            counted = np.flatnonzero(counted)
+            if len(counted):
+                Z_increase = increase(float(z[counted[-1]]), Z1)
+            Z = float(z[-1])
+
+        return SurfacingWindow(L1, Z1, next_L1, None, Z, Z_increase)
+
+
+class SplitGcode:
+    """ The split subtractive gcode as a list of str pieces, iterable without joining them """
+
+    def __init__(self):
+        self.pieces = []
+
+    def __iadd__(self, text):
+        if text:
+            self.pieces.append(text)
+        return self
+
+    def __iter__(self):
+        return iter(self.pieces)
+
+    def __str__(self):
+        return ''.join(self.pieces)
+
+    def tail(self):
+        """ The last 2 characters of the gcode """
+        tail = ''
+        for piece in reversed(self.pieces):
+            tail = piece[-2:] + tail
+            if len(tail) >= 2:
+                break
+        return tail[-2:]
+
+    def end_bloc(self):
+        """ Ends the gcode with a blank line """
+        if self.tail() != '\n\n':
+            self.pieces.append('\n')
+
+    def remove_blank_line(self):
+        """ Removes the trailing blank line of the gcode """
+        if self.tail() == '\n\n':
+            self.pieces[-1] = self.pieces[-1][:-1]
+            if not self.pieces[-1]:
+                self.pieces.pop()
+
+
+def increase(Z, Z1):
+    if Z > Z1:
+        return True
+    if Z < Z1:
+        return False
+    return None
+
+
+def find_blocs(gcode_sub_file):
+    '''
+    This function:
+    - reads the whole substractive GCode file (GcodeFile) to get all the lines
+    - looks for lines beginning with the TAG :
+        "(strategy: parallel_new)" or
+        "(strategy: ramp)"
+        "(strategy: contour2D)
+    Returns the dict {number: bloc} of the blocs beginning with TAG and ending with a
+    blank line ('\\n'), with their Z range and the CuttingMoves of their lines.
+    '''
+    bloc_to_split= {}
+    num_bloc = 0
+    bloc_found = False
+
+    nb_lines = len(gcode_sub_file)
+    # the columns of CuttingMoves for all the lines:
+    after_off, after_on, moves, z = [], [], [], []
+
+    # scan the GCode lines to catch the target:
+    for i, record in enumerate(gcode_lexer.iter_records(gcode_sub_file.lines()), 1):
+        line, command, tag = record.line, record.command, record.tag
+        after_off.append(tag in CUTTING_TAGS)
+        after_on.append(command is not None or record.comment is None)
+        moves.append(command == 'G1')
+        z.append(record.params.get('Z', np.nan))
+
+        if tag is not None and tag[0] == 'strategy' and tag[1] in STRATEGIES:
+            STRATEGY = f'(strategy: {tag[1]})'
+            start_bloc = i-2
+            name = gcode_sub_file.line(start_bloc)
+            bloc_to_split[num_bloc] = {'strategy': f'{STRATEGY}\n',
+                                       'type': '',
+                                       'name': name,
+                                       'header': '',
+                                       'start_bloc': start_bloc,
+                                       'needs_header': False}
+            bloc_found, cutting, first_cutting_line = True, False, None
+            Zmin = None
+            header = ''
+            num_sub_bloc = 0
+            continue
+
+        if i == nb_lines or line == '\n':
+            # This is the end of a "(strategy: ...)"" CAM bloc, save the bloc data
+            if bloc_found:
+                bloc_to_split[num_bloc]['header']   = header
+                bloc_to_split[num_bloc]['ZMinMax']  = (Zmin, Zmax)
+                bloc_to_split[num_bloc]['end_bloc'] = i
+
+                num_bloc += 1
+                bloc_found, cutting, first_cutting_line = False, False, None
+            continue
+
+        if bloc_found:
+            if command is not None and command[0] in 'TM':
+                # add lines like "T1" and "M3 S14000" to header:
+                header += line
+
+            elif not cutting and tag in CUTTING_TAGS:
+                cutting = True
+                if first_cutting_line is None:
+                    first_cutting_line = i-1
+                    bloc_to_split[num_bloc]['first_cutting_line'] = first_cutting_line
+                    bloc_to_split[num_bloc]['type'] = line.strip()
+
+            elif command == 'G0':
+                prev_line = gcode_sub_file.line(i-2)
+                if i <  nb_lines :
+                    next_line = gcode_sub_file.line(i)
+                else:
+                    next_line = '\n'
+                if prev_line.startswith('(type:') and next_line != '\n':
+                    # A new surfacing phase takes place: we wil create a new sub-bloc
+                    # with "(strategy: ...)"
+                    # 1/ Save the data of the current bloc
+                    bloc_to_split[num_bloc]['header']   = header
+                    bloc_to_split[num_bloc]['ZMinMax']  = (Zmin, Zmax)
+                    bloc_to_split[num_bloc]['end_bloc'] = i-3
+                    # 2/ Prepare the new bloc
+                    num_bloc += 1
+                    num_sub_bloc +=1
+                    start_bloc = i-2
+                    new_name = name.strip()[:-1] + f'- split {num_sub_bloc})\n'
+
+                    bloc_to_split[num_bloc] = {'strategy': f'{STRATEGY}\n',
+                                               'type': prev_line.strip,
+                                               'name': new_name,
+                                               'header': header,
+                                               'start_bloc': start_bloc,
+                                               'needs_header': True}
+                    bloc_found, cutting = True, False
+                    first_cutting_line, Zmin = None, None
+
+            elif cutting and command == 'G1':
+                # Extract Z from a line in a 'cutting' zone like:
+                # "G1 X100.202 Y108.725 Z2.083 F924"
+                Z = record.params['Z']
+                if Zmin is None:
+                    Zmin, Zmax = Z, Z
+                if Z < Zmin:
+                    Zmin = Z
+                elif Z > Zmax:
+                    Zmax = Z
+            else:
+                cutting = False
+
+    after_off, after_on = np.array(after_off, dtype=bool), np.array(after_on, dtype=bool)
+    moves, z = np.array(moves, dtype=bool), np.array(z, dtype=float)
+    for bloc in bloc_to_split.values():
+        if 'first_cutting_line' in bloc:
+            first, end = bloc['first_cutting_line'], bloc['end_bloc']
+            bloc['moves'] = CuttingMoves(after_off[first:end], after_on[first:end],
+                                         moves[first:end], z[first:end], first)
+
+    return bloc_to_split
+
+
+def split_blocs(gcode_sub_file, blocs_to_split, zRangeMax3Dsurfacing_mm, zOverlap3Dsurfacing_mm):
+    '''
+    Splits each surfacing CAM operation of `blocs_to_split` (see find_blocs) with a large Z range
+    into overlapping smaller surfacing operations, returns the whole split subtractive gcode
+    as a SplitGcode. The blocs and their splits are logged at the DEBUG level.
+    '''
+    debug = logger.isEnabledFor(logging.DEBUG)
+    zNext = zRangeMax3Dsurfacing_mm - zOverlap3Dsurfacing_mm
+
+    splitted_gcode = SplitGcode()
+    start_line_number = 0
+
+    for key in blocs_to_split:
+
+        bloc = blocs_to_split[key]
+        if debug:
+            logger.debug("\n" + "="*30 +
+                f"\nProcessing bloc {key}\n" +
+                f"\t(start, end):{(bloc['start_bloc'], bloc['end_bloc'])}\n" +
+                f"\tname        :{repr(bloc['name'])}, needs_header:{bloc['needs_header']}\n" +
+                f"\tstrategy    :{repr(bloc['strategy'])}\n" +
+                f"\ttype        :{repr(bloc['type'])}\n" +
+                f"\theader      :{repr(bloc['header'])}\n" +
+                f"\t(Zmin, Zmax):{(bloc['ZMinMax'])}")
+
+        first_line_bloc, end_line_bloc = bloc['first_cutting_line'], bloc['end_bloc']
+        Zmin, Zmax = bloc['ZMinMax']
+
+        # Fill splitted_gcode with the Gcode lines until the firts line of the bloc:
+        if bloc['needs_header']:
+            splitted_gcode += bloc['name']
+            splitted_gcode += bloc['strategy']
+            splitted_gcode += bloc['header']
+
+        splitted_gcode += gcode_sub_file.text(start_line_number, first_line_bloc)
+
+        if abs(Zmax - Zmin) <= zRangeMax3Dsurfacing_mm:
+            # no need to split the CAM operation
+            splitted_gcode += gcode_sub_file.text(first_line_bloc, end_line_bloc)
+            splitted_gcode.end_bloc()
+            start_line_number = end_line_bloc
+            continue
+
+        moves = bloc['moves']
+        single_type = bloc['strategy'].strip() in SINGLE_TYPE_STRATEGIES
+
+        # The first split and following splits need some different processing:
+        first_split = True
+        i = None
+        while(True):
+            # When surfacing a 'ramp', we are splitting a large number of 'G1 ....'
+            # lines with just one '(cutting)' line in the preamble : we must keep
+            # the cutting state for all the 'G1 ...' lines:
+            window = moves.window(first_line_bloc, single_type and not first_split,
+                                  Zmin, Zmax, zRangeMax3Dsurfacing_mm, zNext)
+
+            if window.L2 is not None:
+                # this is the end of a small cutting bloc: the bloc is added to splitted_gcode:
+                L2 = i = window.L2
+                if debug:
+                    logger.debug(f"(Z1,Z2):({window.Z1:.3f},{window.Z:.3f}), (L1,L2)={(window.L1, L2)}")
+
+                if first_split == False:
+                    splitted_gcode += bloc['name']
+                    splitted_gcode += bloc['strategy']
+                    splitted_gcode += bloc['header']
+
+                    if single_type:
+                        # when splitting the many lines of a 'ramp', we must add
+                        # the '(type: cutting)\n' line in each small splitted bloc:
+                        splitted_gcode += f"{bloc['type']}\n"
+
+                splitted_gcode += gcode_sub_file.text(first_line_bloc, L2+1)
+
+                splitted_gcode.end_bloc()
+
+                first_split = False
+
+                # Normally the next bloc to process overlaps the current bloc
+                if window.next_L1 is not None:
+                    first_line_bloc = window.next_L1 + 1
+                else:
+                    first_line_bloc = L2
+            elif first_line_bloc < end_line_bloc:
+                # all the lines were scanned:
+                i = end_line_bloc - 1
+
+            Z, Z_increase = window.Z, window.Z_increase
+            if Z_increase is not None:
+                if (Z_increase == True and Z == Zmax) or (Z_increase == False and Z == Zmin):
+                    if single_type:
+                        # add the rest of the lines of the bloc:
+                        # 1/ remove the trailing '\n':
+                        splitted_gcode.remove_blank_line()
+                        # 2/ add the lines:
+                        splitted_gcode += gcode_sub_file.text(i+1, end_line_bloc)
+                        splitted_gcode.end_bloc()
+                        break
+
+            if i >= end_line_bloc - 1:
+                break
+        # Go on with the next bloc:
+        start_line_number = end_line_bloc
+
+    splitted_gcode += gcode_sub_file.text(end_line_bloc)
+    return splitted_gcode
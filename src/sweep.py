@@ -0,0 +1,144 @@
+"""
+Parameter sweep: many merges of the same input files from a single parse.
+
+The additive gcode is parsed once for the whole sweep, the subtractive gcode once per
+distinct (layer_dropdown, zRangeMax_3Dsurfacing_mm, zOverlap_3Dsurfacing_mm) since
+its offset and its 3D surfacing split depend on them. Each combination of the grid
+then only schedules the CAM layers (layer_overlap) and writes its merged output.
+On Linux, the combinations run in worker processes forked from the parsed data, which
+they share copy-on-write. Elsewhere they run one after the other: fork is not safe on
+macOS (numpy, Accelerate and the system frameworks), and Windows has no fork.
+"""
+import copy
+import itertools
+import json
+import multiprocessing
+import os
+import sys
+from concurrent.futures import ProcessPoolExecutor
+
+from .ASMBL_parser import Parser
+from .cam_gcode import CamGcodeLayer
+from .run_log import RunLog
+
+CAM_SETTINGS = ('layer_overlap', 'layer_dropdown', 'zRangeMax_3Dsurfacing_mm', 'zOverlap_3Dsurfacing_mm')
+
+# {CAM parse key: (parser, operations)}, set before the workers are forked:
+_parsed = {}
+
+
+def sweep_configs(config, grid):
+    """
+    Returns the list of (settings, config) of each combination of the `grid`
+    {CamSettings name: [values]}, the other settings are the ones of `config`
+    """
+    for name in grid:
+        if name not in CAM_SETTINGS:
+            raise ValueError(f"Unknown CamSettings '{name}', expected one of {', '.join(CAM_SETTINGS)}")
+
+    names = list(grid)
+    combinations = []
+    for index, values in enumerate(itertools.product(*(grid[name] for name in names))):
+        settings = dict(zip(names, values))
+        combination_config = copy.deepcopy(config)
+        combination_config['CamSettings'].update(settings)
+        combination_config['OutputSettings']['filename'] = f"{config['OutputSettings']['filename']}_sweep{index:03d}"
+        combinations.append((settings, combination_config))
+    return combinations
+
+
+def cam_parse_key(config):
+    """ The settings the parsed CAM operations depend on """
+    cam_settings = config['CamSettings']
+    return (Parser.cam_offset(config),
+            cam_settings['zRangeMax_3Dsurfacing_mm'],
+            cam_settings['zOverlap_3Dsurfacing_mm'])
+
+
+def merge_plan(parser):
+    """ The (name, cutting height, layer height) of each CAM layer, in the order of the merged gcode """
+    return [(layer.name, layer.cutting_height, layer.layer_height)
+            for layer in parser.merged_gcode if isinstance(layer, CamGcodeLayer)]
+
+
+def run_combination(job):
+    """ Schedules and writes one combination of the sweep, returns its result """
+    index, settings, config, key, folder_path, write, plan = job
+    parser, operations = _parsed[key]
+    parser = copy.copy(parser)
+    parser.config = config
+    parser.progress = None
+    parser.quiet = True
+
+    parser.schedule(operations)
+    file_path = None
+    if write:
+        file_path = parser.create_output_file(folder_path=folder_path, open_output=False)
+
+    result = {
+        'index': index,
+        'settings': settings,
+        'file': file_path,
+        'additive_layers': len(parser.gcode_add_layers),
+        'cam_layers': len(parser.cam_layers),
+        'cam_heights': ([min(layer.layer_height for layer in parser.cam_layers),
+                         max(layer.layer_height for layer in parser.cam_layers)] if parser.cam_layers else None),
+    }
+    if plan:
+        result['plan'] = merge_plan(parser)
+    return result
+
+
+def run_sweep(config, grid, folder_path='output/', workers=None, write=True, plan=False):
+    """
+    Merges the input files of `config` for each combination of the `grid` {CamSettings name: [values]}.
+    The output of combination i is <filename>_sweep<i>.gcode in `folder_path`, unless `write` is False.
+    `workers` is the number of worker processes (all the cores by default, 1 to run in this process),
+    `plan` adds the merge plan of each combination to its result.
+    Returns the list of the results of the combinations, also saved in <filename>_sweep.json.
+    """
+    if config['Flags']['append_AddSubGcode']:
+        raise ValueError('A sweep has no effect when the subtractive gcode is just appended (append_AddSubGcode)')
+
+    combinations = sweep_configs(config, grid)
+    folder_path = os.path.join(folder_path, '')
+
+    with RunLog(config):
+        # one parse of the additive gcode:
+        parser = Parser(config, run=False)
+        print('Opening files...')
+        parser.open_files(config)
+        parser.split_additive_gcode(parser.convert_additive_gcode())
+
+        # one parse of the subtractive gcode per distinct offset and 3D surfacing split:
+        _parsed.clear()
+        jobs = []
+        for index, (settings, combination_config) in enumerate(combinations):
+            key = cam_parse_key(combination_config)
+            if key not in _parsed:
+                variant = copy.copy(parser)
+                variant.config = combination_config
+                variant.offset = Parser.cam_offset(combination_config)
+                _parsed[key] = (variant, variant.parse_cam_operations())
+            jobs.append((index, settings, combination_config, key, folder_path, write, plan))
+        parser.gcode_sub_file.close()
+
+    print(f'Merging {len(jobs)} combinations...')
+    if workers is None:
+        workers = os.cpu_count() or 1
+    workers = min(workers, len(jobs))
+    if workers > 1 and sys.platform == 'linux':
+        with ProcessPoolExecutor(workers, mp_context=multiprocessing.get_context('fork')) as executor:
+            results = list(executor.map(run_combination, jobs))
+    else:
+        # the parsed data can't be shared without fork: the combinations run one after the other
+        results = [run_combination(job) for job in jobs]
+    _parsed.clear()
+
+    if write:
+        summary_path = os.path.join(os.path.expanduser(folder_path),
+                                    config['OutputSettings']['filename'] + '_sweep.json')
+        with open(summary_path, 'w') as summary:
+            json.dump(results, summary, indent=4)
+
+    return results
@@ -1,11 +1,26 @@
 import sys
 import os
-import subprocess
 import time
+import re
+import numpy as np
 
+from . import gcode_lexer
 
-def convert_relative(gcode_abs):
-    """ Converts absolute extrusion gcode into relative extrusion gcode """
+
+# Lookup table of the bytes ending a gcode word:
+WORD_DELIMITERS = np.zeros(256, dtype=bool)
+WORD_DELIMITERS[list(b' \t\r\n;(\0')] = True
+
+
+def convert_relative(gcode_abs, chunk_size=1 << 22):
+    """
+    Converts absolute extrusion gcode into relative extrusion gcode
+
+    The gcode is processed by chunks of about `chunk_size` characters of complete lines.
+    In each chunk the E values, tool changes, G92 resets and M82/M83 lines are located 
+    with array operations on the bytes, and the relative extrusions are computed per tool
+    with a segmented np.diff. The output is assembled with a single join.
+    """
     
     #<JLC9> avoid processing gcode file if alredy relative ;-)
     if 'M83 ' in gcode_abs or 'M83\n' in gcode_abs: 
@@ -13,79 +28,320 @@ def convert_relative(gcode_abs):
         return gcode_rel 
     #</jlc9>
     
-    absolute_mode = False
-    last_tool = None
-    last_e = {}     # {'tool': last extrusion value}
+    state = {
+        'absolute_mode': False,
+        'last_tool': -1,        # code of the current tool, -1 before the first tool change
+        'last_e': {},           # {tool code: last extrusion value}
+        'tools': {},            # {'T1': tool code}
+    }
 
-    lines = gcode_abs.split('\n')
+    gcode_rel = []
+    start = 0
+    while start < len(gcode_abs):
+        stop = gcode_abs.find('\n', start + chunk_size)
+        stop = len(gcode_abs) if stop < 0 else stop + 1
+        # blank lines are removed
+        chunk = re.sub('\n\n+', '\n', gcode_abs[start:stop]).lstrip('\n')
+        gcode_rel.append(convert_relative_chunk(chunk.encode(), state).decode())
+        start = stop
 
-    gcode_rel = ''
+    gcode_rel = ''.join(gcode_rel)
+    if gcode_rel and gcode_rel[-1] != '\n':
+        gcode_rel += '\n'
+    return gcode_rel
 
-    for line in lines:
-        if line == '':
-            continue
 
-        line_start = line.split(' ')[0]
-        # Check for absolute extrusion
-        if line_start == ('M82'):
-            absolute_mode = True
-            line = 'M83'
-
-        # Check for relative extrusion
-        elif line_start == ('M83'):
-            absolute_mode = False
-
-        # Check for tool change
-        elif line_start[0] == 'T':
-            last_tool = line_start
-
-        # Check for extrusion reset
-        elif line_start == 'G92':
-            extrusion_reset = line.split('E')[1]
-            last_e[last_tool] = extrusion_reset
-
-        # Convert Extrusion coordinates to relative if in absolute mode
-        if absolute_mode:
-            if line_start == 'G0' or line_start == 'G1':
-                try:
-                    line_split = line.split('E')
-                    current_extrusion = line_split[1]
-                    extrusion_diff = float(current_extrusion) - float(last_e[last_tool])
-                    extrusion_diff = round(extrusion_diff, 3)
-                    last_e[last_tool] = current_extrusion
-                    line = line_split[0] + 'E' + str(extrusion_diff)
-                except IndexError:
-                    pass
-        gcode_rel += line + '\n'
+def word_ends(buf, positions):
+    """ Returns the index of the delimiter ending the word starting at each of `positions` in `buf` """
+    ends = positions.copy()
+    pending = np.flatnonzero(~WORD_DELIMITERS[buf[ends]])
+    while len(pending):
+        ends[pending] += 1
+        pending = pending[~WORD_DELIMITERS[buf[ends[pending]]]]
+    return ends
 
-    return gcode_rel
+
+def byte_ranges(starts, stops):
+    """ Returns the indexes of all the bytes in the ranges [starts, stops), range after range """
+    lengths = stops - starts
+    offsets = np.cumsum(lengths) - lengths
+    return np.arange(lengths.sum()) + np.repeat(starts - offsets, lengths)
+
+
+def format_decimals(values):
+    """
+    Formats floats rounded to 3 decimals as str() does ('-0.05', '12.0'...) without a Python loop.
+    Returns the bytes of all the values, one after the other, and the length of each of them.
+    """
+    values = np.asarray(values, dtype=float)
+    plain = np.isfinite(values) & (np.abs(values) < 1e15)
+    milli = np.rint(np.abs(np.where(plain, values, 0)) * 1000).astype(np.int64)
+    integers, decimals = np.divmod(milli, 1000)
+
+    powers = 10 ** np.arange(16, dtype=np.int64)
+    n_digits = np.searchsorted(powers, integers, side='right').clip(1)
+    width = int(n_digits.max(initial=1))
+    digit_powers = powers[:width][::-1]
+    n_decimals = np.where(decimals % 100 == 0, 1, np.where(decimals % 10 == 0, 2, 3))
+
+    chars = np.empty((len(values), width + 5), dtype=np.uint8)
+    chars[:, 0] = ord('-')
+    chars[:, 1:width + 1] = integers[:, None] // digit_powers % 10 + ord('0')
+    chars[:, width + 1] = ord('.')
+    chars[:, width + 2:] = decimals[:, None] // np.array([100, 10, 1]) % 10 + ord('0')
+
+    keep = np.empty(chars.shape, dtype=bool)
+    keep[:, 0] = np.signbit(values)
+    keep[:, 1:width + 1] = np.arange(width, 0, -1) <= n_digits[:, None]
+    keep[:, width + 1] = True
+    keep[:, width + 2:] = np.arange(1, 4) <= n_decimals[:, None]
+    lengths = keep.sum(axis=1)
+
+    if plain.all():
+        return chars[keep], lengths
+    # nan, inf and huge values are left to str()
+    pieces = [row[row_keep].tobytes() if is_plain else str(value).encode()
+              for row, row_keep, is_plain, value in zip(chars, keep, plain.tolist(), values.tolist())]
+    return np.frombuffer(b''.join(pieces), dtype=np.uint8), np.array([len(piece) for piece in pieces])
+
+
+def convert_relative_chunk(data, state):
+    """
+    Converts the bytes of a chunk of complete lines without blank lines.
+    `state` carries the extrusion mode, tool and last E values from a chunk to the next.
+    """
+    size = len(data)
+    if size == 0:
+        return data
+    buf = np.frombuffer(data + b'\0\0\0', dtype=np.uint8)    # padded for the look ahead below
+    text = buf[:size]
+
+    # lines:
+    ends = np.flatnonzero(text == ord('\n'))
+    if data[-1:] != b'\n':
+        ends = np.append(ends, size)
+    starts = np.concatenate(([0], ends[:-1] + 1))
+    c0, c1, c2, c3 = (buf[starts + k] for k in range(4))
+
+    is_absolute = (c0 == ord('M')) & (c1 == ord('8')) & (c2 == ord('2')) & WORD_DELIMITERS[c3]
+    is_relative = (c0 == ord('M')) & (c1 == ord('8')) & (c2 == ord('3')) & WORD_DELIMITERS[c3]
+    is_tool = c0 == ord('T')
+    is_reset = (c0 == ord('G')) & (c1 == ord('9')) & (c2 == ord('2')) & ((c3 == ord(' ')) | (c3 == ord('\t')))
+    is_move = (c0 == ord('G')) & ((c1 == ord('0')) | (c1 == ord('1'))) & ((c2 == ord(' ')) | (c2 == ord('\t')))
+
+    # E words in the code part of the lines, the last one of a line is used:
+    comments = np.flatnonzero((text == ord(';')) | (text == ord('(')))
+    code_ends = ends.copy()
+    comment_lines, first_comments = np.unique(np.searchsorted(ends, comments), return_index=True)
+    code_ends[comment_lines] = comments[first_comments]
+
+    e_words = np.flatnonzero((text[1:] == ord('E')) & ((text[:-1] == ord(' ')) | (text[:-1] == ord('\t')))) + 1
+    e_lines = np.searchsorted(ends, e_words)
+    in_code = e_words < code_ends[e_lines]
+    e_words, e_lines = e_words[in_code], e_lines[in_code]
+    last_of_line = np.diff(e_lines, append=-1) != 0
+    e_words, e_lines = e_words[last_of_line], e_lines[last_of_line]
+    value_starts = e_words + 1
+    value_ends = word_ends(buf, value_starts)
+    not_empty = value_ends > value_starts
+    value_starts, value_ends, e_lines = value_starts[not_empty], value_ends[not_empty], e_lines[not_empty]
+
+    has_e = np.zeros(len(starts), dtype=bool)
+    has_e[e_lines] = True
+    is_reset &= has_e
+    is_move &= has_e
+
+    # events, one per line that matters, in the order of the gcode:
+    events = np.flatnonzero(is_absolute | is_relative | is_tool | is_reset | is_move)
+    if len(events) == 0:
+        return data
+    is_absolute, is_relative, is_tool, is_reset, is_move = (
+        mask[events] for mask in (is_absolute, is_relative, is_tool, is_reset, is_move))
+    indexes = np.arange(len(events))
+
+    # extrusion mode in force at each event:
+    mode_events = np.where(is_absolute | is_relative, indexes, -1)
+    np.maximum.accumulate(mode_events, out=mode_events)
+    absolute_mode = np.where(mode_events >= 0, is_absolute[mode_events], state['absolute_mode'])
+
+    # tool in use at each event:
+    tools = state['tools']
+    tool_codes = np.full(len(events), -1, dtype=np.int64)
+    tool_starts = starts[events[is_tool]]
+    for i, tool_start, tool_end in zip(np.flatnonzero(is_tool).tolist(), tool_starts.tolist(),
+                                       word_ends(buf, tool_starts).tolist()):
+        tool_codes[i] = tools.setdefault(data[tool_start:tool_end].decode(), len(tools))
+    tool_events = np.where(is_tool, indexes, -1)
+    np.maximum.accumulate(tool_events, out=tool_events)
+    tool_codes = np.where(tool_events >= 0, tool_codes[tool_events], state['last_tool'])
+
+    # E values of the resets and of the absolute extrusion moves, parsed at once from a
+    # copy of their bytes separated by spaces:
+    converted = is_move & absolute_mode
+    updates = np.flatnonzero(is_reset | converted)
+    e_of_line = np.full(len(starts), -1, dtype=np.int64)
+    e_of_line[e_lines] = np.arange(len(e_lines))
+    update_words = e_of_line[events[updates]]
+    value_bytes = buf[byte_ranges(value_starts[update_words], value_ends[update_words] + 1)]
+    value_bytes[np.cumsum(value_ends[update_words] - value_starts[update_words] + 1) - 1] = ord(' ')
+    values = np.array(value_bytes.tobytes().split(), dtype=float)
+
+    # segmented diff per tool, the first update of a tool is relative to the value carried from the last chunk:
+    order = np.argsort(tool_codes[updates], kind='stable')
+    update_tools = tool_codes[updates][order]
+    update_values = values[order]
+    is_converted = converted[updates][order]
+    previous = np.empty_like(update_values)
+    previous[1:] = update_values[:-1]
+    first_updates = np.flatnonzero(np.diff(update_tools, prepend=-2) != 0)
+    last_e = state['last_e']
+    for i in first_updates.tolist():
+        code = int(update_tools[i])
+        if code in last_e:
+            previous[i] = last_e[code]
+        elif is_converted[i]:
+            # extrusion move before any extrusion reset of the tool
+            raise KeyError(next((name for name, value in tools.items() if value == code), None))
+    last_updates = np.append(first_updates[1:], len(update_tools))[:len(first_updates)] - 1
+    last_e.update(zip(update_tools[last_updates].tolist(), update_values[last_updates].tolist()))
+
+    # back to the gcode order:
+    extrusion_diffs = np.empty_like(update_values)
+    extrusion_diffs[order] = round_array(update_values - previous, 3)
+    is_converted = converted[updates]
+    extrusion_diffs = extrusion_diffs[is_converted]
+    state['absolute_mode'] = bool(absolute_mode[-1])
+    state['last_tool'] = int(tool_codes[-1])
+
+    # replacements: the E value of the converted moves, and the M82 lines by M83
+    moves = update_words[is_converted]
+    absolute_lines = events[is_absolute]
+    if len(moves) == 0 and len(absolute_lines) == 0:
+        return data
+    cut_starts = np.concatenate((value_starts[moves], starts[absolute_lines]))
+    cut_ends = np.concatenate((value_ends[moves], ends[absolute_lines]))
+    new_bytes, new_lengths = format_decimals(extrusion_diffs)
+    new_bytes = np.concatenate((new_bytes, np.tile(np.frombuffer(b'M83', dtype=np.uint8), len(absolute_lines))))
+    new_lengths = np.concatenate((new_lengths, np.full(len(absolute_lines), 3)))
+
+    # the cut bytes are dropped and the new bytes inserted where they were, in a single pass:
+    kept = np.ones(size, dtype=bool)
+    kept[byte_ranges(cut_starts, cut_ends)] = False
+    cuts = np.argsort(cut_starts, kind='stable')
+    removed = np.empty_like(cut_starts)
+    removed[cuts] = np.cumsum(cut_ends[cuts] - cut_starts[cuts]) - (cut_ends[cuts] - cut_starts[cuts])
+    return np.insert(text[kept], np.repeat(cut_starts - removed, new_lengths), new_bytes).tobytes()
 
 
 def offset_gcode(gcode, offset):
     '''Applies the X, Y & Z offset to the values of X, Y & Z displ. of the gcode line.
+       `gcode` is either a gcode string or a GcodeRecord already lexed.
        Returns the modified gcode line.'''
-       
-    gcode_segments = gcode.split(' ')
-    offset_gcode = ''
-    for gcode_segment in gcode_segments:
+
+    if isinstance(gcode, str):
+        gcode = gcode_lexer.parse_line(gcode)
+    params = gcode.params
+
+    offset_segments = []
+    for gcode_segment in gcode.fields:
         if gcode_segment[0] == 'X':
-            x_pos = float(gcode_segment[1:])
-            x_pos += offset[0]
-            gcode_segment = gcode_segment[0] + f'{x_pos:.3f}'
+            gcode_segment = f'X{params["X"] + offset[0]:.3f}'
 
         elif gcode_segment[0] == 'Y':
-            y_pos = float(gcode_segment[1:])
-            y_pos += offset[1]
-            gcode_segment = gcode_segment[0] + f'{y_pos:.3f}'
+            gcode_segment = f'Y{params["Y"] + offset[1]:.3f}'
 
         elif gcode_segment[0] == 'Z':
-            z_pos = float(gcode_segment[1:])
-            z_pos += offset[2]
-            gcode_segment = gcode_segment[0] + f'{z_pos:.3f}'
+            gcode_segment = f'Z{params["Z"] + offset[2]:.3f}'
+
+        offset_segments.append(gcode_segment)
+
+    if gcode.comment is not None:
+        # the comment as it is written, from its first ';' or '(':
+        text = gcode.line.rstrip('\r\n')
+        offset_segments.append(text[min(position for position in (text.find(';'), text.find('(')) if position >= 0):])
+
+    return ' '.join(offset_segments)
+
+
+def round_array(values, decimals=3):
+    """
+    Vectorised round(): same results as Python's round() on each value.
+    np.round scales by 10**decimals, which can break ties differently, so the
+    values close to a tie are rounded again one by one with round().
+    """
+    values = np.asarray(values, dtype=float)
+    rounded = np.round(values, decimals)
+    scaled = np.abs(values * 10.0 ** decimals)
+    ties = np.abs(scaled - np.floor(scaled) - 0.5) < 1e-6
+    for i in np.flatnonzero(ties):
+        rounded[i] = round(float(values[i]), decimals)
+    return rounded
 
-        offset_gcode += ' ' + gcode_segment
 
-    return offset_gcode[1:]
+def write_chunks(chunks, sink, buffer_size=1 << 20):
+    """
+    Writes the str chunks of an iterable to the file-like `sink` as they are produced.
+    The chunks are gathered into writes of about `buffer_size` characters, the sink is
+    flushed after each write. Returns the number of characters written.
+    """
+    if isinstance(chunks, str):
+        chunks = (chunks,)
+    flush = getattr(sink, 'flush', None)
+
+    buffer = []
+    buffered = 0
+    written = 0
+    for chunk in chunks:
+        if not chunk:
+            continue
+        buffer.append(chunk)
+        buffered += len(chunk)
+        if buffered >= buffer_size:
+            sink.write(''.join(buffer))
+            if flush is not None:
+                flush()
+            written += buffered
+            buffer, buffered = [], 0
+    if buffer:
+        sink.write(''.join(buffer))
+        written += buffered
+    if flush is not None:
+        flush()
+    return written
+
+
+def iter_blocks(chunks, separator='\n\n'):
+    """
+    Generates the blocks of the text made of the str `chunks` separated by `separator`
+    (of 1 or 2 characters), as `''.join(chunks).split(separator)` but without joining the
+    chunks of text which are not split
+    """
+    rest = []
+    for chunk in chunks:
+        if not chunk:
+            continue
+        # a separator may also begin at the end of the previous chunk:
+        boundary = rest[-1][-1:] + chunk[0] if rest else ''
+        if separator not in chunk and separator not in boundary:
+            rest.append(chunk)
+            continue
+        blocks = (''.join(rest) + chunk).split(separator)
+        rest = [blocks.pop()]
+        yield from blocks
+    yield ''.join(rest)
+
+
+def split_by_size(items, n_chunks):
+    """
+    Splits the list of strings `items` into at most `n_chunks` consecutive chunks
+    holding about the same number of characters
+    """
+    sizes = np.cumsum([len(item) for item in items])
+    if len(sizes) == 0:
+        return []
+    bounds = np.searchsorted(sizes, sizes[-1] * np.arange(1, n_chunks) / n_chunks, side='right')
+    bounds = [0] + sorted(set(bounds.tolist()) - {0, len(items)}) + [len(items)]
+    return [items[start:stop] for start, stop in zip(bounds[:-1], bounds[1:])]
 
 
 def find_maxima(numbers):
@@ -123,6 +379,7 @@ def find_maxima(numbers):
 
 
 def open_file(path):
+    import subprocess
     print(f"JLC:openning path: <{path}>")
     if sys.platform == 'win32':
         path = os.path.normpath(path)
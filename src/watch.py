@@ -0,0 +1,160 @@
+"""
+Watch mode: merges the input files again each time they (or the config) change.
+
+The Watcher keeps the parsed additive layers and CAM operations of the last merge in
+memory. When the files change, only the side whose content changed is parsed again:
+the Fusion add-in posts both files each time, but a CAM edit leaves the additive gcode
+as it was. The CAM operations are also parsed again when the settings they depend on
+change (offset, 3D surfacing split), a change of the other CamSettings (layer_overlap)
+only schedules and writes the merged gcode again.
+
+The files are checked every `interval` seconds by their modification time and size,
+a merge starts once they have not changed for one interval (the add-in may still be
+writing them). A failed merge is reported and the previous parse is kept.
+"""
+import hashlib
+import json
+import os
+import threading
+import time
+
+from .ASMBL_parser import Parser
+from .run_log import RunLog
+from .sweep import cam_parse_key
+
+WATCH_INTERVAL = 0.5    # s between two checks of the files
+READ_SIZE = 1 << 20
+
+ADDITIVE_STATE = ('gcode_add', 'gcode_add_layers', 'gcode_add_table')
+
+
+def file_signature(path):
+    """ (modification time, size) of the file `path`, None if it does not exist """
+    try:
+        stat = os.stat(path)
+    except FileNotFoundError:
+        return None
+    return stat.st_mtime_ns, stat.st_size
+
+
+def file_digest(path):
+    """ Hash of the content of the file `path` """
+    digest = hashlib.sha256()
+    with open(path, 'rb') as gcode_file:
+        for chunk in iter(lambda: gcode_file.read(READ_SIZE), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+class Watcher:
+    """
+    Merges the input files of the config file `config_path` into `folder_path` each time
+    they change, see the module docstring. `overrides` is an optional function applied
+    to the config each time it is loaded (command line options).
+    """
+
+    def __init__(self, config_path, folder_path='output/', interval=WATCH_INTERVAL, workers=1, overrides=None):
+        self.config_path = config_path
+        self.folder_path = os.path.join(folder_path, '')
+        self.interval = interval
+        self.workers = workers
+        self.overrides = overrides
+
+        self.additive = None            # Parser holding the parsed additive gcode
+        self.additive_key = None        # hash of the parsed additive file
+        self.operations = None          # parsed CAM operations
+        self.cam_key = None             # hash of the parsed subtractive file and the settings of the parse
+        self.merged = None              # what the last merge was made of
+
+    def load_config(self):
+        with open(self.config_path) as config_file:
+            config = json.load(config_file)
+        if self.overrides is not None:
+            self.overrides(config)
+        if config['Flags']['append_AddSubGcode']:
+            raise ValueError('The watch mode does not append the subtractive gcode (append_AddSubGcode)')
+        return config
+
+    def paths(self):
+        """ The files watched: the config file and the input files of the current config """
+        paths = [self.config_path]
+        try:
+            paths += self.load_config()['InputFiles'].values()
+        except (OSError, ValueError, KeyError):
+            pass
+        return paths
+
+    def signatures(self):
+        return {path: file_signature(path) for path in self.paths()}
+
+    def update(self):
+        """
+        Merges the input files, parsing again only what changed since the last merge.
+        Returns {'additive': , 'subtractive': 'parsed' | 'kept', 'file': , 'wall_s': },
+        None if nothing changed.
+        """
+        start = time.perf_counter()
+        config = self.load_config()
+        additive_key = file_digest(config['InputFiles']['additive_gcode'])
+        cam_key = (file_digest(config['InputFiles']['subtractive_gcode']), cam_parse_key(config))
+        merged = (additive_key, cam_key, json.dumps(config, sort_keys=True))
+        if merged == self.merged:
+            return None
+
+        result = {'additive': 'kept', 'subtractive': 'kept'}
+        with RunLog(config):
+            parser = Parser(config, run=False, workers=self.workers, quiet=True)
+
+            additive = self.additive
+            if additive_key != self.additive_key:
+                parser.open_additive_file(config)
+                parser.split_additive_gcode(parser.convert_additive_gcode())
+                additive = parser
+                result['additive'] = 'parsed'
+            else:
+                for name in ADDITIVE_STATE:
+                    setattr(parser, name, getattr(additive, name))
+
+            operations = self.operations
+            if cam_key != self.cam_key:
+                parser.open_subtractive_file(config)
+                try:
+                    operations = parser.parse_cam_operations()
+                finally:
+                    parser.gcode_sub_file.close()
+                parser.gcode_sub = None
+                result['subtractive'] = 'parsed'
+
+            parser.schedule(operations)
+            result['file'] = parser.create_output_file(folder_path=self.folder_path, open_output=False)
+
+        # the parsed data are only kept once the merge succeeded:
+        self.additive, self.additive_key = additive, additive_key
+        self.operations, self.cam_key = operations, cam_key
+        self.merged = merged
+        result['wall_s'] = time.perf_counter() - start
+        return result
+
+    def run(self, stop=None, report=print):
+        """
+        Checks the files and merges them when they changed, until the threading.Event `stop`
+        is set (or forever). `report` is called with the message of each merge.
+        """
+        stop = stop or threading.Event()
+        previous, merged = None, None
+        while not stop.is_set():
+            signatures = self.signatures()
+            # the files must have been stable for one interval:
+            if signatures != merged and signatures == previous:
+                merged = signatures
+                try:
+                    result = self.update()
+                except Exception as error:
+                    report(f"{time.strftime('%H:%M:%S')} merge FAILED: {type(error).__name__}: {error}")
+                else:
+                    if result is not None:
+                        report(f"{time.strftime('%H:%M:%S')} additive {result['additive']}, "
+                               f"subtractive {result['subtractive']}, merged in {result['wall_s']:.2f} s "
+                               f"-> {result['file']}")
+            previous = signatures
+            stop.wait(self.interval)
@@ -0,0 +1,151 @@
+"""
+Round trips of src.bgcode: the binary gcode written by BgcodeWriter, with each compression
+and gcode encoding, must decode with read_bgcode to the same gcode, with valid block CRCs.
+"""
+import io
+import random
+import struct
+import zlib
+
+import pytest
+
+from src import bgcode
+from src.bgcode import BlockType, Compression
+
+
+def sample_gcode(lines=6000, seed=0):
+    """ Merged-like gcode of about 40 bytes per line: moves, comments, tool changes """
+    rng = random.Random(seed)
+    gcode = ['; generated by N-Fab\n', 'M104 S210 ; set the temperature\n', 'G28\n', '\n']
+    for i in range(lines):
+        kind = rng.random()
+        if kind < 0.7:
+            gcode.append(f'G1 X{rng.uniform(-100, 100):.3f} Y{rng.uniform(-100, 100):.3f} E{rng.random():.5f}\n')
+        elif kind < 0.85:
+            gcode.append(f'G0 X{rng.uniform(0, 200):.2f} Y{rng.uniform(0, 200):.2f} Z{i / 100:.2f} F6000\n')
+        elif kind < 0.95:
+            gcode.append(f';LAYER:{i} (comment with lowercase, tabs\tand symbols: #%*)\n')
+        else:
+            gcode.append(f'T{i % 3}\nM3 S24000\tg1 z-0.5 f300 ; cut\n')
+    return ''.join(gcode)
+
+
+def write_bgcode(gcode, settings, metadata=None, thumbnails=(), workers=1, pieces=7):
+    """ The bgcode bytes of `gcode`, written to the writer in `pieces` uneven pieces """
+    file = io.BytesIO()
+    with bgcode.BgcodeWriter(file, settings, metadata, thumbnails, workers=workers) as writer:
+        cuts = sorted(random.Random(1).sample(range(1, len(gcode)), min(pieces, len(gcode)) - 1))
+        for start, end in zip([0] + cuts, cuts + [len(gcode)]):
+            writer.write(gcode[start:end])
+    return file.getvalue()
+
+
+def blocks(data):
+    """ [(block type, compression, stored CRC, CRC of the block bytes)] of the bgcode bytes `data` """
+    _, checksum = struct.unpack_from('<IH', data, 4)
+    assert checksum == bgcode.Checksum.CRC32
+    found = []
+    i = 10
+    while i < len(data):
+        start = i
+        block_type, compression, stored_size = struct.unpack_from('<HHI', data, i)
+        i += 8
+        if compression != Compression.NONE:
+            stored_size, = struct.unpack_from('<I', data, i)
+            i += 4
+        i += (6 if block_type == BlockType.THUMBNAIL else 2) + stored_size
+        crc, = struct.unpack_from('<I', data, i)
+        found.append((BlockType(block_type), Compression(compression), crc, zlib.crc32(data[start:i])))
+        i += 4
+    assert i == len(data)
+    return found
+
+
+@pytest.fixture(params=[False, True], ids=['numpy', 'heatshrink2'])
+def heatshrink(request, monkeypatch):
+    """ Runs a test with the numpy heatshrink of src.bgcode, and with heatshrink2 if it is installed """
+    if request.param:
+        if bgcode.heatshrink_module() is None:
+            pytest.skip('heatshrink2 is not installed')
+    else:
+        monkeypatch.setattr(bgcode, '_heatshrink2', None)
+
+
+@pytest.mark.parametrize('encoding', ['none', 'meatpack', 'meatpack_comments'])
+@pytest.mark.parametrize('compression', ['none', 'deflate', 'heatshrink_11_4', 'heatshrink_12_4'])
+def test_round_trip(compression, encoding, heatshrink):
+    gcode = sample_gcode()
+    settings = {'gcode_compression': compression, 'gcode_encoding': encoding, 'metadata_compression': compression}
+    metadata = {BlockType.PRINTER_METADATA: {'bed_centre_x': 100, 'bed_centre_y': 100},
+                BlockType.SLICER_METADATA: {'layer_overlap': 2, 'layer_dropdown': 0.1}}
+    data = write_bgcode(gcode, settings, metadata)
+
+    decoded = bgcode.read_bgcode(data)
+    expected = bgcode.strip_comments(gcode.encode()).decode() if encoding == 'meatpack' else gcode
+    assert decoded['gcode'] == expected
+    assert decoded['blocks'] == -(-len(gcode.encode()) // bgcode.BLOCK_SIZE)
+    assert decoded['metadata'][BlockType.FILE_METADATA] == {'Producer': 'N-Fab'}
+    assert decoded['metadata'][BlockType.PRINTER_METADATA] == {'bed_centre_x': '100', 'bed_centre_y': '100'}
+    assert decoded['metadata'][BlockType.SLICER_METADATA] == {'layer_overlap': '2', 'layer_dropdown': '0.1'}
+
+    found = blocks(data)
+    assert [crc for *_, crc, _ in found] == [crc for *_, crc in found]
+    gcode_blocks = [block for block in found if block[0] == BlockType.GCODE]
+    assert len(gcode_blocks) == decoded['blocks']
+    if compression != 'none':   # gcode compresses: no block falls back to Compression.NONE
+        assert {block[1] for block in gcode_blocks} == {bgcode.setting(Compression, compression)}
+
+
+def test_workers_same_bytes():
+    gcode = sample_gcode(lines=12000)
+    settings = {'gcode_compression': 'deflate', 'gcode_encoding': 'meatpack_comments'}
+    data = write_bgcode(gcode, settings)
+    assert write_bgcode(gcode, settings, workers=2) == data
+    assert write_bgcode(gcode, settings, pieces=1) == data
+
+
+def test_thumbnails():
+    png = b'\x89PNG\r\n\x1a\n' + struct.pack('>I4sII', 13, b'IHDR', 16, 12) + bytes(40)
+    data = write_bgcode('G28\n', {}, thumbnails=[png])
+    assert bgcode.read_bgcode(data)['thumbnails'] == [(bgcode.ThumbnailFormat.PNG, 16, 12, png)]
+    assert BlockType.THUMBNAIL in [block[0] for block in blocks(data)]
+
+
+def test_no_checksum():
+    gcode = sample_gcode(lines=100)
+    data = write_bgcode(gcode, {'checksum': 'none'})
+    assert struct.unpack_from('<IH', data, 4)[1] == bgcode.Checksum.NONE
+    assert bgcode.read_bgcode(data)['gcode'] == gcode
+
+
+def test_corrupted_block():
+    data = bytearray(write_bgcode(sample_gcode(lines=100), {}))
+    data[-10] ^= 0x01
+    with pytest.raises(ValueError, match='checksum'):
+        bgcode.read_bgcode(bytes(data))
+    with pytest.raises(ValueError, match='Not a bgcode'):
+        bgcode.read_bgcode(b'GCODE' + bytes(data[5:]))
+
+
+@pytest.mark.parametrize('window_bits, lookahead_bits', [(8, 4), (11, 4), (12, 4)])
+@pytest.mark.parametrize('data', [
+    b'', b'G', b'GG', b'GGG', b'G1 X1\n' * 2000, bytes(5000), bytes(range(256)) * 40,
+    bytes(random.Random(2).getrandbits(8) for _ in range(5000)),
+    b'G1 X10.5 Y-3.2 E0.0123\nG1 X10.6 Y-3.1 E0.0125\n' * 300,
+], ids=['empty', '1', '2', '3', 'lines', 'zeros', 'ramp', 'random', 'moves'])
+def test_heatshrink(data, window_bits, lookahead_bits, heatshrink):
+    compressed = bgcode.heatshrink_compress(data, window_bits, lookahead_bits)
+    assert bgcode.heatshrink_decompress(compressed, window_bits, lookahead_bits) == data
+    heatshrink2 = bgcode.heatshrink_module()
+    if heatshrink2 is not None:     # the numpy heatshrink is read by the C one, and back
+        assert heatshrink2.decompress(compressed, window_sz2=window_bits, lookahead_sz2=lookahead_bits) == data
+        compressed = heatshrink2.compress(data, window_sz2=window_bits, lookahead_sz2=lookahead_bits)
+        assert bgcode.heatshrink_decompress(compressed, window_bits, lookahead_bits) == data
+
+
+@pytest.mark.parametrize('data', [
+    b'', b'G1 X1\n', b'G1 X1', b'G1 X1\nM104 S210', b'\n\n\n', b'g1 x1 ; Comment\tTAB\n',
+    bytes(range(1, 255)) + b'\n', sample_gcode(lines=500).encode(),
+], ids=['empty', 'line', 'no newline', 'tail', 'newlines', 'lowercase', 'bytes', 'gcode'])
+def test_meatpack(data):
+    assert bgcode.meatpack_decode(bgcode.meatpack_encode(data)) == data
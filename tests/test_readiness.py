@@ -0,0 +1,208 @@
+"""
+Tests of src.readiness: the waits of the Fusion add-in for its posted files and toolpaths.
+"""
+import os
+import sys
+import threading
+import time
+
+import pytest
+
+from src import readiness
+
+CPU_BOUND = 0.1     # s of CPU time for a wait of about 1 s: the waits must not spin a core
+
+
+class FakeToolpathFuture:
+    """ GenerateToolpathFuture of `operations` toolpaths taking `duration` seconds each """
+
+    def __init__(self, operations, duration):
+        self.numberOfOperations = operations
+        self.start = time.monotonic()
+        self.duration = duration
+
+    @property
+    def numberOfCompleted(self):
+        return min(self.numberOfOperations, int((time.monotonic() - self.start) / self.duration))
+
+    @property
+    def isGenerationCompleted(self):
+        return self.numberOfCompleted == self.numberOfOperations
+
+
+class FailingToolpathFuture:
+    """ GenerateToolpathFuture whose generation fails after `delay` seconds """
+
+    def __init__(self, delay):
+        self.start = time.monotonic()
+        self.delay = delay
+
+    @property
+    def isGenerationCompleted(self):
+        if time.monotonic() - self.start > self.delay:
+            raise RuntimeError('toolpath generation failed')
+        return False
+
+
+def later(delay, function, *args):
+    """ Runs function(*args) in a thread after `delay` seconds, returns the thread """
+    thread = threading.Timer(delay, function, args)
+    thread.start()
+    return thread
+
+
+def write_file(path, lines, period):
+    """ Writes `lines` lines in the file `path`, one every `period` seconds """
+    with open(path, 'w') as file:
+        for i in range(lines):
+            file.write(f'G1 X{i}\n')
+            file.flush()
+            time.sleep(period)
+
+
+def test_file_appearing_late(tmp_path):
+    path = tmp_path / 'tmpAdditive.gcode'
+    writer = later(0.3, path.write_text, 'G1 X0\n')
+    start = time.perf_counter()
+    readiness.wait_for_files([path], timeout=5, stable_for=0.1)
+    writer.join()
+    assert 0.4 <= time.perf_counter() - start < 2
+    assert path.read_text() == 'G1 X0\n'
+
+
+def test_file_still_written(tmp_path):
+    path = tmp_path / 'tmpSubtractive.gcode'
+    writer = threading.Thread(target=write_file, args=(path, 10, 0.1))
+    cpu = time.process_time()
+    writer.start()
+    readiness.wait_for_files([path], timeout=10)
+    cpu = time.process_time() - cpu
+    done = not writer.is_alive()
+    writer.join()
+    assert done, 'the file was ready before its writer was done'
+    assert len(path.read_text().splitlines()) == 10
+    assert cpu < CPU_BOUND
+
+
+def test_several_files(tmp_path):
+    paths = [tmp_path / 'tmpAdditive.gcode', tmp_path / 'tmpSubtractive.gcode']
+    writers = [later(0.1, paths[0].write_text, 'G1 X0\n'), later(0.5, paths[1].write_text, 'G1 X1\n')]
+    start = time.perf_counter()
+    readiness.wait_for_files(paths, timeout=5, stable_for=0.1)
+    for writer in writers:
+        writer.join()
+    assert time.perf_counter() - start >= 0.6
+
+
+def test_file_never_written(tmp_path):
+    path = tmp_path / 'never.gcode'
+    start = time.perf_counter()
+    with pytest.raises(TimeoutError, match='file not written'):
+        readiness.wait_for_files([path], timeout=0.5)
+    assert 0.5 <= time.perf_counter() - start < 0.5 + 2 * readiness.MAX_DELAY
+
+
+def test_file_written_past_timeout(tmp_path):
+    path = tmp_path / 'tmpSubtractive.gcode'
+    writer = threading.Thread(target=write_file, args=(path, 20, 0.05))
+    writer.start()
+    try:
+        with pytest.raises(TimeoutError, match='still written or locked'):
+            readiness.wait_for_files([path], timeout=0.5)
+    finally:
+        writer.join()
+
+
+def test_file_removed(tmp_path):
+    path = tmp_path / 'NFab.gcode'
+    path.write_text('G1 X0\n')
+    remover = later(0.3, os.remove, path)
+    start = time.perf_counter()
+    readiness.wait_for_removal(path, timeout=5)
+    remover.join()
+    assert 0.3 <= time.perf_counter() - start < 1
+    assert not path.exists()
+
+
+def test_file_not_removed(tmp_path):
+    path = tmp_path / 'NFab.gcode'
+    path.write_text('G1 X0\n')
+    with pytest.raises(TimeoutError, match='removal'):
+        readiness.wait_for_removal(path, timeout=0.3)
+
+
+def test_cancel(tmp_path):
+    cancel = threading.Event()
+    canceller = later(0.3, cancel.set)
+    start = time.perf_counter()
+    with pytest.raises(readiness.WaitCancelled):
+        readiness.wait_for_files([tmp_path / 'never.gcode'], timeout=10, cancel=cancel)
+    canceller.join()
+    assert time.perf_counter() - start < 0.3 + 2 * readiness.MAX_DELAY
+
+
+def test_cancel_function(tmp_path):
+    start = time.monotonic()
+    with pytest.raises(readiness.WaitCancelled):
+        readiness.wait_for_removal(__file__, timeout=10, cancel=lambda: time.monotonic() - start > 0.2)
+
+
+def test_future_generated():
+    future = FakeToolpathFuture(4, 0.25)
+    calls = []
+    cpu = time.process_time()
+    readiness.wait_for_future(future, timeout=10, on_wait=lambda: calls.append(future.numberOfCompleted))
+    cpu = time.process_time() - cpu
+    assert future.isGenerationCompleted
+    # on_wait keeps the UI alive: called every period (0.125 s) while the toolpaths are generated
+    assert 6 <= len(calls) <= 10
+    assert calls == sorted(calls)
+    assert cpu < CPU_BOUND
+
+
+def test_future_timeout():
+    start = time.perf_counter()
+    with pytest.raises(TimeoutError, match='toolpaths'):
+        readiness.wait_for_future(FakeToolpathFuture(4, 10), timeout=0.5)
+    assert 0.5 <= time.perf_counter() - start < 0.5 + 2 * readiness.MAX_DELAY
+
+
+def test_future_error():
+    with pytest.raises(RuntimeError, match='generation failed'):
+        readiness.wait_for_future(FailingToolpathFuture(0.2), timeout=5)
+
+
+def test_backoff():
+    """ The delays between the checks double from first_delay up to max_delay """
+    checks = []
+    with pytest.raises(TimeoutError):
+        readiness.wait_until(lambda: checks.append(time.monotonic()), timeout=1, first_delay=0.01, max_delay=0.16)
+    delays = [b - a for a, b in zip(checks, checks[1:])]
+    assert len(checks) < 15
+    assert delays[0] < 0.05
+    assert max(delays) < 0.16 + 0.05
+    assert max(delays) >= 0.16
+
+
+@pytest.mark.skipif(sys.platform != 'linux', reason='inotify')
+def test_folder_events(tmp_path):
+    """ On Linux an event in the folder wakes the wait before the end of its sleep """
+    with readiness.FolderEvents([tmp_path]) as events:
+        assert events.fd is not None
+        writer = later(0.1, (tmp_path / 'tmpAdditive.gcode').write_text, 'G1 X0\n')
+        start = time.perf_counter()
+        assert events.wait(5)
+        assert time.perf_counter() - start < 1
+        writer.join()
+        events.wait(0.05)       # the events of the rest of the write
+        assert not events.wait(0.05)
+    assert events.fd is None
+
+
+def test_folder_events_without_folder(tmp_path):
+    """ Without a folder to watch, the wait is a plain sleep """
+    with readiness.FolderEvents([tmp_path / 'missing']) as events:
+        assert events.fd is None
+        start = time.perf_counter()
+        assert not events.wait(0.1)
+        assert time.perf_counter() - start >= 0.1